@@ -0,0 +1,337 @@
+"""Versioned JSON read API for the mobile clients.
+
+Everything is under /api/v1, authenticated with the same login session as
+the HTML pages. Lists are paginated with the same keyset cursors as the
+site: each response has `items` and a `next` cursor to pass back as
+'before' (None on the last page). Large exports stream as NDJSON.
+"""
+
+import json
+
+from flask import Blueprint, Response, g, request, stream_with_context
+
+from models import (author_card, User, Message, Like, DirectMessage,
+                    ConversationParticipant, Follows, Recommendation,
+                    TimelineEntry)
+from pagination import PAGE_SIZE, paginate
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+EXPORT_BATCH_SIZE = 1000
+
+
+##############################################################################
+# Serialization
+
+
+def dumps(data):
+    """Compact JSON bytes (orjson when installed)."""
+
+    if orjson is not None:
+        return orjson.dumps(data)
+
+    return json.dumps(data, separators=(',', ':')).encode('UTF-8')
+
+
+def json_response(data, status=200):
+    return Response(dumps(data), status=status, mimetype='application/json')
+
+
+def serialize_user(user):
+    return {
+        'id': user.id,
+        'username': user.username,
+        'image_url': user.image_url,
+    }
+
+
+def serialize_message(message, author=None):
+    return {
+        'id': message.id,
+        'text': message.text,
+        'timestamp': message.timestamp.isoformat(),
+        'user': serialize_user(author or message.user),
+        'like_count': message.like_count,
+    }
+
+
+def serialize_direct_message(message):
+    return {
+        'id': message.id,
+        'text': message.text,
+        'timestamp': message.timestamp.isoformat(),
+        'user': serialize_user(message.user),
+        'recipient': message.recipient.username,
+        'recipient_id': message.recipient_id,
+        'conversation_id': message.conversation_id,
+    }
+
+
+def serialize_conversation(participant):
+    return {
+        'id': participant.conversation_id,
+        'user': serialize_user(participant.other_user),
+        'last_message_at': participant.last_message_at.isoformat(),
+        'last_message': participant.conversation.last_message_preview,
+        'unread_count': participant.unread_count,
+    }
+
+
+def page_response(items, next_cursor):
+    return json_response({'items': items, 'next': next_cursor})
+
+
+def page_limit():
+    """The 'limit' querystring param, clamped to 1..PAGE_SIZE."""
+
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    return max(1, min(limit, PAGE_SIZE))
+
+
+def _user_key(user):
+    return user.id, user.id
+
+
+##############################################################################
+# Auth and errors
+
+
+@api.before_request
+def require_login():
+    if not g.identity:
+        return json_response({'error': 'unauthorized'}, 401)
+
+
+@api.errorhandler(404)
+def not_found(error):
+    return json_response({'error': 'not found'}, 404)
+
+
+##############################################################################
+# Timelines and profiles
+
+
+@api.get('/timeline')
+def timeline():
+    """The logged-in user's home timeline."""
+
+    messages, next_cursor = paginate(
+        (Message.with_author()
+         .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+         .filter(TimelineEntry.user_id == g.identity.id)),
+        TimelineEntry.timestamp,
+        TimelineEntry.message_id,
+        cursor=request.args.get('before'),
+        limit=page_limit())
+
+    return page_response([serialize_message(msg) for msg in messages],
+                         next_cursor)
+
+
+@api.get('/users/<int:user_id>')
+def user_detail(user_id):
+    """A user's profile and counters."""
+
+    user = User.query.get_or_404(user_id)
+
+    return json_response({
+        **serialize_user(user),
+        'header_image_url': user.header_image_url,
+        'bio': user.bio,
+        'location': user.location,
+        'message_count': user.message_count,
+        'following_count': user.following_count,
+        'follower_count': user.follower_count,
+        'likes_count': user.likes_count,
+    })
+
+
+@api.get('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """A user's messages, newest first."""
+
+    user = User.query.get_or_404(user_id)
+    messages, next_cursor = paginate(
+        Message.query.filter(Message.user_id == user.id),
+        Message.timestamp,
+        Message.id,
+        cursor=request.args.get('before'),
+        limit=page_limit())
+
+    return page_response([serialize_message(msg, user) for msg in messages],
+                         next_cursor)
+
+
+@api.get('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    """Messages a user has liked."""
+
+    user = User.query.get_or_404(user_id)
+    messages, next_cursor = paginate(
+        (Message.with_author()
+         .join(Like, Like.message_id == Message.id)
+         .filter(Like.user_id == user.id)),
+        Message.timestamp,
+        Message.id,
+        cursor=request.args.get('before'),
+        limit=page_limit())
+
+    return page_response([serialize_message(msg) for msg in messages],
+                         next_cursor)
+
+
+def _follow_page(user_id, own_column, other_column):
+    """One page of the users on the other side of `user_id`'s follows."""
+
+    user = User.query.get_or_404(user_id)
+    users, next_cursor = paginate(
+        (User.query
+         .join(Follows, other_column == User.id)
+         .filter(own_column == user.id)),
+        User.id,
+        User.id,
+        cursor=request.args.get('before'),
+        limit=page_limit(),
+        key=_user_key,
+        kind=int)
+
+    return page_response([serialize_user(other) for other in users],
+                         next_cursor)
+
+
+@api.get('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    """Users following this user."""
+
+    return _follow_page(user_id,
+                        Follows.user_being_followed_id,
+                        Follows.user_following_id)
+
+
+@api.get('/users/<int:user_id>/following')
+def user_following(user_id):
+    """Users this user follows."""
+
+    return _follow_page(user_id,
+                        Follows.user_following_id,
+                        Follows.user_being_followed_id)
+
+
+@api.get('/direct_messages')
+def direct_messages():
+    """Direct messages the logged-in user sent or received."""
+
+    messages, next_cursor = paginate(
+        (DirectMessage.with_author()
+         .options(author_card(DirectMessage.recipient))
+         .join(ConversationParticipant,
+               ConversationParticipant.conversation_id
+               == DirectMessage.conversation_id)
+         .filter(ConversationParticipant.user_id == g.identity.id)),
+        DirectMessage.timestamp,
+        DirectMessage.id,
+        cursor=request.args.get('before'),
+        limit=page_limit())
+
+    return page_response([serialize_direct_message(msg) for msg in messages],
+                         next_cursor)
+
+
+@api.get('/conversations')
+def conversations():
+    """The logged-in user's conversations, most recent first."""
+
+    participants, next_cursor = paginate(
+        ConversationParticipant.inbox(g.identity.id),
+        ConversationParticipant.last_message_at,
+        ConversationParticipant.conversation_id,
+        cursor=request.args.get('before'),
+        limit=page_limit(),
+        key=lambda row: (row.last_message_at, row.conversation_id))
+
+    return page_response([serialize_conversation(participant)
+                          for participant in participants],
+                         next_cursor)
+
+
+@api.get('/conversations/<int:conversation_id>/messages')
+def conversation_messages(conversation_id):
+    """Messages in one of the logged-in user's conversations."""
+
+    ConversationParticipant.query.get_or_404((conversation_id,
+                                              g.identity.id))
+
+    messages, next_cursor = paginate(
+        (DirectMessage.with_author()
+         .options(author_card(DirectMessage.recipient))
+         .filter(DirectMessage.conversation_id == conversation_id)),
+        DirectMessage.timestamp,
+        DirectMessage.id,
+        cursor=request.args.get('before'),
+        limit=page_limit())
+
+    return page_response([serialize_direct_message(msg) for msg in messages],
+                         next_cursor)
+
+
+@api.get('/recommendations')
+def recommendations():
+    """Who-to-follow suggestions for the logged-in user, best first.
+
+    Precomputed by recommendations.py; `score` is how many of the accounts
+    the user follows follow the suggested one.
+    """
+
+    suggestions = Recommendation.for_user(g.identity.id, page_limit())
+
+    return page_response([{**serialize_user(suggestion.candidate),
+                           'score': suggestion.score}
+                          for suggestion in suggestions],
+                         None)
+
+
+##############################################################################
+# NDJSON exports
+
+
+def ndjson_response(rows, serialize):
+    """Stream `rows` as newline-delimited JSON, one serialized row per line."""
+
+    def generate():
+        for row in rows:
+            yield dumps(serialize(row)) + b'\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+@api.get('/users/<int:user_id>/messages.ndjson')
+def export_user_messages(user_id):
+    """Every message a user has posted, newest first."""
+
+    user = User.query.get_or_404(user_id)
+    rows = (Message.query
+            .filter(Message.user_id == user.id)
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .yield_per(EXPORT_BATCH_SIZE))
+
+    return ndjson_response(rows, lambda msg: serialize_message(msg, user))
+
+
+@api.get('/users/<int:user_id>/likes.ndjson')
+def export_user_likes(user_id):
+    """Every message a user has liked, newest first."""
+
+    user = User.query.get_or_404(user_id)
+    rows = (Message.with_author()
+            .join(Like, Like.message_id == Message.id)
+            .filter(Like.user_id == user.id)
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .yield_per(EXPORT_BATCH_SIZE))
+
+    return ndjson_response(rows, serialize_message)
@@ -1,15 +1,93 @@
 import os
+from collections import namedtuple
+from functools import cached_property, partial
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (Flask, render_template, request, flash, redirect, session, g,
+                   abort, jsonify)
+from markupsafe import Markup
+from flask.ctx import _AppCtxGlobals
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm, CSRFProtectForm, EditUserForm, DirectMessageForm
-from models import db, connect_db, User, Message, Like, DirectMessage
+import assets
+import instrumentation
+from api import api
+from events import events, hub as event_hub, publish_follow, publish_message
+from followgraph import follow_graph
+from compression import CompressionMiddleware, DEFAULT_MIMETYPES
+from caching import TTLCache, LRUCache, RedisBackend, FragmentCache
+from http_caching import page_etag, render_conditional
+from hashing import HashingOverloaded
+from pagination import paginate, paginate_ids
+from search import search_users, create_search_indexes
+from instrumentation import query_budget
+from like_buffer import like_buffer, remember_pending_like, session_overlay
+from models import (db, connect_db, User, Message, Like, DirectMessage,
+                    Conversation, ConversationParticipant, Follows,
+                    TimelineEntry, TopMessage, Recommendation, LikeBucket,
+                    LEADERBOARD_WINDOWS)
 
 CURR_USER_KEY = "curr_user"
 
+# Who-to-follow suggestions shown in the profile sidebar.
+SIDEBAR_SUGGESTIONS = 5
+
+# Slim record of the logged-in user: enough for the navbar and for
+# authorization checks, without loading the full User row.
+Identity = namedtuple('Identity', ['id', 'username', 'image_url'])
+
+
+class WarblerGlobals(_AppCtxGlobals):
+    """Flask `g`, with the current user and CSRF form built on first use.
+
+    Requests that never touch g.user / g.identity / g.csrf (static files,
+    anonymous pages) skip the lookups entirely.
+    """
+
+    @cached_property
+    def user(self):
+        """The logged-in User, or None."""
+
+        if CURR_USER_KEY not in session:
+            return None
+
+        return User.query.get(session[CURR_USER_KEY])
+
+    @cached_property
+    def identity(self):
+        """The logged-in user's Identity, or None.
+
+        Served from a short-TTL per-worker cache where possible.
+        """
+
+        if CURR_USER_KEY not in session:
+            return None
+
+        user_id = session[CURR_USER_KEY]
+        identity = identity_cache.get(user_id)
+
+        if identity is None:
+            row = (db.session.query(User.id, User.username, User.image_url)
+                   .filter(User.id == user_id)
+                   .first())
+            if row is None:
+                return None
+
+            identity = Identity(*row)
+            identity_cache.set(user_id, identity)
+
+        return identity
+
+    @cached_property
+    def csrf(self):
+        """A CSRFProtectForm for the logout/like/delete buttons."""
+
+        return CSRFProtectForm()
+
+
 app = Flask(__name__)
+app.app_ctx_globals_class = WarblerGlobals
 
 # Get DB_URI from environ variable (useful for production/testing) or,
 # if not set there, use development local db.
@@ -19,29 +97,210 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+app.config['IDENTITY_CACHE_TTL'] = int(os.environ.get('IDENTITY_CACHE_TTL', 30))
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['HASHING_WORKERS'] = int(
+    os.environ.get('HASHING_WORKERS', os.cpu_count() or 1))
+app.config['HASHING_QUEUE_TIMEOUT'] = float(
+    os.environ.get('HASHING_QUEUE_TIMEOUT', 0.25))
 toolbar = DebugToolbarExtension(app)
 
+app.config['FRAGMENT_CACHE_ENTRIES'] = int(
+    os.environ.get('FRAGMENT_CACHE_ENTRIES', 10_000))
+app.config['FRAGMENT_CACHE_BYTES'] = int(
+    os.environ.get('FRAGMENT_CACHE_BYTES', 16 * 1024 * 1024))
+app.config['FRAGMENT_CACHE_URL'] = os.environ.get('FRAGMENT_CACHE_URL')
+
+identity_cache = TTLCache(ttl=app.config['IDENTITY_CACHE_TTL'])
+fragment_cache = FragmentCache(
+    LRUCache(max_entries=app.config['FRAGMENT_CACHE_ENTRIES'],
+             max_bytes=app.config['FRAGMENT_CACHE_BYTES']),
+    shared=(RedisBackend(app.config['FRAGMENT_CACHE_URL'])
+            if app.config['FRAGMENT_CACHE_URL'] else None))
+
+app.config['SQL_INSTRUMENTATION'] = (
+    os.environ.get('SQL_INSTRUMENTATION', '1') == '1')
+app.config['SQL_STRICT'] = os.environ.get('SQL_STRICT') == '1'
+app.config['SQL_QUERY_BUDGET'] = (int(os.environ['SQL_QUERY_BUDGET'])
+                                  if os.environ.get('SQL_QUERY_BUDGET')
+                                  else None)
+
+app.config['EVENTS_BACKEND_URL'] = os.environ.get('EVENTS_BACKEND_URL')
+app.config['EVENTS_MAX_STREAMS'] = int(os.environ.get('EVENTS_MAX_STREAMS', 8))
+app.config['LIKE_BUFFER_ENABLED'] = (
+    os.environ.get('LIKE_BUFFER_ENABLED') == '1')
+app.config['LIKE_BUFFER_INTERVAL_MS'] = int(
+    os.environ.get('LIKE_BUFFER_INTERVAL_MS', 5))
+app.config['LIKE_BUFFER_MAX_EVENTS'] = int(
+    os.environ.get('LIKE_BUFFER_MAX_EVENTS', 500))
+app.config['LIKE_BUFFER_FSYNC'] = os.environ.get('LIKE_BUFFER_FSYNC') == '1'
+if os.environ.get('LIKE_BUFFER_JOURNAL_DIR'):
+    app.config['LIKE_BUFFER_JOURNAL_DIR'] = os.environ['LIKE_BUFFER_JOURNAL_DIR']
+app.config['FOLLOW_GRAPH_ENABLED'] = (
+    os.environ.get('FOLLOW_GRAPH_ENABLED') == '1')
+app.config['FOLLOW_GRAPH_REBUILD_SECONDS'] = int(
+    os.environ.get('FOLLOW_GRAPH_REBUILD_SECONDS', 15 * 60))
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+app.config['COMPRESS_MIMETYPES'] = DEFAULT_MIMETYPES
+
 connect_db(app)
+instrumentation.init_app(app)
+assets.init_app(app)
+event_hub.init_app(app)
+like_buffer.init_app(app)
+follow_graph.init_app(app)
+app.register_blueprint(api)
+app.register_blueprint(events)
+
+app.wsgi_app = CompressionMiddleware(
+    app.wsgi_app,
+    min_size=app.config['COMPRESS_MIN_SIZE'],
+    level=app.config['COMPRESS_LEVEL'],
+    mimetypes=app.config['COMPRESS_MIMETYPES'])
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
-def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+def wants_json():
+    """Did the client (a fetch() call) ask for JSON rather than a page?"""
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
-    else:
-        g.user = None
+    accept = request.accept_mimetypes
+    return accept['application/json'] > accept['text/html']
+
+
+def viewer_following_ids(users):
+    """Ids of `users` the logged-in user follows (empty if logged out)."""
+
+    if not g.identity:
+        return set()
+
+    return followed_ids_among(g.identity.id, (user.id for user in users))
+
+
+def followed_ids_among(follower_id, user_ids):
+    """Which of `user_ids` does `follower_id` follow?"""
+
+    if follow_graph.ready:
+        return follow_graph.followed_ids_among(follower_id, user_ids)
+
+    return Follows.followed_ids_among(follower_id, user_ids)
+
+
+def viewer_suggestions():
+    """Who-to-follow suggestions for the logged-in user (see
+    recommendations.py)."""
+
+    if not g.identity:
+        return []
+
+    return Recommendation.for_user(g.identity.id, SIDEBAR_SUGGESTIONS).all()
+
+
+def followed_users(user, cursor=None):
+    """One page of the users `user` follows, and the next page's cursor."""
+
+    if follow_graph.ready:
+        return users_page(partial(follow_graph.following_page, user.id),
+                          cursor)
+
+    return follow_page(user,
+                       Follows.user_following_id,
+                       Follows.user_being_followed_id,
+                       cursor)
+
+
+def follower_users(user, cursor=None):
+    """One page of the users following `user`, and the next page's cursor."""
+
+    if follow_graph.ready:
+        return users_page(partial(follow_graph.follower_page, user.id),
+                          cursor)
+
+    return follow_page(user,
+                       Follows.user_being_followed_id,
+                       Follows.user_following_id,
+                       cursor)
+
+
+def follow_page(user, own_column, other_column, cursor):
+    """One page (highest id first) of the users across `user`'s follows."""
+
+    return paginate((User.query
+                     .join(Follows, other_column == User.id)
+                     .filter(own_column == user.id)),
+                    User.id,
+                    User.id,
+                    cursor=cursor,
+                    key=lambda other: (other.id, other.id),
+                    kind=int)
+
+
+def users_page(fetch_ids, cursor):
+    """One page of ids from `fetch_ids`, loading only that page's users."""
+
+    page_ids, next_cursor = paginate_ids(fetch_ids, cursor)
+    users = {other.id: other
+             for other in User.query.filter(User.id.in_(page_ids))}
+
+    return ([users[user_id] for user_id in page_ids if user_id in users],
+            next_cursor)
+
+
+def viewer_liked_ids(messages):
+    """Ids of `messages` the logged-in user likes (empty if logged out)."""
+
+    if not g.identity:
+        return set()
+
+    return liked_ids_among([msg.id for msg in messages])
+
+
+def liked_ids_among(message_ids):
+    """Which of `message_ids` the logged-in user likes."""
+
+    liked_ids = Like.liked_ids_among(g.identity.id, message_ids)
+
+    if like_buffer.enabled:
+        # Likes still waiting in the write-behind buffer.
+        liked_ids = like_buffer.overlay(g.identity.id, message_ids, liked_ids)
+        liked_ids = session_overlay(session, message_ids, liked_ids)
+
+    return liked_ids
+
+
+def message_card_key(message, author):
+    """Fragment cache key for a message card by `author`.
+
+    The timestamp guards against message ids being reused after a reseed
+    while a shared cache backend still holds the old cards.
+    """
+
+    return (f"message-card:{message.id}:{message.timestamp.isoformat()}"
+            f":{author.profile_version}")
+
+
+@app.template_global()
+def message_card(message, author):
+    """Rendered (and cached) markup for a message card by `author`.
+
+    Only the viewer-independent part of the card is cached; templates
+    render the like button around it.
+    """
+
+    key = message_card_key(message, author)
+    html = fragment_cache.get(key)
+
+    if html is None:
+        html = (app.jinja_env
+                .get_template('messages/_card.html')
+                .render(message=message, author=author))
+        fragment_cache.set(key, html)
+
+    return Markup(html)
 
-@app.before_request
-def add_CSRFProtectForm():
-    """adding CSRFProtectForm to g.user"""
-    
-    g.csrf = CSRFProtectForm()
 
 def do_login(user):
     """Log in user."""
@@ -83,6 +342,9 @@ def signup():
         except IntegrityError:
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
+        except HashingOverloaded:
+            flash("Too many signups right now, please try again.", 'danger')
+            return render_template('users/signup.html', form=form), 503
 
         do_login(user)
 
@@ -99,10 +361,16 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        try:
+            user = User.authenticate(form.username.data,
+                                     form.password.data)
+        except HashingOverloaded:
+            flash("Too many logins right now, please try again.", 'danger')
+            return render_template('users/login.html', form=form), 503
 
         if user:
+            # authenticate may have upgraded the stored password hash
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -130,85 +398,177 @@ def logout():
 # General user routes:
 
 @app.get('/users')
+@query_budget(4)
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search usernames and bios, and
+    an 'after' cursor param for the next page of results.
     """
 
     search = request.args.get('q')
+    users, next_cursor = search_users(search, request.args.get('after'))
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
-
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html',
+                           users=users,
+                           search=search,
+                           next_cursor=next_cursor,
+                           following_ids=viewer_following_ids(users))
 
 
 @app.get('/users/<int:user_id>')
+@query_budget(6)
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
 
-    user = User.query.get_or_404(user_id)
+    Messages are paged newest-first; a 'before' param in the querystring
+    is the cursor for the next (older) page.
+    """
 
-    return render_template('users/show.html', user=user)
+    user = User.query.get_or_404(user_id)
+    messages, next_cursor = paginate(
+        Message.query.filter(Message.user_id == user.id),
+        Message.timestamp,
+        Message.id,
+        cursor=request.args.get('before'))
+
+    following_ids = viewer_following_ids([user])
+    liked_ids = viewer_liked_ids(messages)
+    suggestions = viewer_suggestions()
+    etag = page_etag('users_show',
+                     user.id,
+                     user.state_version,
+                     [msg.id for msg in messages],
+                     next_cursor,
+                     following_ids,
+                     liked_ids,
+                     [(suggestion.candidate_id, suggestion.score,
+                       suggestion.candidate.profile_version)
+                      for suggestion in suggestions])
+
+    return render_conditional(etag,
+                              'users/show.html',
+                              stream=True,
+                              user=user,
+                              messages=messages,
+                              next_cursor=next_cursor,
+                              following_ids=following_ids,
+                              liked_ids=liked_ids,
+                              suggestions=suggestions)
 
 
 @app.get('/users/<int:user_id>/following')
+@query_budget(5)
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show list of people this user is following.
 
-    if not g.user:
+    Users are paged highest id first; a 'before' param in the querystring
+    is the cursor for the next page.
+    """
+
+    if not g.identity:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    users, next_cursor = followed_users(user, request.args.get('before'))
+    following_ids = viewer_following_ids([user, *users])
+    etag = page_etag('following',
+                     user.id,
+                     user.state_version,
+                     [(other.id, other.state_version) for other in users],
+                     next_cursor,
+                     following_ids)
+
+    return render_conditional(etag,
+                              'users/following.html',
+                              user=user,
+                              users=users,
+                              next_cursor=next_cursor,
+                              following_ids=following_ids)
 
 
 @app.get('/users/<int:user_id>/followers')
+@query_budget(5)
 def users_followers(user_id):
-    """Show list of followers of this user."""
+    """Show list of followers of this user.
 
-    if not g.user:
+    Paged like show_following.
+    """
+
+    if not g.identity:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    users, next_cursor = follower_users(user, request.args.get('before'))
+    following_ids = viewer_following_ids([user, *users])
+    etag = page_etag('followers',
+                     user.id,
+                     user.state_version,
+                     [(other.id, other.state_version) for other in users],
+                     next_cursor,
+                     following_ids)
+
+    return render_conditional(etag,
+                              'users/followers.html',
+                              user=user,
+                              users=users,
+                              next_cursor=next_cursor,
+                              following_ids=following_ids)
 
 
 @app.post('/users/follow/<int:follow_id>')
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
-    if not g.user:
+    if not g.identity:
         flash("Access unauthorized.", "danger")
         return redirect("/")
-    if g.user.id == follow_id:
+    if g.identity.id == follow_id:
         flash("You can not follow yourself!!!")
-        return redirect(f"/users/{g.user.id}/following")
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+        return redirect(f"/users/{g.identity.id}/following")
+
+    if not db.session.query(User.id).filter_by(id=follow_id).scalar():
+        abort(404)
+
+    # Counters and timelines only move when the follow is new.
+    if Follows.add(g.identity.id, follow_id):
+        TimelineEntry.backfill(g.identity.id, follow_id)
+        User.adjust_counts(g.identity.id, following_count=1)
+        User.adjust_counts(follow_id, follower_count=1)
+        publish_follow(g.identity.id, follow_id, True)
+        if follow_graph.enabled:
+            follow_graph.record(g.identity.id, follow_id, True)
+        db.session.commit()
+
+    if wants_json():
+        return jsonify(user_id=follow_id, following=True)
 
-    return redirect(f"/users/{g.user.id}/following")
+    return redirect(f"/users/{g.identity.id}/following")
 
 
 @app.post('/users/stop-following/<int:follow_id>')
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
-    if not g.user:
+    if not g.identity:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    if Follows.remove(g.identity.id, follow_id):
+        TimelineEntry.purge(g.identity.id, follow_id)
+        User.adjust_counts(g.identity.id, following_count=-1)
+        User.adjust_counts(follow_id, follower_count=-1)
+        publish_follow(g.identity.id, follow_id, False)
+        if follow_graph.enabled:
+            follow_graph.record(g.identity.id, follow_id, False)
+        db.session.commit()
+
+    if wants_json():
+        return jsonify(user_id=follow_id, following=False)
 
-    return redirect(f"/users/{g.user.id}/following")
+    return redirect(f"/users/{g.identity.id}/following")
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
@@ -224,7 +584,13 @@ def edit_profile():
     form = EditUserForm(obj=user)
 
     if form.validate_on_submit():
-        if User.authenticate(user.username, form.password.data):
+        if user.check_password(form.password.data):
+            if (user.username != form.username.data
+                    or user.image_url != form.image_url.data):
+                # retire every cached card showing the old name/avatar
+                user.profile_version += 1
+
+            user.state_version += 1
             user.username = form.username.data
             user.email = form.email.data
             user.image_url = form.image_url.data
@@ -232,6 +598,7 @@ def edit_profile():
             user.bio = form.bio.data
 
             db.session.commit()
+            identity_cache.delete(user.id)
             flash(f"{user.username} updated")
 
             return redirect(f"/users/{user.id}")
@@ -249,8 +616,20 @@ def delete_user():
 
     do_logout()
 
+    user_id = g.user.id
+    dependent_ids = g.user.counter_dependent_ids()
+    # Other users' messages this user liked lose a like, as on an unlike.
+    liked_ids = [message_id for (message_id,) in
+                 db.session.query(Like.message_id)
+                 .join(Message, Message.id == Like.message_id)
+                 .filter(Like.user_id == user_id, Message.user_id != user_id)]
     db.session.delete(g.user)
+    db.session.flush()
+    User.recount(dependent_ids)
+    Message.recount_likes(liked_ids)
+    LikeBucket.add({message_id: -1 for message_id in liked_ids})
     db.session.commit()
+    identity_cache.delete(user_id)
 
     return redirect("/signup")
 
@@ -259,119 +638,227 @@ def delete_user():
 # Messages routes:
 
 @app.route('/messages/new', methods=["GET", "POST"])
+@query_budget(8)
 def messages_add():
     """Add a message:
 
     Show form if GET. If valid, update message and redirect to user page.
     """
 
-    if not g.user:
+    if not g.identity:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.identity.id)
+        db.session.add(msg)
+        db.session.flush()
+        TimelineEntry.fan_out(msg)
+        User.adjust_counts(g.identity.id, message_count=1)
+        publish_message(msg, message_card(msg, msg.user))
         db.session.commit()
 
-        return redirect(f"/users/{g.user.id}")
+        return redirect(f"/users/{g.identity.id}")
 
     return render_template('messages/new.html', form=form)
 
 
 @app.get('/messages/<int:message_id>')
+@query_budget(5)
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = Message.with_author().get_or_404(message_id)
+    following_ids = viewer_following_ids([msg.user])
+    liked_ids = viewer_liked_ids([msg])
+    etag = page_etag('messages_show',
+                     msg.id,
+                     msg.like_count,
+                     msg.user.profile_version,
+                     following_ids,
+                     liked_ids)
+
+    return render_conditional(etag,
+                              'messages/show.html',
+                              message=msg,
+                              following_ids=following_ids,
+                              liked_ids=liked_ids)
 
 
 @app.post('/messages/<int:message_id>/delete')
 def messages_destroy(message_id):
     """Delete a message."""
     msg = Message.query.get(message_id)
-    if not g.user or g.user.id != msg.user_id:
+    if not g.identity or g.identity.id != msg.user_id:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
+    msg = Message.with_author().get(message_id)
+    liker_ids = [like.user_id for like
+                 in Like.query.filter_by(message_id=msg.id)]
+    fragment_cache.delete(message_card_key(msg, msg.user))
     db.session.delete(msg)
+    db.session.flush()
+    User.adjust_counts(g.identity.id, message_count=-1)
+    User.recount(liker_ids)
     db.session.commit()
 
-    return redirect(f"/users/{g.user.id}")
+    return redirect(f"/users/{g.identity.id}")
 
 ##############################################################################
-# Direct Message Route
+# Direct messages
+#
+# Messages live in one-to-one conversations (see Conversation in models.py).
+# The inbox and each thread are keyset-paged, newest first.
+
+
+def can_message(user_id):
+    """May the logged-in user message `user_id`?
+
+    Anyone they follow, or anyone they already have a conversation with.
+    """
+
+    return (bool(followed_ids_among(g.identity.id, [user_id]))
+            or Conversation.find(g.identity.id, user_id) is not None)
+
 
 @app.route("/direct_message/new", methods=["GET", "POST"])
+@query_budget(10)
 def send_direct_message():
-    """Send direct message to user"""
-     
-    if not g.user:
+    """Start a conversation with one of the users you follow."""
+
+    if not g.identity:
         flash("Access unauthorized.", "danger")
         return redirect("/")
-    
-    
-    user_id = g.user.id
-    user = User.query.get(user_id)
 
     form = DirectMessageForm()
-    following_list = g.user.following
-    friends = [(user.id, user.username) for user in following_list]
-    form.select_user.choices = friends
-    
-    
+    # Every followed user, not a page of them; only ids and names.
+    form.select_user.choices = [
+        (user_id, username)
+        for user_id, username in (
+            db.session.query(User.id, User.username)
+            .join(Follows, Follows.user_being_followed_id == User.id)
+            .filter(Follows.user_following_id == g.identity.id)
+            .order_by(User.username))]
+
     if form.validate_on_submit():
-        select_user = form.select_user.data
-        text = form.text.data
-        friend = User.query.get(select_user)
-        message = DirectMessage(
-                                text=text, 
-                                user_id=user_id, 
-                                recipient_id=friend.username) 
-        
-        friend.direct_messages.append(message)
-        user.direct_messages.append(message) 
-        db.session.add(message)
+        recipient_id = form.select_user.data
+        DirectMessage.send(g.identity.id, recipient_id, form.text.data)
         db.session.commit()
-        
-        return render_template("/messages/direct_messages.html",user=user, form=form)
-    
-    return render_template("/messages/direct_messages.html",user=user,form=form)        
-    
-    
-    
-    
-    
+
+        return redirect(f"/direct_messages/{recipient_id}")
+
+    return render_template("/messages/direct_messages.html", form=form)
+
+
+@app.get("/direct_messages")
+@query_budget(5)
+def direct_messages_inbox():
+    """Show the logged-in user's conversations, most recent first."""
+
+    if not g.identity:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    conversations, next_cursor = paginate(
+        ConversationParticipant.inbox(g.identity.id),
+        ConversationParticipant.last_message_at,
+        ConversationParticipant.conversation_id,
+        cursor=request.args.get('before'),
+        key=lambda row: (row.last_message_at, row.conversation_id))
+
+    return render_template("/messages/inbox.html",
+                           conversations=conversations,
+                           next_cursor=next_cursor,
+                           total_unread=ConversationParticipant.total_unread(
+                               g.identity.id))
+
+
+@app.route("/direct_messages/<int:user_id>", methods=["GET", "POST"])
+@query_budget(8)
+def direct_messages_thread(user_id):
+    """Show (and reply in) the conversation with user `user_id`."""
+
+    if not g.identity:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    other = User.query.get_or_404(user_id)
+    form = MessageForm()
+
+    if form.validate_on_submit():
+        if not can_message(user_id):
+            flash("You can only message users you follow.", "danger")
+            return redirect("/direct_message/new")
+
+        DirectMessage.send(g.identity.id, user_id, form.text.data)
+        db.session.commit()
+
+        return redirect(f"/direct_messages/{user_id}")
+
+    conversation = Conversation.find(g.identity.id, user_id)
+    messages, next_cursor = [], None
+
+    if conversation is not None:
+        messages, next_cursor = paginate(
+            (DirectMessage.with_author()
+             .filter(DirectMessage.conversation_id == conversation.id)),
+            DirectMessage.timestamp,
+            DirectMessage.id,
+            cursor=request.args.get('before'))
+
+        ConversationParticipant.mark_read(conversation.id, g.identity.id)
+        db.session.commit()
+
+    return render_template("/messages/thread.html",
+                           other=other,
+                           form=form,
+                           messages=messages,
+                           next_cursor=next_cursor)
+
+
 ##############################################################################
 # Homepage and error pages
 
 
 @app.get('/')
+@query_budget(5)
 def display_homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, with a
+      'before' cursor param to page back through older ones
     """
     if not g.user:
         flash('Unauthorized')
         return redirect('/login')
 
     if g.user:
-        following_ids = [ follow.id for follow in g.user.following]
-        following_ids.append(g.user.id)
-        messages = (Message.query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-            
-
-        return render_template('home.html', messages=messages)
+        messages, next_cursor = paginate(
+            (Message.with_author()
+             .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+             .filter(TimelineEntry.user_id == g.user.id)),
+            TimelineEntry.timestamp,
+            TimelineEntry.message_id,
+            cursor=request.args.get('before'))
+
+        liked_ids = viewer_liked_ids(messages)
+        etag = page_etag('home',
+                         g.user.state_version,
+                         [(msg.id, msg.user.profile_version)
+                          for msg in messages],
+                         next_cursor,
+                         liked_ids)
+
+        return render_conditional(etag,
+                                  'home.html',
+                                  stream=True,
+                                  messages=messages,
+                                  next_cursor=next_cursor,
+                                  liked_ids=liked_ids)
 
     else:
         return render_template('home-anon.html')
@@ -380,50 +867,170 @@ def display_homepage():
 #likes route
 
 @app.post('/messages/<int:message_id>/like')
+@query_budget(8)
 def toggle_like(message_id):
     """toggle likes for current user"""
 
-    if not g.user:
+    if not g.identity:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    form = g.csrf
-    user = g.user
-    message = Message.query.get_or_404(message_id)
-    
-    if form.validate_on_submit():
-        if user.id != message.id:
-            if message in g.user.likes:
-                g.user.likes.remove(message)
-            else:
-                g.user.likes.append(message)
-        db.session.commit()
-        return redirect('/')
+    author_id = (db.session.query(Message.user_id)
+                 .filter_by(id=message_id)
+                 .scalar())
+    if author_id is None:
+        abort(404)
+
+    liked = None
+    if g.csrf.validate_on_submit() and author_id != g.identity.id:
+        if like_buffer.enabled:
+            # Written by the buffer's next flush.
+            liked = message_id not in liked_ids_among([message_id])
+            like_buffer.record(g.identity.id, message_id, liked)
+            remember_pending_like(session, message_id, liked)
+
+        # Unlike if there was a like to remove, otherwise like.
+        elif Like.remove(g.identity.id, message_id):
+            User.adjust_counts(g.identity.id, likes_count=-1)
+            Message.adjust_like_counts({message_id: -1})
+            liked = False
+            db.session.commit()
+        else:
+            if Like.add(g.identity.id, message_id):
+                User.adjust_counts(g.identity.id, likes_count=1)
+                Message.adjust_like_counts({message_id: 1})
+            liked = True
+            db.session.commit()
+
+    if wants_json():
+        if liked is None:
+            return jsonify(error="cannot like this message"), 400
+        return jsonify(message_id=message_id, liked=liked)
+
+    return redirect('/')
 
 
 @app.get("/users/<int:user_id>/likes")
+@query_budget(5)
 def user_likes(user_id):
     """show user likes page"""
 
-    if not g.user:
+    if not g.identity:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get(user_id)
+    user = User.query.get_or_404(user_id)
+    messages, next_cursor = paginate(
+        (Message.with_author()
+         .join(Like, Like.message_id == Message.id)
+         .filter(Like.user_id == user.id)),
+        Message.timestamp,
+        Message.id,
+        cursor=request.args.get('before'))
+
+    return render_template('users/likes.html',
+                           user=user,
+                           messages=messages,
+                           next_cursor=next_cursor,
+                           following_ids=viewer_following_ids([user]),
+                           liked_ids=viewer_liked_ids(messages))
+
+@app.get('/top')
+@query_budget(4)
+def top_messages():
+    """Most liked warbles of the last 24 hours or 7 days.
+
+    Served from the precomputed leaderboard (see TopMessage).
+    """
+
+    if not g.identity:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    window = request.args.get('window', '24h')
+    if window not in LEADERBOARD_WINDOWS:
+        abort(404)
+
+    entries = TopMessage.leaderboard(window).all()
+    messages = [entry.message for entry in entries]
 
-    return render_template('users/likes.html', user=user)
+    return render_template('messages/top.html',
+                           window=window,
+                           windows=LEADERBOARD_WINDOWS,
+                           entries=entries,
+                           liked_ids=viewer_liked_ids(messages))
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Maintenance commands
+
+
+@app.cli.command('recount-users')
+def recount_users():
+    """Repair denormalized User counters from the source tables.
+
+    Databases that predate the counter columns need migrate_counters.py
+    first.
+    """
+
+    User.recount()
+    db.session.commit()
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Materialize every home timeline from the messages/follows tables.
+
+    Run once on databases that predate timeline_entries (create the table
+    with db.create_all() first), or to repair timelines.
+    """
+
+    TimelineEntry.rebuild()
+    db.session.commit()
+
+
+@app.cli.command('recount-likes')
+def recount_likes():
+    """Repair Message.like_count from the likes table.
+
+    Databases that predate like_count need migrate_counters.py first.
+    """
+
+    Message.recount_likes()
+    db.session.commit()
+
+
+@app.cli.command('refresh-leaderboard')
+def refresh_leaderboard():
+    """Rebuild the top warbles leaderboards (run every few minutes)."""
+
+    TopMessage.refresh()
+    db.session.commit()
+
+
+@app.cli.command('create-search-indexes')
+def create_search_indexes_command():
+    """Add the Postgres user search indexes to an existing database."""
+
+    create_search_indexes()
+    db.session.commit()
+
+
+##############################################################################
+# HTTP caching policy
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Pages that set an ETag (see http_caching.py) are revalidated on every
+# use and answered with a 304 when unchanged. Static files keep Flask's
+# own conditional responses, and fingerprinted /assets/ are immutable (see
+# assets.py). Everything else -- forms with CSRF tokens, redirects -- is
+# not stored.
+
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Default to no-store for responses without their own caching policy."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if (request.endpoint not in ('static', 'serve_asset')
+            and not response.get_etag()[0]):
+        response.cache_control.no_store = True
     return response
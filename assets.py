@@ -0,0 +1,185 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask build-assets` copies everything under static/ into static/dist/
+with a content hash in the filename, writes .gz (and, if the optional
+`brotli` package is installed, .br) variants of text assets, and records
+the mapping in static/dist/manifest.json.
+
+Templates link assets with `asset_url('stylesheets/style.css')` (or the
+`static_asset` filter for stored '/static/...' URLs). Once a manifest
+exists those resolve to /assets/<hashed name>, which is served with a
+one-year immutable Cache-Control and the best precompressed variant the
+client accepts. Without a manifest they fall back to plain /static/ URLs.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+import click
+from flask import request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST_DIRNAME = 'dist'
+MANIFEST_FILENAME = 'manifest.json'
+
+# Images are already compressed; only text-like assets get .gz/.br copies.
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.ico', '.json', '.txt'}
+
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+
+# url("/static/...") references inside stylesheets
+CSS_STATIC_URL = re.compile(r"""url\((['"]?)/static/([^'")]+)\1\)""")
+
+# (Accept-Encoding token, file suffix), in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+_manifest = {}
+
+
+def _write_asset(dist_folder, logical, data):
+    """Write one fingerprinted asset (and its compressed variants)."""
+
+    stem, ext = os.path.splitext(logical)
+    hashed = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+    target = os.path.join(dist_folder, hashed)
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, 'wb') as f:
+        f.write(data)
+
+    if ext.lower() in COMPRESSIBLE_EXTENSIONS:
+        with open(target + '.gz', 'wb') as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(target + '.br', 'wb') as f:
+                f.write(brotli.compress(data, quality=11))
+
+    return hashed
+
+
+def build_assets(static_folder):
+    """Build static/dist/ and its manifest; return the manifest dict.
+
+    Stylesheets are built last, with their url("/static/...") references
+    rewritten to the fingerprinted files.
+    """
+
+    dist_folder = os.path.join(static_folder, DIST_DIRNAME)
+    sources = []
+
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        if os.path.abspath(dirpath) == os.path.abspath(dist_folder):
+            dirnames[:] = []
+            continue
+
+        for filename in filenames:
+            source = os.path.join(dirpath, filename)
+            sources.append(
+                os.path.relpath(source, static_folder).replace(os.sep, '/'))
+
+    sources.sort(key=lambda logical: (logical.endswith('.css'), logical))
+    manifest = {}
+
+    for logical in sources:
+        with open(os.path.join(static_folder, logical), 'rb') as f:
+            data = f.read()
+
+        if logical.endswith('.css'):
+            def fingerprinted(match):
+                hashed = manifest.get(match.group(2))
+                if hashed is None:
+                    return match.group(0)
+                return f"url({match.group(1)}/assets/{hashed}{match.group(1)})"
+
+            data = CSS_STATIC_URL.sub(fingerprinted,
+                                      data.decode('UTF-8')).encode('UTF-8')
+
+        manifest[logical] = _write_asset(dist_folder, logical, data)
+
+    with open(os.path.join(dist_folder, MANIFEST_FILENAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def load_manifest(static_folder):
+    """Load static/dist/manifest.json (if built) into memory."""
+
+    path = os.path.join(static_folder, DIST_DIRNAME, MANIFEST_FILENAME)
+
+    _manifest.clear()
+    if os.path.exists(path):
+        with open(path) as f:
+            _manifest.update(json.load(f))
+
+
+def asset_url(filename):
+    """URL for static file `filename` (a path relative to static/)."""
+
+    hashed = _manifest.get(filename)
+    if hashed is None:
+        return url_for('static', filename=filename)
+
+    return url_for('serve_asset', filename=hashed)
+
+
+def static_asset(url):
+    """Template filter: fingerprint a stored '/static/...' URL.
+
+    Other URLs (e.g. external avatars) pass through unchanged.
+    """
+
+    if url and url.startswith('/static/'):
+        return asset_url(url[len('/static/'):])
+
+    return url
+
+
+def init_app(app):
+    """Register the asset route, template helpers and build command."""
+
+    dist_folder = os.path.join(app.static_folder, DIST_DIRNAME)
+    load_manifest(app.static_folder)
+
+    app.add_template_global(asset_url)
+    app.add_template_filter(static_asset)
+
+    @app.get('/assets/<path:filename>')
+    def serve_asset(filename):
+        """Serve a fingerprinted asset, precompressed if the client allows."""
+
+        mimetype = mimetypes.guess_type(filename)[0]
+
+        for encoding, suffix in ENCODINGS:
+            if (request.accept_encodings[encoding]
+                    and os.path.exists(os.path.join(dist_folder,
+                                                    filename + suffix))):
+                response = send_from_directory(dist_folder,
+                                               filename + suffix,
+                                               mimetype=mimetype,
+                                               max_age=ASSET_MAX_AGE)
+                response.content_encoding = encoding
+                break
+        else:
+            response = send_from_directory(dist_folder,
+                                           filename,
+                                           max_age=ASSET_MAX_AGE)
+
+        response.vary.add('Accept-Encoding')
+        response.cache_control.immutable = True
+        return response
+
+    @app.cli.command('build-assets')
+    def build_assets_command():
+        """Fingerprint and precompress static/ into static/dist/."""
+
+        manifest = build_assets(app.static_folder)
+        click.echo(f"Built {len(manifest)} assets into {dist_folder}")
@@ -0,0 +1,102 @@
+"""Benchmark for response compression.
+
+Seeds a throwaway SQLite database, then requests a few HTML routes with
+and without `Accept-Encoding: gzip` and reports, per route, the bytes
+saved and the extra CPU time compression costs.
+
+Run it like:
+
+    python benchmarks/bench_compression.py [--messages 500] [--repeat 20]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = f"sqlite:///{DB_PATH}"
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+os.environ.setdefault('BCRYPT_LOG_ROUNDS', '4')
+
+from app import app, CURR_USER_KEY  # noqa: E402
+from models import db, User, Message, Follows, TimelineEntry  # noqa: E402
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_ENABLED'] = False
+
+
+def seed(num_users, num_messages):
+    """Create users who all follow user 1, and messages spread among them."""
+
+    db.create_all()
+
+    users = [User.signup(f"user{i}", f"user{i}@example.com", "password", None)
+             for i in range(num_users)]
+    db.session.commit()
+
+    for user in users[1:]:
+        db.session.add(Follows(user_being_followed_id=user.id,
+                               user_following_id=users[0].id))
+
+    for i in range(num_messages):
+        db.session.add(Message(text=f"Benchmark warble number {i}. " * 4,
+                               user_id=users[i % num_users].id))
+
+    db.session.commit()
+    TimelineEntry.rebuild()
+    User.recount()
+    db.session.commit()
+
+    return users[0].id
+
+
+def measure(client, url, encoding, repeat):
+    """Return (body bytes, CPU seconds per request) for `url`."""
+
+    headers = {'Accept-Encoding': encoding} if encoding else {}
+    client.get(url, headers=headers)  # warm the fragment cache
+
+    start = time.process_time()
+    for _ in range(repeat):
+        body = client.get(url, headers=headers).data
+    cpu = (time.process_time() - start) / repeat
+
+    return len(body), cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    viewer_id = seed(args.users, args.messages)
+    routes = ['/', f'/users/{viewer_id}', '/users',
+              f'/users/{viewer_id}/following']
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = viewer_id
+
+    print(f"{'route':<24} {'raw B':>8} {'gzip B':>8} {'saved':>7} "
+          f"{'raw ms':>8} {'gzip ms':>8} {'+cpu ms':>8}")
+
+    for url in routes:
+        raw_bytes, raw_cpu = measure(client, url, None, args.repeat)
+        gz_bytes, gz_cpu = measure(client, url, 'gzip', args.repeat)
+        saved = 1 - gz_bytes / raw_bytes if raw_bytes else 0
+
+        print(f"{url:<24} {raw_bytes:>8} {gz_bytes:>8} {saved:>7.1%} "
+              f"{raw_cpu * 1000:>8.2f} {gz_cpu * 1000:>8.2f} "
+              f"{(gz_cpu - raw_cpu) * 1000:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Microbenchmark for the password hashing service.
+
+Reports bcrypt hashes/sec at a few costs, on one thread and on the
+hashing pool sized to the machine, plus the per-core rate.
+
+Run it like:
+
+    python benchmarks/bench_hashing.py [--rounds 10 11 12] [--seconds 3]
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hashing import PasswordHasher  # noqa: E402
+
+
+def hashes_per_sec(hasher, seconds, threads):
+    """Hash continuously from `threads` callers for `seconds`; return rate."""
+
+    deadline = time.perf_counter() + seconds
+
+    def caller():
+        count = 0
+        while time.perf_counter() < deadline:
+            hasher.hash("benchmark-password")
+            count += 1
+        return count
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as callers:
+        total = sum(callers.map(lambda _: caller(), range(threads)))
+
+    return total / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, nargs='+', default=[10, 11, 12])
+    parser.add_argument('--seconds', type=float, default=3.0)
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    print(f"{'cost':>4} {'1 thread/s':>11} {f'{cores} threads/s':>13} "
+          f"{'per core/s':>11} {'avg ms':>8}")
+
+    for rounds in args.rounds:
+        single = hashes_per_sec(PasswordHasher(rounds, workers=1),
+                                args.seconds, threads=1)
+
+        pooled_hasher = PasswordHasher(rounds, workers=cores)
+        pooled = hashes_per_sec(pooled_hasher, args.seconds, threads=cores)
+        avg_ms = pooled_hasher.metrics()['avg_ms']
+
+        print(f"{rounds:>4} {single:>11.1f} {pooled:>13.1f} "
+              f"{pooled / cores:>11.1f} {avg_ms:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
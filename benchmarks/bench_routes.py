@@ -0,0 +1,281 @@
+"""Route-level benchmark suite.
+
+Seeds a database at one or more dataset sizes (generator/synthetic.py +
+seed.py), then drives the main routes through the Flask test client and
+records, per route:
+
+- latency (median and 95th percentile over --repeat requests)
+- SQL statements issued by one request
+- peak Python memory allocated while serving one request (tracemalloc)
+
+Run it like:
+
+    python benchmarks/bench_routes.py --sizes small medium \\
+        [--output results.json] [--baseline baseline.json]
+
+Each size runs in its own process against a SQLite file (seeded once and
+cached under --workdir) or, with --database-url, a local Postgres
+database, which is dropped and reseeded for every run.
+
+With --baseline, results are compared against an earlier --output file:
+routes whose query count grew, or whose latency or memory grew by more
+than --tolerance, are reported and the exit status is 1.
+
+Requires numpy (for the data generator).
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (users, messages, follows, likes, direct messages)
+SIZES = {
+    'small': (100, 1_000, 2_000, 2_000, 200),
+    'medium': (2_000, 100_000, 60_000, 60_000, 5_000),
+    'large': (20_000, 1_000_000, 400_000, 500_000, 20_000),
+}
+
+METRICS = ['p50_ms', 'p95_ms', 'queries', 'peak_kib']
+
+# Latency changes smaller than this are treated as noise.
+MIN_LATENCY_DELTA_MS = 2.0
+
+
+##############################################################################
+# One size (child process)
+
+
+def prepare_database(size, workdir, database_url):
+    """Point DATABASE_URL at a seeded database for `size`."""
+
+    sys.path.insert(0, os.path.join(ROOT, 'generator'))
+    import synthetic
+
+    csv_dir = os.path.join(workdir, f"{size}-csv")
+    if not os.path.exists(os.path.join(csv_dir, 'direct_messages.csv')):
+        users, messages, follows, likes, direct_messages = SIZES[size]
+        synthetic.generate(csv_dir, users, messages, follows, likes,
+                           direct_messages, seed=0, end='2024-01-01')
+
+    if database_url:
+        os.environ['DATABASE_URL'] = database_url
+        return csv_dir
+
+    # Seed a pristine copy once; every run works on a fresh copy of it.
+    pristine = os.path.join(workdir, f"{size}.db")
+    working = os.path.join(workdir, f"{size}-run.db")
+
+    if not os.path.exists(pristine):
+        os.environ['DATABASE_URL'] = f"sqlite:///{pristine}.tmp"
+        subprocess.run([sys.executable, 'seed.py', '--data-dir', csv_dir],
+                       cwd=ROOT, env=os.environ, check=True)
+        os.replace(f"{pristine}.tmp", pristine)
+
+    shutil.copy(pristine, working)
+    os.environ['DATABASE_URL'] = f"sqlite:///{working}"
+    return None
+
+
+def run_size(size, workdir, database_url, repeat):
+    """Benchmark every route for one dataset size; return {route: metrics}."""
+
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('BCRYPT_LOG_ROUNDS', '4')
+    csv_dir = prepare_database(size, workdir, database_url)
+
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    from app import app, CURR_USER_KEY
+    from models import db, User, Message
+
+    if csv_dir:
+        import seed
+        seed.seed(csv_dir)
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['DEBUG_TB_ENABLED'] = False
+
+    statements = []
+    event.listen(Engine, 'before_cursor_execute',
+                 lambda *args: statements.append(args[2]))
+
+    with app.app_context():
+        # The heaviest pages: the user who follows the most people views
+        # the profile of the user with the most followers.
+        viewer = User.query.order_by(User.following_count.desc()).first()
+        celebrity = User.query.order_by(User.follower_count.desc()).first()
+        message = (Message.query
+                   .filter(Message.user_id != viewer.id)
+                   .order_by(Message.id)
+                   .first())
+        viewer_id, celebrity_id, message_id = (viewer.id, celebrity.id,
+                                               message.id)
+        db.session.remove()
+
+    # (name, method, url, form data); names compare across datasets
+    routes = [
+        ('GET /', 'GET', '/', None),
+        ('GET /users', 'GET', '/users', None),
+        ('GET /users/<celebrity>', 'GET', f'/users/{celebrity_id}', None),
+        ('GET /users/<celebrity>/followers',
+         'GET', f'/users/{celebrity_id}/followers', None),
+        ('GET /users/<viewer>/following',
+         'GET', f'/users/{viewer_id}/following', None),
+        ('GET /users/<viewer>/likes',
+         'GET', f'/users/{viewer_id}/likes', None),
+        ('POST /messages/<id>/like',
+         'POST', f'/messages/{message_id}/like', None),
+        ('POST /messages/new',
+         'POST', '/messages/new', {'text': 'Benchmark warble'}),
+    ]
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = viewer_id
+
+    def request(method, url, data):
+        resp = client.open(url, method=method, data=data)
+        resp.get_data()
+        assert resp.status_code < 400, f"{method} {url}: {resp.status}"
+
+    results = {}
+
+    for name, method, url, data in routes:
+        request(method, url, data)  # warm caches
+
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            request(method, url, data)
+            timings.append((time.perf_counter() - start) * 1000)
+
+        statements.clear()
+        request(method, url, data)
+        queries = len(statements)
+
+        tracemalloc.start()
+        request(method, url, data)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        timings.sort()
+        results[name] = {
+            'p50_ms': round(statistics.median(timings), 2),
+            'p95_ms': round(timings[int(0.95 * (len(timings) - 1))], 2),
+            'queries': queries,
+            'peak_kib': round(peak / 1024, 1),
+        }
+
+    return results
+
+
+##############################################################################
+# Reporting
+
+
+def print_results(size, results):
+    print(f"\n{size}")
+    print(f"  {'route':<36} {'p50 ms':>8} {'p95 ms':>8} {'queries':>8} "
+          f"{'peak KiB':>9}")
+    for route, metrics in results.items():
+        print(f"  {route:<36} {metrics['p50_ms']:>8.2f} "
+              f"{metrics['p95_ms']:>8.2f} {metrics['queries']:>8} "
+              f"{metrics['peak_kib']:>9.1f}")
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of regressions of `results` against `baseline`."""
+
+    regressions = []
+
+    for size, routes in results.items():
+        for route, metrics in routes.items():
+            before = baseline.get(size, {}).get(route)
+            if before is None:
+                continue
+
+            for metric in METRICS:
+                old, new = before[metric], metrics[metric]
+                allowed = old if metric == 'queries' else old * (1 + tolerance)
+
+                if metric.endswith('_ms'):
+                    allowed = max(allowed, old + MIN_LATENCY_DELTA_MS)
+
+                if new > allowed:
+                    regressions.append(f"{size} {route}: {metric} "
+                                       f"{old} -> {new}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', nargs='+', choices=SIZES,
+                        default=['small'])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--workdir',
+                        default=os.path.join(ROOT, 'benchmarks', '.data'))
+    parser.add_argument('--database-url',
+                        help='benchmark against this (dropped!) database '
+                             'instead of SQLite')
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--baseline', help='compare against a JSON result')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed latency/memory growth (default 25%%)')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        results = run_size(args.child, args.workdir, args.database_url,
+                           args.repeat)
+        with open(args.output, 'w') as out:
+            json.dump(results, out)
+        return
+
+    os.makedirs(args.workdir, exist_ok=True)
+    results = {}
+
+    for size in args.sizes:
+        size_output = os.path.join(args.workdir, f"{size}-results.json")
+        command = [sys.executable, os.path.abspath(__file__),
+                   '--child', size, '--repeat', str(args.repeat),
+                   '--workdir', args.workdir, '--output', size_output]
+        if args.database_url:
+            command += ['--database-url', args.database_url]
+
+        subprocess.run(command, check=True)
+        with open(size_output) as size_results:
+            results[size] = json.load(size_results)
+        print_results(size, results[size])
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline),
+                                  args.tolerance)
+
+        print(f"\n{len(regressions)} regression(s) against {args.baseline}")
+        for regression in regressions:
+            print(f"  {regression}")
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""Small in-process caches shared by the app's request helpers."""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class TTLCache:
+    """A per-worker cache whose entries expire `ttl` seconds after being set.
+
+    Holds at most `max_entries` items, evicting the least recently set.
+    Safe to share between threads of one worker.
+    """
+
+    def __init__(self, ttl, max_entries=10_000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return the cached value for `key`, or None if missing/expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+
+            return value
+
+    def set(self, key, value):
+        """Cache `value` under `key` for `ttl` seconds."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Drop `key` from the cache, if present."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class LRUCache:
+    """A per-worker least-recently-used cache for rendered strings.
+
+    Bounded both by entry count and by the total length of the cached
+    values. Safe to share between threads of one worker.
+    """
+
+    def __init__(self, max_entries=10_000, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return the cached value for `key` (marking it recent), or None."""
+
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Cache `value`, evicting least recently used entries if needed."""
+
+        if len(value) > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+
+            self._entries[key] = value
+            self._bytes += len(value)
+
+            while (len(self._entries) > self.max_entries
+                   or self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def delete(self, key):
+        """Drop `key` from the cache, if present."""
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+class RedisBackend:
+    """Shared cache backend on Redis, so workers reuse each other's renders.
+
+    Needs the optional `redis` package.
+    """
+
+    def __init__(self, url, ttl=24 * 60 * 60, prefix='warbler:'):
+        import redis
+
+        self.ttl = ttl
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(self.prefix + key)
+        return value.decode('UTF-8') if value is not None else None
+
+    def set(self, key, value):
+        self._client.set(self.prefix + key, value, ex=self.ttl)
+
+    def delete(self, key):
+        self._client.delete(self.prefix + key)
+
+
+class FragmentCache:
+    """Rendered-fragment cache: a local LRU in front of an optional shared
+    backend (e.g. `RedisBackend`).
+    """
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+
+    def get(self, key):
+        value = self.local.get(key)
+
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
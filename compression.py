@@ -0,0 +1,141 @@
+"""gzip response compression as WSGI middleware.
+
+Works on streamed responses too: output is compressed incrementally and
+sync-flushed every `flush_size` bytes of input, so a page rendered with
+`render_conditional(..., stream=True)` reaches the browser in pieces
+instead of after the whole body has been built and compressed.
+"""
+
+import zlib
+
+from werkzeug.http import parse_accept_header
+
+DEFAULT_MIMETYPES = (
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+    'application/x-ndjson',
+    'image/svg+xml',
+)
+
+
+class CompressionMiddleware:
+    """Gzip responses for clients that accept it (gzip with q > 0).
+
+    Responses are compressed when their Content-Type is in `mimetypes`,
+    they are not already encoded, they have a body (not HEAD, 204 or 304),
+    and their Content-Length (if known up front) is at least `min_size`
+    bytes. Every response of those types gets `Vary: Accept-Encoding`,
+    compressed or not, so shared caches keep the two versions apart.
+    """
+
+    def __init__(self, app, min_size=500, level=6,
+                 mimetypes=DEFAULT_MIMETYPES, flush_size=8 * 1024):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.mimetypes = set(mimetypes)
+        self.flush_size = flush_size
+
+    def _varies(self, headers):
+        """Could this response be sent compressed to some clients?"""
+
+        headers = {name.lower(): value for name, value in headers}
+
+        if 'content-encoding' in headers:
+            return False
+
+        mimetype = headers.get('content-type', '').split(';')[0].strip()
+        return mimetype in self.mimetypes
+
+    def _should_compress(self, status, headers):
+        if int(status.split(' ', 1)[0]) in (204, 206, 304):
+            return False
+
+        for name, value in headers:
+            if name.lower() == 'content-length':
+                return int(value) >= self.min_size
+
+        return True
+
+    def __call__(self, environ, start_response):
+        # Quality lookup handles `*` and `gzip;q=0` (explicitly refused).
+        # HEAD responses have no body to compress.
+        accepts_gzip = (
+            environ.get('REQUEST_METHOD') != 'HEAD'
+            and parse_accept_header(
+                environ.get('HTTP_ACCEPT_ENCODING'))['gzip'])
+
+        state = {'compress': False}
+
+        def compressing_start_response(status, headers, exc_info=None):
+            if self._varies(headers):
+                headers = _add_vary(headers, 'Accept-Encoding')
+
+                if accepts_gzip and self._should_compress(status, headers):
+                    state['compress'] = True
+                    headers = [_weaken_etag(name, value)
+                               for name, value in headers
+                               if name.lower() != 'content-length']
+                    headers.append(('Content-Encoding', 'gzip'))
+
+            return start_response(status, headers, exc_info)
+
+        app_iter = self.app(environ, compressing_start_response)
+
+        if not state['compress']:
+            return app_iter
+
+        return self._compress(app_iter)
+
+    def _compress(self, app_iter):
+        """Yield gzip output for `app_iter`, flushing as input arrives."""
+
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      zlib.MAX_WBITS | 16)
+        pending = 0
+
+        try:
+            for chunk in app_iter:
+                output = compressor.compress(chunk)
+                pending += len(chunk)
+
+                if pending >= self.flush_size:
+                    output += compressor.flush(zlib.Z_SYNC_FLUSH)
+                    pending = 0
+
+                if output:
+                    yield output
+
+            yield compressor.flush(zlib.Z_FINISH)
+
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+def _add_vary(headers, field):
+    """Add `field` to the Vary header, merged with any already set."""
+
+    fields = [item.strip()
+              for name, value in headers if name.lower() == 'vary'
+              for item in value.split(',') if item.strip()]
+
+    if '*' in fields or field.lower() in map(str.lower, fields):
+        return headers
+
+    return ([(name, value) for name, value in headers
+             if name.lower() != 'vary']
+            + [('Vary', ', '.join(fields + [field]))])
+
+
+def _weaken_etag(name, value):
+    """Compressed bodies differ byte-for-byte, so strong ETags become weak."""
+
+    if name.lower() == 'etag' and not value.startswith('W/'):
+        return name, f"W/{value}"
+
+    return name, value
@@ -0,0 +1,406 @@
+"""Server-sent events push for new timeline messages.
+
+`messages_add` publishes each new message, with its rendered card, to `hub`.
+Clients on the home page hold open GET /timeline/events, and each
+connection forwards the messages whose author the viewer follows (or wrote
+themselves); the page prepends the card. The follow routes publish follow
+events, which keep each open stream's set of authors current without
+querying.
+
+Events are published as part of the write they announce: `hub.publish`
+is called before the commit and the event goes out only if the commit
+does (see `on_commit`), so a client never hears about a row it can't read
+yet.
+
+Delivery within a worker goes through an in-process broker. To reach
+clients connected to *other* workers, configure EVENTS_BACKEND_URL:
+
+- postgresql://...      Postgres LISTEN/NOTIFY on the app database
+- unix:///some/dir      a datagram socket per worker in that directory
+
+SSE connections are long-lived and each open stream holds one worker
+thread, so a worker serves at most EVENTS_MAX_STREAMS of them at once (keep
+it well under gunicorn's --threads). Above that the endpoint answers 503
+with Retry-After and the page tries again later, so streams can never take
+every thread away from ordinary requests.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import select
+import socket
+import tempfile
+import threading
+import time
+import uuid
+
+from flask import Blueprint, Response, current_app, g
+from sqlalchemy import event as sqlalchemy_event, text
+from sqlalchemy.orm import Session
+
+from models import db, Follows
+
+HEARTBEAT_SECONDS = 15
+RECONNECT_MIN_SECONDS = 1
+RECONNECT_MAX_SECONDS = 60
+MAX_STREAM_SECONDS = 5 * 60
+MAX_STREAMS = 8
+STREAM_RETRY_SECONDS = 30
+SUBSCRIBER_QUEUE_SIZE = 100
+CHANNEL = 'warbler_messages'
+ON_COMMIT_KEY = 'on_commit'
+
+events = Blueprint('events', __name__)
+
+logger = logging.getLogger('warbler.events')
+
+
+def on_commit(callback):
+    """Call `callback()` once the current db.session transaction commits.
+
+    Dropped if the transaction rolls back instead.
+    """
+
+    # Begin the transaction if nothing has yet, so a rollback clears it.
+    db.session.connection()
+    db.session.info.setdefault(ON_COMMIT_KEY, []).append(callback)
+
+
+@sqlalchemy_event.listens_for(Session, 'after_commit')
+def _run_on_commit(session):
+    for callback in session.info.pop(ON_COMMIT_KEY, []):
+        callback()
+
+
+@sqlalchemy_event.listens_for(Session, 'after_soft_rollback')
+def _drop_on_commit(session, previous_transaction):
+    # Rolling back a savepoint leaves the outer transaction's callbacks.
+    if not session.in_transaction():
+        session.info.pop(ON_COMMIT_KEY, None)
+
+
+##############################################################################
+# Pub/sub
+
+
+class LocalBroker:
+    """In-process fan-out of events to subscriber queues."""
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        """Return a new queue that receives every published event."""
+
+        subscription = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, event):
+        """Deliver `event` to every subscriber (dropped for full queues)."""
+
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait(event)
+            except queue.Full:
+                pass
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+
+class PostgresNotifyBackend:
+    """Cross-worker delivery over Postgres LISTEN/NOTIFY.
+
+    NOTIFY goes through db.session, inside the write's own transaction:
+    Postgres delivers it when (and only if) that transaction commits, and
+    publishing costs one statement rather than a new connection.
+    """
+
+    transactional = True
+
+    def __init__(self, dsn, channel=CHANNEL):
+        self.dsn = dsn
+        self.channel = channel
+
+    def publish(self, event):
+        db.session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                           {'channel': self.channel,
+                            'payload': json.dumps(event)})
+
+    def listen(self, deliver):
+        """Call `deliver(event)` for every notification (runs forever).
+
+        A lost connection is logged and reopened, with exponential backoff,
+        and the channel LISTENed to again. Events notified while it was
+        down are missed.
+        """
+
+        import psycopg2
+
+        delay = RECONNECT_MIN_SECONDS
+
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {self.channel}")
+
+                logger.info("Listening for events on %s", self.channel)
+                delay = RECONNECT_MIN_SECONDS
+                self._receive(conn, deliver)
+            except Exception:
+                logger.exception("Event listener on %s failed; reconnecting "
+                                 "in %ss", self.channel, delay)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_SECONDS)
+
+    @staticmethod
+    def _receive(conn, deliver):
+        while True:
+            if select.select([conn], [], [], HEARTBEAT_SECONDS) == ([], [], []):
+                # Quiet: make sure the connection is still there.
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                continue
+
+            conn.poll()
+            while conn.notifies:
+                _deliver(deliver, conn.notifies.pop(0).payload)
+
+
+class UnixSocketBackend:
+    """Cross-worker delivery over datagram sockets in a shared directory.
+
+    Each worker binds one socket in `directory` (removed again at exit);
+    publishing sends the event to every socket found there.
+    """
+
+    transactional = False
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        self._path = os.path.join(directory, f"{uuid.uuid4().hex}.sock")
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self._path)
+        atexit.register(self.close)
+
+    def close(self):
+        """Close and remove this worker's socket."""
+
+        self._socket.close()
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+
+    def publish(self, event):
+        payload = json.dumps(event).encode('UTF-8')
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+        try:
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                try:
+                    sender.sendto(payload, path)
+                except ConnectionRefusedError:
+                    # a worker that exited without cleaning up
+                    os.unlink(path)
+                except OSError:
+                    pass
+        finally:
+            sender.close()
+
+    def listen(self, deliver):
+        """Call `deliver(event)` for every datagram (runs forever)."""
+
+        while True:
+            try:
+                payload = self._socket.recv(64 * 1024)
+            except OSError:
+                if self._socket.fileno() == -1:
+                    return  # closed
+                logger.exception("Event listener on %s failed", self._path)
+                time.sleep(RECONNECT_MIN_SECONDS)
+                continue
+
+            _deliver(deliver, payload)
+
+
+def _deliver(deliver, payload):
+    try:
+        event = json.loads(payload)
+    except ValueError:
+        logger.warning("Dropped a malformed event: %r", payload[:200])
+        return
+
+    deliver(event)
+
+
+class EventHub:
+    """Publishes events to local subscribers, via `backend` if configured.
+
+    With a backend, published events go out through it and come back in
+    (to this worker as well as the others) through its listener thread.
+    """
+
+    def __init__(self):
+        self.broker = LocalBroker()
+        self.backend = None
+        self.streams = threading.BoundedSemaphore(MAX_STREAMS)
+
+    def init_app(self, app):
+        self.streams = threading.BoundedSemaphore(
+            app.config.setdefault('EVENTS_MAX_STREAMS', MAX_STREAMS))
+
+        url = app.config.get('EVENTS_BACKEND_URL')
+
+        if not url:
+            self.backend = None
+            return
+
+        if url.startswith('unix://'):
+            self.backend = UnixSocketBackend(url[len('unix://'):]
+                                             or tempfile.gettempdir())
+        elif url.startswith(('postgres://', 'postgresql://')):
+            self.backend = PostgresNotifyBackend(url)
+        else:
+            raise ValueError(f"Unknown EVENTS_BACKEND_URL: {url}")
+
+        threading.Thread(target=self.backend.listen,
+                         args=(self.broker.publish,),
+                         name='events-listener',
+                         daemon=True).start()
+
+    def publish(self, event):
+        """Publish `event` when the current transaction commits."""
+
+        if self.backend is None:
+            on_commit(lambda: self.broker.publish(event))
+        elif self.backend.transactional:
+            self.backend.publish(event)
+        else:
+            on_commit(lambda: self.backend.publish(event))
+
+    def subscribe(self):
+        return self.broker.subscribe()
+
+    def unsubscribe(self, subscription):
+        self.broker.unsubscribe(subscription)
+
+
+hub = EventHub()
+
+
+def publish_message(message, card):
+    """Announce a newly created Message, rendered as `card`, to streams.
+
+    Call before committing the message (it needs the flushed id).
+    """
+
+    hub.publish({
+        'type': 'message',
+        'id': message.id,
+        'user_id': message.user_id,
+        'html': str(card),
+    })
+
+
+def publish_follow(follower_id, followed_id, following):
+    """Announce a follow/unfollow; call before committing it."""
+
+    hub.publish({
+        'type': 'follow',
+        'follower_id': follower_id,
+        'followed_id': followed_id,
+        'following': following,
+    })
+
+
+##############################################################################
+# SSE endpoint
+
+
+def _visible_author_ids(user_id):
+    """Authors whose messages appear in `user_id`'s timeline."""
+
+    rows = (db.session.query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id))
+
+    return {followed_id for (followed_id,) in rows} | {user_id}
+
+
+def _sse(event_type, data):
+    return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+
+@events.get('/timeline/events')
+def timeline_events():
+    """Stream the logged-in user's new timeline messages as SSE."""
+
+    if not g.identity:
+        return Response(status=401)
+
+    if not hub.streams.acquire(blocking=False):
+        return Response(status=503,
+                        headers={'Retry-After': str(STREAM_RETRY_SECONDS)})
+
+    user_id = g.identity.id
+    max_seconds = current_app.config.get('EVENTS_MAX_STREAM_SECONDS',
+                                         MAX_STREAM_SECONDS)
+    heartbeat = current_app.config.get('EVENTS_HEARTBEAT_SECONDS',
+                                       HEARTBEAT_SECONDS)
+
+    # Subscribe before reading the follows, so nothing posted or followed
+    # in between is missed.
+    subscription = hub.subscribe()
+    authors = _visible_author_ids(user_id)
+
+    def generate():
+        deadline = time.monotonic() + max_seconds
+        yield "retry: 5000\n\n"
+
+        while time.monotonic() < deadline:
+            try:
+                event = subscription.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ": ping\n\n"
+                continue
+
+            if event['type'] == 'follow':
+                if event['follower_id'] == user_id and event['following']:
+                    authors.add(event['followed_id'])
+                elif event['follower_id'] == user_id:
+                    authors.discard(event['followed_id'])
+            elif event.get('user_id') in authors:
+                yield _sse(event['type'], event)
+
+    def close():
+        hub.unsubscribe(subscription)
+        hub.streams.release()
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.call_on_close(close)
+    return response
@@ -0,0 +1,345 @@
+"""In-memory follow graph index.
+
+With FOLLOW_GRAPH_ENABLED, each worker keeps the whole `follows` table in
+memory as two compressed sparse row (CSR) adjacency structures, one per
+direction:
+
+- `offsets` (array('q'), one entry per user id + 1) and
+- `targets` (array('i'), one int32 per edge), sorted within each user,
+
+so user u's neighbours are targets[offsets[u]:offsets[u + 1]]. That is
+~4 bytes per edge per direction, instead of an ORM object per edge.
+Membership is a bisect over that slice (O(log degree)); degree is one
+subtraction.
+
+Follows and unfollows made since the arrays were built live in a small
+overlay of added/removed edges. This worker's own writes are applied to it
+directly (`record`, when the commit lands), and other workers' arrive through
+the event hub when EVENTS_BACKEND_URL is configured (see events.py). The
+arrays are first built by a background thread at startup (the app reads the
+follows table until then), and rebuilt from the table every
+FOLLOW_GRAPH_REBUILD_SECONDS, which folds in the overlay and repairs
+anything missed.
+"""
+
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+
+from sqlalchemy import func, select
+
+from events import hub, on_commit
+from models import db, Follows, User
+
+BUILD_BATCH_SIZE = 10_000
+
+
+class Adjacency:
+    """One direction of the graph: CSR arrays plus an overlay of edits."""
+
+    def __init__(self, offsets=None, targets=None):
+        self.offsets = offsets if offsets is not None else array('q', [0])
+        self.targets = targets if targets is not None else array('i')
+        self.added = {}
+        self.removed = {}
+
+    @classmethod
+    def build(cls, edges, size):
+        """From (source, target) pairs sorted by source then target."""
+
+        counts = array('q', bytes(8 * (size + 1)))
+        targets = array('i')
+
+        for source, target in edges:
+            counts[source + 1] += 1
+            targets.append(target)
+
+        return cls(array('q', accumulate(counts)), targets)
+
+    def _span(self, source):
+        if source + 1 >= len(self.offsets):
+            return 0, 0
+        return self.offsets[source], self.offsets[source + 1]
+
+    def _base_contains(self, source, target):
+        start, end = self._span(source)
+        index = bisect_left(self.targets, target, start, end)
+        return index < end and self.targets[index] == target
+
+    def contains(self, source, target):
+        if target in self.added.get(source, ()):
+            return True
+        if target in self.removed.get(source, ()):
+            return False
+        return self._base_contains(source, target)
+
+    def degree(self, source):
+        start, end = self._span(source)
+        return (end - start
+                + len(self.added.get(source, ()))
+                - len(self.removed.get(source, ())))
+
+    def neighbours(self, source):
+        """Sorted ids adjacent to `source`."""
+
+        start, end = self._span(source)
+        removed = self.removed.get(source, ())
+        ids = [target for target in self.targets[start:end]
+               if target not in removed]
+
+        if self.added.get(source):
+            ids = sorted(ids + list(self.added[source]))
+
+        return ids
+
+    def page(self, source, before=None, limit=100):
+        """Up to `limit` ids adjacent to `source` below `before`, highest first.
+
+        Bisects into the CSR slice and walks back from there, so a page of
+        a large neighbour list costs O(limit), not O(degree).
+        """
+
+        start, end = self._span(source)
+        if before is not None:
+            end = bisect_left(self.targets, before, start, end)
+
+        removed = self.removed.get(source, ())
+        added = sorted((target for target in self.added.get(source, ())
+                        if before is None or target < before),
+                       reverse=True)
+
+        # Merge the base slice (walked backwards) with the added edges;
+        # the two never share an id.
+        ids, index, extra = [], end - 1, 0
+        while len(ids) < limit:
+            base = self.targets[index] if index >= start else None
+            if extra < len(added) and (base is None or added[extra] > base):
+                ids.append(added[extra])
+                extra += 1
+            elif base is not None:
+                index -= 1
+                if base not in removed:
+                    ids.append(base)
+            else:
+                break
+
+        return ids
+
+    def set_edge(self, source, target, present):
+        """Record that the edge now is (or isn't) there."""
+
+        in_base = self._base_contains(source, target)
+        add, drop = ((self.added, self.removed) if present
+                     else (self.removed, self.added))
+
+        drop.get(source, set()).discard(target)
+        if present != in_base:
+            add.setdefault(source, set()).add(target)
+        else:
+            add.get(source, set()).discard(target)
+
+    @property
+    def overlay_size(self):
+        return (sum(map(len, self.added.values()))
+                + sum(map(len, self.removed.values())))
+
+
+class FollowGraph:
+    """Per-worker follow graph: who follows whom, without the ORM."""
+
+    def __init__(self):
+        self.enabled = False
+        self.built_at = None
+        self._following = Adjacency()
+        self._followers = Adjacency()
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()
+        self._pending = None
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.setdefault('FOLLOW_GRAPH_ENABLED', False)
+        self.rebuild_seconds = app.config.setdefault(
+            'FOLLOW_GRAPH_REBUILD_SECONDS', 15 * 60)
+
+        if not self.enabled:
+            return
+
+        if hub.backend is not None:
+            threading.Thread(target=self._listen,
+                             args=(hub.subscribe(),),
+                             name='follow-graph-listener',
+                             daemon=True).start()
+
+        # Built off the request path; until then `ready` is False and
+        # callers use the follows table.
+        threading.Thread(target=self._build_periodically,
+                         name='follow-graph-build',
+                         daemon=True).start()
+
+    @property
+    def ready(self):
+        """Enabled and built at least once."""
+
+        return self.enabled and self.built_at is not None
+
+    ##########################################################################
+    # Building
+
+    def build(self):
+        """Load the follows table into fresh CSR arrays (app context)."""
+
+        with self._build_lock:
+            self._build()
+
+    def _build(self):
+        # The table scan runs without self._lock, so queries and edits
+        # carry on against the old arrays (edits are also queued in
+        # _pending for the new ones).
+        with self._lock:
+            self._pending = []
+
+        size = (db.session.query(func.max(User.id)).scalar() or 0) + 1
+        following = Adjacency.build(
+            self._edges(Follows.user_following_id,
+                        Follows.user_being_followed_id), size)
+        followers = Adjacency.build(
+            self._edges(Follows.user_being_followed_id,
+                        Follows.user_following_id), size)
+
+        with self._lock:
+            # Writes made while the table was being read; reapplying one
+            # that the read already saw is harmless.
+            for follower_id, followed_id, following_now in self._pending:
+                following.set_edge(follower_id, followed_id, following_now)
+                followers.set_edge(followed_id, follower_id, following_now)
+
+            self._following, self._followers = following, followers
+            self._pending = None
+            self.built_at = time.monotonic()
+
+    @staticmethod
+    def _edges(source, target):
+        rows = db.session.execute(
+            select(source, target)
+            .order_by(source, target)
+            .execution_options(stream_results=True))
+
+        for batch in rows.partitions(BUILD_BATCH_SIZE):
+            yield from batch
+
+    def _ensure_built(self):
+        if self.built_at is None:
+            with self._build_lock:
+                if self.built_at is None:
+                    self._build()
+
+    def _build_periodically(self):
+        """Build now, then every FOLLOW_GRAPH_REBUILD_SECONDS (if set)."""
+
+        while True:
+            with self.app.app_context():
+                self.build()
+                db.session.remove()
+
+            if not self.rebuild_seconds:
+                return
+            time.sleep(self.rebuild_seconds)
+
+    ##########################################################################
+    # Updates
+
+    def record(self, follower_id, followed_id, following):
+        """Apply a follow/unfollow here when it commits.
+
+        Call before committing the write. Other workers hear of it through
+        the follow event the route publishes (`events.publish_follow`).
+        """
+
+        on_commit(lambda: self._apply(follower_id, followed_id, following))
+
+    def _apply(self, follower_id, followed_id, following):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((follower_id, followed_id, following))
+            self._following.set_edge(follower_id, followed_id, following)
+            self._followers.set_edge(followed_id, follower_id, following)
+
+    def _listen(self, subscription):
+        while True:
+            event = subscription.get()
+            # Our own writes come back too; applying an edit twice is a no-op.
+            if event.get('type') == 'follow':
+                self._apply(event['follower_id'], event['followed_id'],
+                            event['following'])
+
+    ##########################################################################
+    # Queries
+
+    def is_following(self, follower_id, followed_id):
+        self._ensure_built()
+        with self._lock:
+            return self._following.contains(follower_id, followed_id)
+
+    def followed_ids_among(self, follower_id, user_ids):
+        """Which of `user_ids` does user `follower_id` follow?"""
+
+        self._ensure_built()
+        with self._lock:
+            return {user_id for user_id in user_ids
+                    if self._following.contains(follower_id, user_id)}
+
+    def following_ids(self, user_id):
+        self._ensure_built()
+        with self._lock:
+            return self._following.neighbours(user_id)
+
+    def follower_ids(self, user_id):
+        self._ensure_built()
+        with self._lock:
+            return self._followers.neighbours(user_id)
+
+    def following_page(self, user_id, before=None, limit=100):
+        """Ids `user_id` follows below `before`, highest first."""
+
+        self._ensure_built()
+        with self._lock:
+            return self._following.page(user_id, before, limit)
+
+    def follower_page(self, user_id, before=None, limit=100):
+        """Ids following `user_id` below `before`, highest first."""
+
+        self._ensure_built()
+        with self._lock:
+            return self._followers.page(user_id, before, limit)
+
+    def following_count(self, user_id):
+        self._ensure_built()
+        with self._lock:
+            return self._following.degree(user_id)
+
+    def follower_count(self, user_id):
+        self._ensure_built()
+        with self._lock:
+            return self._followers.degree(user_id)
+
+    def stats(self):
+        """Sizes of the arrays and overlay, for monitoring."""
+
+        with self._lock:
+            return {
+                'edges': len(self._following.targets),
+                'users': len(self._following.offsets) - 1,
+                'overlay': self._following.overlay_size,
+                'bytes': sum(adjacency.offsets.itemsize
+                             * len(adjacency.offsets)
+                             + adjacency.targets.itemsize
+                             * len(adjacency.targets)
+                             for adjacency in (self._following,
+                                               self._followers)),
+            }
+
+
+follow_graph = FollowGraph()
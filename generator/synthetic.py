@@ -0,0 +1,390 @@
+"""Generate large, reproducible Warbler datasets for load testing.
+
+Unlike create_csvs.py this works offline (no Faker, no image API) and
+scales to millions of users:
+
+- rows are produced in vectorized numpy batches ("shards"), generated in
+  parallel across processes and concatenated in order
+- follows and likes are sampled from power-law (Zipf-like) distributions:
+  a few users have huge follower counts and most have a handful, and
+  likes pile up on a minority of messages
+- no pair lists are materialized: follows are partitioned by follower and
+  each follower's out-degree is drawn up front, so duplicates only need
+  removing within a shard
+
+The same --seed and --end give byte-identical output regardless of
+--workers.
+
+    python generator/synthetic.py --users 1000000 --messages 20000000 \\
+        --follows 50000000 --likes 30000000 --direct-messages 2000000 \\
+        --out generator/synthetic
+    python seed.py --data-dir generator/synthetic
+
+Requires numpy.
+"""
+
+import argparse
+import csv
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+SHARD_SIZE = 200_000
+MAX_WARBLER_LENGTH = 140
+TIMESTAMP_SPAN_DAYS = 2 * 365
+
+# Same password hash create_csvs.py gives every user.
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+IMAGE_URLS = np.array([
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+])
+
+LOCATIONS = np.array([
+    "San Francisco", "Oakland", "New York", "Chicago", "Austin", "Seattle",
+    "Portland", "Denver", "Boston", "Atlanta", "Toronto", "London", "Berlin",
+    "Paris", "Madrid", "Lisbon", "Tokyo", "Seoul", "Sydney", "Mexico City",
+])
+
+WORDS = np.array("""
+    about above across after again against almost along already also always
+    among answer around away back because become before begin behind believe
+    below between beyond bird both bring build call came carry change city
+    close cold come could country cover cross dark early earth east enough
+    even ever every face fact family far fast feel field find fire first
+    follow food form found free friend full garden give good great green
+    ground group grow half hand happen hard head hear heart heavy help here
+    high hold home hope horse house idea inside island just keep kind know
+    land large last late learn leave left less letter light line listen
+    little live long look made make many mark may mean might mile mind miss
+    money moon more morning most mountain move much music must name near
+    need never next night north nothing notice number ocean often old once
+    only open order other over paper part pass past people picture place
+    plan plant play point power quick quiet rain reach read ready real river
+    road rock room round run same saw school sea second see seem sentence
+    serve set several shape short show side simple since sing sky slow small
+    snow song soon sound south space stand star start stay still stone stop
+    story street strong study such summer sun sure table take talk tell than
+    thing think those though thought through time today together town travel
+    tree true turn under until upon valley very voice walk warm watch water
+    wave weather west while white whole wind window winter without wonder
+    wood word work world write year young
+""".split())
+
+HEADERS = {
+    'users': ['id', 'email', 'username', 'image_url', 'password', 'bio',
+              'location'],
+    'messages': ['id', 'text', 'timestamp', 'user_id'],
+    'follows': ['user_being_followed_id', 'user_following_id'],
+    'likes': ['user_id', 'message_id'],
+    'direct_messages': ['text', 'timestamp', 'user_id', 'recipient_id'],
+}
+
+
+##############################################################################
+# Distributions
+
+
+def zipf_cdf(n, alpha):
+    """Cumulative distribution over ranks 1..n with weight rank**-alpha."""
+
+    weights = np.arange(1, n + 1, dtype=np.float64) ** -alpha
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def sample_ranks(rng, cdf, size):
+    """Draw `size` 0-based ranks from a zipf_cdf."""
+
+    return np.searchsorted(cdf, rng.random(size), side='right')
+
+
+class Population:
+    """Per-run distributions shared by every shard.
+
+    Popularity and activity are independent random orderings of user ids,
+    so the most-followed users aren't also the most prolific posters.
+    """
+
+    def __init__(self, seed, users, messages, alpha, end):
+        rng = np.random.default_rng([seed, 0])
+
+        self.end = np.datetime64(end, 'us')
+        self.users = users
+        self.messages = messages
+        self.user_cdf = zipf_cdf(users, alpha)
+        self.message_cdf = zipf_cdf(messages, alpha) if messages else None
+
+        self.popular = rng.permutation(users) + 1
+        self.active = rng.permutation(users) + 1
+        self.liked = rng.permutation(messages) + 1 if messages else None
+
+    def popular_users(self, rng, size):
+        return self.popular[sample_ranks(rng, self.user_cdf, size)]
+
+    def active_users(self, rng, size):
+        return self.active[sample_ranks(rng, self.user_cdf, size)]
+
+    def popular_messages(self, rng, size):
+        return self.liked[sample_ranks(rng, self.message_cdf, size)]
+
+
+def out_degrees(seed, users, total, alpha, stream):
+    """Per-user out-degree (follows made / likes given) summing to ~total."""
+
+    if not total:
+        return np.zeros(users, dtype=np.int64)
+
+    rng = np.random.default_rng([seed, stream])
+    weights = rng.permutation(np.arange(1, users + 1, dtype=np.float64)
+                              ** -alpha)
+    return rng.multinomial(total, weights / weights.sum())
+
+
+##############################################################################
+# Shards
+
+
+_population = None
+
+
+def _init_worker(seed, users, messages, alpha, end):
+    global _population
+    _population = Population(seed, users, messages, alpha, end)
+
+
+def sentences(rng, size, min_words, max_words):
+    """Random text from WORDS, capped at MAX_WARBLER_LENGTH."""
+
+    lengths = rng.integers(min_words, max_words + 1, size)
+    words = WORDS[rng.integers(0, len(WORDS), (size, max_words))]
+
+    return [' '.join(row[:length]).capitalize()[:MAX_WARBLER_LENGTH - 1] + '.'
+            for row, length in zip(words.tolist(), lengths.tolist())]
+
+
+def timestamps(rng, size):
+    now = _population.end
+    span = np.int64(TIMESTAMP_SPAN_DAYS * 24 * 3600 * 10**6)
+    offsets = rng.integers(0, span, size).astype('timedelta64[us]')
+    return np.datetime_as_string(now - offsets, unit='us').tolist()
+
+
+def user_rows(rng, start, stop):
+    ids = np.arange(start, stop) + 1
+    size = len(ids)
+    usernames = [f"user{user_id}" for user_id in ids.tolist()]
+
+    return zip(ids.tolist(),
+               [f"{name}@example.com" for name in usernames],
+               usernames,
+               IMAGE_URLS[rng.integers(0, len(IMAGE_URLS), size)].tolist(),
+               [PASSWORD_HASH] * size,
+               sentences(rng, size, 4, 12),
+               LOCATIONS[rng.integers(0, len(LOCATIONS), size)].tolist())
+
+
+def message_rows(rng, start, stop):
+    size = stop - start
+
+    return zip(range(start + 1, stop + 1),
+               sentences(rng, size, 5, 25),
+               timestamps(rng, size),
+               _population.active_users(rng, size).tolist())
+
+
+def _pairs(rng, owners, degrees, draw, exclude_self, rounds=8):
+    """Unique (owner, target) pairs: about `degrees[i]` for owners[i].
+
+    Popular targets get drawn repeatedly, so owners that lost pairs to
+    de-duplication draw again for the shortfall a few times.
+    """
+
+    keys = np.empty(0, dtype=np.int64)
+    wanted = degrees
+
+    for _ in range(rounds):
+        sources = np.repeat(owners, wanted)
+        if not len(sources):
+            break
+
+        targets = draw(rng, len(sources))
+        if exclude_self:
+            keep = sources != targets
+            sources, targets = sources[keep], targets[keep]
+
+        # Shards own disjoint owner ranges, so de-duplicating here is enough.
+        keys = np.union1d(keys, sources.astype(np.int64) << 32 | targets)
+
+        have = np.bincount((keys >> 32) - owners[0], minlength=len(owners))
+        wanted = np.maximum(degrees - have, 0)
+
+    return keys >> 32, keys & 0xFFFFFFFF
+
+
+def follow_rows(rng, start, stop, degrees):
+    followers, followed = _pairs(rng, np.arange(start, stop) + 1, degrees,
+                                 _population.popular_users, exclude_self=True)
+    return zip(followed.tolist(), followers.tolist())
+
+
+def like_rows(rng, start, stop, degrees):
+    users, messages = _pairs(rng, np.arange(start, stop) + 1, degrees,
+                             _population.popular_messages, exclude_self=False)
+    return zip(users.tolist(), messages.tolist())
+
+
+def direct_message_rows(rng, start, stop):
+    size = stop - start
+    senders = _population.active_users(rng, size)
+    recipients = _population.popular_users(rng, size)
+    keep = senders != recipients
+
+    return zip(sentences(rng, size, 3, 20),
+               timestamps(rng, size),
+               senders[keep].tolist(),
+               recipients[keep].tolist())
+
+
+GENERATORS = {
+    'users': user_rows,
+    'messages': message_rows,
+    'follows': follow_rows,
+    'likes': like_rows,
+    'direct_messages': direct_message_rows,
+}
+
+STREAMS = {name: index + 1 for index, name in enumerate(GENERATORS)}
+
+
+def write_shard(seed, table, shard, start, stop, path, degrees=None):
+    """Generate rows [start, stop) of `table` into `path`; return row count."""
+
+    rng = np.random.default_rng([seed, STREAMS[table], shard])
+    args = (rng, start, stop) if degrees is None else (rng, start, stop,
+                                                       degrees)
+
+    with open(path, 'w', newline='') as out:
+        writer = csv.writer(out)
+        rows = 0
+        for row in GENERATORS[table](*args):
+            writer.writerow(row)
+            rows += 1
+
+    return rows
+
+
+##############################################################################
+# Driver
+
+
+def shard_ranges(count, shard_size):
+    return [(start, min(start + shard_size, count))
+            for start in range(0, count, shard_size)]
+
+
+def generate(out_dir, users, messages, follows, likes, direct_messages,
+             seed=0, alpha=1.1, end=None, workers=None,
+             shard_size=SHARD_SIZE):
+    """Write users/messages/follows/likes/direct_messages CSVs to `out_dir`."""
+
+    if users >= 2**31 or messages >= 2**31:
+        raise ValueError("ids must fit in a 32-bit integer column")
+
+    os.makedirs(out_dir, exist_ok=True)
+    end = end or str(np.datetime64('today', 'D'))
+
+    follow_degrees = np.minimum(
+        out_degrees(seed, users, follows, alpha, STREAMS['follows']),
+        users - 1)
+    like_degrees = (np.minimum(
+        out_degrees(seed, users, likes, alpha, STREAMS['likes']), messages)
+        if messages else np.zeros(users, dtype=np.int64))
+
+    # Follows/likes shards are sized by rows produced, not users covered.
+    plan = {
+        'users': shard_ranges(users, shard_size),
+        'messages': shard_ranges(messages, shard_size),
+        'follows': _degree_shards(follow_degrees, shard_size),
+        'likes': _degree_shards(like_degrees, shard_size),
+        'direct_messages': shard_ranges(direct_messages, shard_size),
+    }
+
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(seed, users, messages, alpha, end)) as pool:
+        for table, ranges in plan.items():
+            started = time.monotonic()
+            futures = []
+
+            for shard, (start, stop) in enumerate(ranges):
+                degrees = {'follows': follow_degrees,
+                           'likes': like_degrees}.get(table)
+                path = os.path.join(out_dir, f"{table}.{shard:05}.part")
+                futures.append((path, pool.submit(
+                    write_shard, seed, table, shard, start, stop, path,
+                    None if degrees is None else degrees[start:stop])))
+
+            rows = _concatenate(os.path.join(out_dir, f"{table}.csv"),
+                                HEADERS[table], futures)
+
+            elapsed = time.monotonic() - started
+            print(f"{table}: {rows:,} rows in {elapsed:.1f}s",
+                  file=sys.stderr)
+
+
+def _degree_shards(degrees, shard_size):
+    """Split owners into ranges of about `shard_size` total degree."""
+
+    boundaries = np.searchsorted(np.cumsum(degrees),
+                                 np.arange(shard_size, degrees.sum(),
+                                           shard_size),
+                                 side='right')
+    edges = [0, *sorted(set(boundaries.tolist()) - {0, len(degrees)}),
+             len(degrees)]
+    return list(zip(edges, edges[1:])) if degrees.sum() else []
+
+
+def _concatenate(path, header, futures):
+    """Write `header` then each shard file (in order) into `path`."""
+
+    rows = 0
+
+    with open(path, 'w', newline='') as out:
+        csv.writer(out).writerow(header)
+
+        for part, future in futures:
+            rows += future.result()
+            with open(part, newline='') as shard:
+                shutil.copyfileobj(shard, out)
+            os.remove(part)
+
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--out', default='generator/synthetic')
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--follows', type=int, default=200_000)
+    parser.add_argument('--likes', type=int, default=200_000)
+    parser.add_argument('--direct-messages', type=int, default=20_000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--alpha', type=float, default=1.1,
+                        help='power-law exponent for degrees and popularity')
+    parser.add_argument('--end', default=None,
+                        help='latest timestamp (ISO date, default today)')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE)
+    args = parser.parse_args()
+
+    generate(args.out, args.users, args.messages, args.follows, args.likes,
+             args.direct_messages, seed=args.seed, alpha=args.alpha,
+             end=args.end, workers=args.workers, shard_size=args.shard_size)
@@ -0,0 +1,173 @@
+"""Password hashing service.
+
+bcrypt is deliberately slow, so hashing runs on a bounded thread pool
+rather than inline on the request thread: bcrypt releases the GIL, so with
+threaded workers (gunicorn --threads / gthread) other requests keep being
+served while a login is hashed, and a login burst queues up behind
+HASHING_WORKERS hashes instead of occupying every worker at once.
+
+Configuration (read in `PasswordHasher.init_app`):
+
+- BCRYPT_LOG_ROUNDS: bcrypt cost for new hashes (lower it in tests/dev)
+- HASHING_WORKERS: size of the hashing pool
+- HASHING_MAX_QUEUE: hashes allowed to wait for a pool thread before
+  callers get `HashingOverloaded`
+- HASHING_QUEUE_TIMEOUT: seconds a caller waits for room in a full queue
+  before giving up (kept short: a rejected login is better than a request
+  thread parked behind a burst)
+- HASHING_METRICS_INTERVAL: seconds between metrics lines on the
+  "warbler.hashing" logger (rejections are always logged)
+"""
+
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+
+import bcrypt
+
+logger = logging.getLogger('warbler.hashing')
+
+DEFAULT_LOG_ROUNDS = 12
+DEFAULT_QUEUE_TIMEOUT = 0.25
+DEFAULT_METRICS_INTERVAL = 60
+
+
+class HashingOverloaded(Exception):
+    """Raised when the hashing queue is full."""
+
+
+class PasswordHasher:
+    """Hashes and checks bcrypt passwords on a bounded worker pool."""
+
+    def __init__(self, rounds=DEFAULT_LOG_ROUNDS, workers=None, max_queue=64,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT,
+                 metrics_interval=DEFAULT_METRICS_INTERVAL):
+        self.rounds = rounds
+        self.queue_timeout = queue_timeout
+        self.metrics_interval = metrics_interval
+        self._pool = None
+        self._configure_pool(workers or os.cpu_count() or 1, max_queue)
+
+    def init_app(self, app):
+        """Pick up hashing settings from `app.config`."""
+
+        self.rounds = app.config.setdefault('BCRYPT_LOG_ROUNDS',
+                                            DEFAULT_LOG_ROUNDS)
+        self.queue_timeout = app.config.setdefault('HASHING_QUEUE_TIMEOUT',
+                                                   DEFAULT_QUEUE_TIMEOUT)
+        self.metrics_interval = app.config.setdefault(
+            'HASHING_METRICS_INTERVAL', DEFAULT_METRICS_INTERVAL)
+        self._configure_pool(
+            app.config.setdefault('HASHING_WORKERS', os.cpu_count() or 1),
+            app.config.setdefault('HASHING_MAX_QUEUE', 64))
+
+    def _configure_pool(self, workers, max_queue):
+        old_pool = self._pool
+
+        self.workers = workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix='hashing')
+        self._slots = BoundedSemaphore(workers + max_queue)
+        self._lock = Lock()
+        self._pending = 0
+        self._max_pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._total_seconds = 0.0
+        self._logged_at = time.monotonic()
+
+        # Replaced by init_app: the old pool's threads finish any work
+        # already handed to them, then exit.
+        if old_pool is not None:
+            old_pool.shutdown(wait=False)
+
+    def _run(self, fn, *args):
+        """Run `fn(*args)` on the pool and wait for its result."""
+
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self._rejected += 1
+            logger.warning(json.dumps({'overloaded': True, **self.metrics()}))
+            raise HashingOverloaded()
+
+        with self._lock:
+            self._pending += 1
+            self._max_pending = max(self._max_pending, self._pending)
+
+        def timed():
+            start = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self._completed += 1
+                    self._total_seconds += time.perf_counter() - start
+
+        try:
+            return self._pool.submit(timed).result()
+        finally:
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+            self._log_metrics()
+
+    def _log_metrics(self):
+        """Log `metrics()` if `metrics_interval` has passed since last time."""
+
+        now = time.monotonic()
+        with self._lock:
+            if now - self._logged_at < self.metrics_interval:
+                return
+            self._logged_at = now
+
+        logger.info(json.dumps(self.metrics()))
+
+    def hash(self, password):
+        """Return a bcrypt hash (str) of `password` at the configured cost."""
+
+        hashed = self._run(bcrypt.hashpw,
+                           password.encode('UTF-8'),
+                           bcrypt.gensalt(self.rounds))
+        return hashed.decode('UTF-8')
+
+    def check(self, hashed, password):
+        """Does `password` match bcrypt hash `hashed`?"""
+
+        try:
+            return self._run(bcrypt.checkpw,
+                             password.encode('UTF-8'),
+                             hashed.encode('UTF-8'))
+        except ValueError:
+            # Not a bcrypt hash at all.
+            return False
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than the configured one?"""
+
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def metrics(self):
+        """Queue-depth and throughput counters for this worker's pool."""
+
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'in_flight': self._pending,
+                'queued': max(self._pending - self.workers, 0),
+                'max_in_flight': self._max_pending,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'avg_ms': (self._total_seconds / self._completed * 1000
+                           if self._completed else 0.0),
+            }
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,82 @@
+"""Conditional GET support for HTML pages.
+
+Views compute an ETag from the rows a page is built from (plus who is
+viewing it) *before* rendering, so a client whose copy is still current
+gets a 304 without the template ever running.
+"""
+
+import hashlib
+import time
+
+from flask import (current_app, g, make_response, render_template, request,
+                   session, stream_with_context)
+from flask_wtf.csrf import generate_csrf
+
+# Pages embed CSRF tokens, which Flask-WTF signs with a timestamp and
+# expires after WTF_CSRF_TIME_LIMIT (an hour by default). Rolling the ETag
+# over every half hour keeps revalidated pages from carrying dead tokens.
+CSRF_EPOCH_SECONDS = 30 * 60
+
+
+def page_etag(*parts):
+    """ETag for a page built from `parts`.
+
+    `parts` should identify every row the page shows, with a version
+    where the row can change. The viewer's identity and CSRF session are
+    mixed in, since the navbar, buttons and forms depend on them.
+    """
+
+    # Make sure the session's CSRF token exists before it is hashed in, so
+    # the page rendered next doesn't change it.
+    generate_csrf()
+
+    viewer = (g.identity,
+              session.get(current_app.config.get('WTF_CSRF_FIELD_NAME',
+                                                 'csrf_token')),
+              int(time.time() // CSRF_EPOCH_SECONDS))
+
+    return hashlib.sha1(repr((parts, viewer)).encode('UTF-8')).hexdigest()
+
+
+# Template output is handed to the server in chunks of roughly this many
+# template events when streaming.
+STREAM_BUFFER_SIZE = 32
+
+
+def stream_template(template, **context):
+    """Render `template` as a stream of chunks, for a streamed response."""
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+
+    # The CSRF token is stored in the session the first time it is made;
+    # make it now, while the session cookie can still be sent.
+    generate_csrf()
+
+    stream = app.jinja_env.get_or_select_template(template).stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return stream_with_context(stream)
+
+
+def render_conditional(etag, template, stream=False, **context):
+    """Render `template`, or return a 304 if the client already has `etag`.
+
+    With `stream`, the page is sent as it renders (see compression.py).
+    Pages with pending flash messages are always rendered in full, since
+    showing them modifies the session.
+    """
+
+    has_flashes = '_flashes' in session
+
+    if not has_flashes and request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+    elif stream and not has_flashes:
+        response = current_app.response_class(
+            stream_template(template, **context))
+    else:
+        response = make_response(render_template(template, **context))
+
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
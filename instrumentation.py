@@ -0,0 +1,195 @@
+"""Per-request SQL instrumentation.
+
+Counts and times every SQL statement a request issues (via SQLAlchemy
+cursor events), then:
+
+- adds a Server-Timing header (`db` and `app` durations, query count),
+  which browser dev tools and most APM agents display
+- logs one JSON line per request to the "warbler.requests" logger, with
+  the slowest statements and any statement repeated SQL_REPEAT_THRESHOLD
+  or more times in one request (the usual signature of an N+1 query)
+- in strict mode (SQL_STRICT, meant for tests), raises QueryBudgetExceeded
+  when a view issues more statements than its budget
+
+Budgets come from the @query_budget(n) decorator on a view, falling back
+to SQL_QUERY_BUDGET. Streamed pages keep querying after the view returns,
+so their header covers the view only while the log line and budget check
+run once the body has been sent.
+"""
+
+import json
+import logging
+import re
+import time
+from collections import Counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('warbler.requests')
+
+SLOWEST_STATEMENTS = 3
+STATEMENT_LOG_LENGTH = 300
+
+# Collapses expanded IN lists, so `IN (?, ?)` and `IN (?, ?, ?)` match.
+_PARAMETER_LIST = re.compile(
+    r"\(\s*(?:\?|%s|%\(\w+\)s)(?:\s*,\s*(?:\?|%s|%\(\w+\)s))*\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A request issued more SQL statements than its budget allows."""
+
+
+def query_budget(limit):
+    """Decorator: allow the view at most `limit` SQL statements."""
+
+    def decorator(view):
+        view.query_budget = limit
+        return view
+
+    return decorator
+
+
+def statement_pattern(statement):
+    """Normalize `statement` for grouping repeats."""
+
+    return _WHITESPACE.sub(' ', _PARAMETER_LIST.sub('(...)', statement)).strip()
+
+
+class RequestStats:
+    """SQL statements issued while serving one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = []
+
+    def record(self, statement, seconds):
+        self.statements.append((statement, seconds))
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    @property
+    def db_ms(self):
+        return sum(seconds for _, seconds in self.statements) * 1000
+
+    @property
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def slowest(self, limit=SLOWEST_STATEMENTS):
+        ranked = sorted(self.statements, key=lambda item: item[1],
+                        reverse=True)
+        return [{'statement': statement[:STATEMENT_LOG_LENGTH],
+                 'ms': round(seconds * 1000, 2)}
+                for statement, seconds in ranked[:limit]]
+
+    def repeated(self, threshold):
+        counts = Counter(statement_pattern(statement)
+                         for statement, _ in self.statements)
+        return [{'statement': pattern[:STATEMENT_LOG_LENGTH], 'count': count}
+                for pattern, count in counts.most_common()
+                if count >= threshold]
+
+
+##############################################################################
+# SQLAlchemy events
+
+
+def _current_stats():
+    return g.get('sql_stats') if has_request_context() else None
+
+
+# The start time lives on the statement's execution context rather than
+# the connection, so a statement that raises leaves nothing behind.
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if context is not None and _current_stats() is not None:
+        context.sql_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stats = _current_stats()
+    started = getattr(context, 'sql_started', None)
+
+    if stats is not None and started is not None:
+        stats.record(statement, time.perf_counter() - started)
+
+
+##############################################################################
+# Flask hooks
+
+
+def init_app(app):
+    """Instrument every request `app` serves."""
+
+    app.config.setdefault('SQL_INSTRUMENTATION', True)
+    app.config.setdefault('SQL_STRICT', False)
+    app.config.setdefault('SQL_QUERY_BUDGET', None)
+    app.config.setdefault('SQL_REPEAT_THRESHOLD', 5)
+
+    @app.before_request
+    def start_sql_stats():
+        if app.config['SQL_INSTRUMENTATION']:
+            g.sql_stats = RequestStats()
+
+    @app.after_request
+    def report_sql_stats(response):
+        stats = g.get('sql_stats')
+        if stats is None:
+            return response
+
+        response.headers['Server-Timing'] = (
+            f'db;dur={stats.db_ms:.1f};desc="{stats.count} queries", '
+            f'app;dur={stats.elapsed_ms:.1f}')
+
+        view = app.view_functions.get(request.endpoint)
+        budget = getattr(view, 'query_budget', app.config['SQL_QUERY_BUDGET'])
+        context = {
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+        }
+
+        def finish():
+            report(app, stats, context, budget)
+
+        # The request context is gone by the time a stream is closed, so
+        # everything finish() needs is captured here.
+        if response.is_streamed:
+            response.call_on_close(finish)
+        else:
+            finish()
+
+        return response
+
+
+def report(app, stats, context, budget):
+    """Log `stats` and, in strict mode, enforce the query budget."""
+
+    repeated = stats.repeated(app.config['SQL_REPEAT_THRESHOLD'])
+
+    logger.log(
+        logging.WARNING if repeated else logging.INFO,
+        json.dumps({
+            **context,
+            'duration_ms': round(stats.elapsed_ms, 2),
+            'queries': stats.count,
+            'db_ms': round(stats.db_ms, 2),
+            'slowest': stats.slowest(),
+            'repeated': repeated,
+        }))
+
+    if (app.config['SQL_STRICT'] and budget is not None
+            and stats.count > budget):
+        raise QueryBudgetExceeded(
+            f"{context['method']} {context['path']} issued {stats.count} "
+            f"SQL statements (budget {budget}): "
+            + json.dumps(stats.repeated(2) or stats.slowest(stats.count)))
@@ -0,0 +1,413 @@
+"""Write-behind buffering for like/unlike events.
+
+With LIKE_BUFFER_ENABLED, `toggle_like` records the new like state here
+instead of writing it in the request. Each worker keeps the latest state
+per (user, message), so a burst of clicks on one message collapses into
+one row change, and a background thread writes everything pending in
+batched statements every LIKE_BUFFER_INTERVAL_MS or LIKE_BUFFER_MAX_EVENTS
+events, whichever comes first. With LIKE_BUFFER_INTERVAL_MS = 0 there is
+no background thread, and pending events are written only by flush()
+(tests) or at shutdown.
+
+Durability: every event is appended to a per-worker journal before the
+request returns (fsync'd too with LIKE_BUFFER_FSYNC). A journal segment is
+deleted only once its events are committed. Segments left behind by a
+worker that died are replayed by the next worker to start. Applying an
+event sets a like state and counts only the changes it made, so replaying
+one twice is harmless; the flush that replays recounts the messages it
+touches too, repairing anything a crash left half-counted.
+Pending events are also flushed when the worker shuts down.
+
+Read-your-writes: the viewer's own pending likes are overlaid on what the
+database says, from this worker's buffer and from a short-lived record in
+their session (which follows them to other workers until the flush lands).
+"""
+
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from itertools import groupby
+from operator import itemgetter
+
+from sqlalchemy import delete, tuple_
+
+from models import (db, insert_ignoring_conflicts, upsert, Like, Message,
+                    User)
+
+logger = logging.getLogger('warbler.likes')
+
+SESSION_KEY = 'pending_likes'
+SESSION_OVERLAY_SECONDS = 5
+SESSION_OVERLAY_MAX = 50
+
+# Age after which an unrenamed journal segment is known to be abandoned.
+STALE_SEGMENT_SECONDS = 60
+
+
+class LikeBuffer:
+    """Per-worker, journaled, coalescing buffer of like states."""
+
+    def __init__(self):
+        self.enabled = False
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._journal = None
+        self._segments = []
+        self._recount = False
+        self._metrics = dict(events=0, coalesced=0, flushes=0,
+                             rows_written=0, errors=0, max_pending=0,
+                             last_flush_ms=0.0, replayed=0)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.setdefault('LIKE_BUFFER_ENABLED', False)
+        self.interval = app.config.setdefault('LIKE_BUFFER_INTERVAL_MS',
+                                              5) / 1000
+        self.max_events = app.config.setdefault('LIKE_BUFFER_MAX_EVENTS', 500)
+        self.fsync = app.config.setdefault('LIKE_BUFFER_FSYNC', False)
+        self.journal_dir = app.config.setdefault(
+            'LIKE_BUFFER_JOURNAL_DIR',
+            os.path.join(tempfile.gettempdir(), 'warbler-likes'))
+
+        if not self.enabled or self._journal is not None:
+            return
+
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self._open_segment()
+        self._replay_orphans()
+        atexit.register(self.close)
+
+        if self.interval:
+            self._thread = threading.Thread(target=self._run,
+                                            name='like-buffer',
+                                            daemon=True)
+            self._thread.start()
+
+    ##########################################################################
+    # Recording and reading
+
+    def record(self, user_id, message_id, liked):
+        """Buffer the new like state of (user, message)."""
+
+        with self._lock:
+            self._write_journal(user_id, message_id, liked)
+
+            key = (user_id, message_id)
+            if key in self._pending:
+                self._metrics['coalesced'] += 1
+            self._pending[key] = liked
+
+            self._metrics['events'] += 1
+            self._metrics['max_pending'] = max(self._metrics['max_pending'],
+                                               len(self._pending))
+            full = len(self._pending) >= self.max_events
+
+        if full:
+            self._wake.set()
+
+    def overlay(self, user_id, message_ids, liked_ids):
+        """`liked_ids` with `user_id`'s pending states for `message_ids`."""
+
+        liked_ids = set(liked_ids)
+
+        with self._lock:
+            for message_id in message_ids:
+                state = self._pending.get((user_id, message_id))
+                if state is True:
+                    liked_ids.add(message_id)
+                elif state is False:
+                    liked_ids.discard(message_id)
+
+        return liked_ids
+
+    def metrics(self):
+        """Event, coalescing and flush counters for this worker."""
+
+        with self._lock:
+            return {**self._metrics, 'pending': len(self._pending)}
+
+    ##########################################################################
+    # Flushing
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write everything pending in one transaction."""
+
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    # Segments queued with nothing pending (e.g. orphans
+                    # holding only a torn line) have nothing left to write.
+                    drained, self._segments = self._segments, []
+                else:
+                    drained = None
+                    pending, self._pending = self._pending, {}
+                    recount, self._recount = self._recount, False
+                    segments = self._rotate_segment()
+
+            if drained is not None:
+                _remove_segments(drained)
+                return
+
+            started = time.perf_counter()
+
+            try:
+                with self.app.app_context():
+                    written = apply_like_states(pending, recount=recount)
+                    db.session.commit()
+                    db.session.remove()
+            except Exception:
+                logger.exception("like buffer flush failed; will retry")
+                with self._lock:
+                    self._metrics['errors'] += 1
+                    # Keep newer states recorded during the failed flush.
+                    self._pending = {**pending, **self._pending}
+                    self._segments = segments + self._segments
+                    self._recount = self._recount or recount
+                return
+
+            _remove_segments(segments)
+
+            with self._lock:
+                self._metrics['flushes'] += 1
+                self._metrics['rows_written'] += written
+                self._metrics['last_flush_ms'] = round(
+                    (time.perf_counter() - started) * 1000, 2)
+                metrics = {**self._metrics, 'pending': len(self._pending)}
+
+            logger.debug(json.dumps({'flushed': len(pending), **metrics}))
+
+    def close(self):
+        """Flush on shutdown."""
+
+        self.flush()
+
+    ##########################################################################
+    # Journal
+
+    def _open_segment(self):
+        # Locked under a name replay ignores, then renamed into place, so a
+        # starting worker never sees a segment its owner hasn't locked yet.
+        path = os.path.join(self.journal_dir,
+                            f"likes-{os.getpid()}-{time.time_ns()}.journal")
+        handle = open(path + '.tmp', 'a')
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        os.rename(path + '.tmp', path)
+        self._journal = (path, handle)
+
+    def _rotate_segment(self):
+        """Start a new journal segment; return the segments being flushed."""
+
+        if self._journal is None:
+            return []
+
+        segments = self._segments + [self._journal]
+        self._segments = []
+        self._open_segment()
+        return segments
+
+    def _write_journal(self, user_id, message_id, liked):
+        if self._journal is None:
+            return
+
+        handle = self._journal[1]
+        handle.write(f"{user_id} {message_id} {int(liked)}\n")
+        handle.flush()
+        if self.fsync:
+            os.fsync(handle.fileno())
+
+    def _replay_orphans(self):
+        """Queue the events of journals left behind by dead workers."""
+
+        # Empty segments from workers that died between creating one and
+        # renaming it into place (a fresh one may be mid-rename).
+        for path in glob.glob(os.path.join(self.journal_dir,
+                                           '*.journal.tmp')):
+            try:
+                if time.time() - os.path.getmtime(path) > STALE_SEGMENT_SECONDS:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        for path in sorted(glob.glob(os.path.join(self.journal_dir,
+                                                  '*.journal'))):
+            if path == self._journal[0]:
+                continue
+
+            handle = open(path)
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                handle.close()  # still owned by a live worker
+                continue
+
+            with self._lock:
+                for line in handle:
+                    try:
+                        user_id, message_id, liked = map(int, line.split())
+                    except ValueError:
+                        continue  # torn final line
+                    self._pending[(user_id, message_id)] = bool(liked)
+                    self._metrics['replayed'] += 1
+                    self._recount = True
+                self._segments.append((path, handle))
+
+        self.flush()
+
+
+def _remove_segments(segments):
+    for path, handle in segments:
+        handle.close()
+        os.remove(path)
+
+
+def apply_like_states(states, recount=False):
+    """Set each (user_id, message_id) -> liked state; return rows changed.
+
+    Likes on messages or by users deleted since the click are dropped.
+    Message like counts and buckets get only the changes actually made, so
+    applying the same states twice leaves them correct. With `recount`
+    (journal replay), the messages involved are also recounted from the
+    likes table. Users' likes_count is always recounted (an index-only
+    read of their likes).
+    """
+
+    keys = list(states)
+    existing = set(db.session.query(Like.user_id, Like.message_id)
+                   .filter(tuple_(Like.user_id, Like.message_id).in_(keys)))
+
+    unlikes = [key for key in keys if not states[key] and key in existing]
+    likes = [key for key in keys if states[key] and key not in existing]
+
+    # The SELECT above only narrows down what to write: another worker may
+    # change the same likes before the statements below run, so the counts
+    # come from the rows the statements actually changed.
+    removed = _delete_likes(unlikes) if unlikes else []
+
+    if likes:
+        message_ids = {found for (found,) in db.session.query(Message.id)
+                       .filter(Message.id.in_({message_id
+                                               for _, message_id in likes}))}
+        user_ids = {found for (found,) in db.session.query(User.id)
+                    .filter(User.id.in_({user_id for user_id, _ in likes}))}
+
+        likes = [(user_id, message_id) for user_id, message_id in likes
+                 if user_id in user_ids and message_id in message_ids]
+
+    added = _insert_likes(likes) if likes else []
+
+    deltas = Counter(added)
+    deltas.subtract(removed)
+
+    User.recount({user_id for user_id, _ in keys}, counters=['likes_count'])
+    Message.adjust_like_counts(deltas)
+    if recount:
+        Message.recount_likes({message_id for _, message_id in keys})
+
+    return len(added) + len(removed)
+
+
+def _by_message(keys):
+    """Group (user_id, message_id) keys as (message_id, [user_id, ...])."""
+
+    for message_id, group in groupby(sorted(keys, key=itemgetter(1)),
+                                     key=itemgetter(1)):
+        yield message_id, [user_id for user_id, _ in group]
+
+
+def _insert_likes(keys):
+    """Insert likes; return the message id of every row actually added.
+
+    One statement with RETURNING where the dialect supports it, otherwise
+    one per message, counted by its rowcount.
+    """
+
+    rows = [dict(user_id=user_id, message_id=message_id)
+            for user_id, message_id in keys]
+
+    if db.engine.dialect.full_returning:
+        statement = (upsert(Like).values(rows).on_conflict_do_nothing()
+                     .returning(Like.message_id))
+        return [message_id for (message_id,) in db.session.execute(statement)]
+
+    added = []
+    for message_id, user_ids in _by_message(keys):
+        added += [message_id] * insert_ignoring_conflicts(
+            Like, [dict(user_id=user_id, message_id=message_id)
+                   for user_id in user_ids])
+    return added
+
+
+def _delete_likes(keys):
+    """Delete likes; return the message id of every row actually removed."""
+
+    if db.engine.dialect.full_returning:
+        statement = (delete(Like)
+                     .where(tuple_(Like.user_id, Like.message_id).in_(keys))
+                     .returning(Like.message_id))
+        return [message_id for (message_id,) in db.session.execute(statement)]
+
+    removed = []
+    for message_id, user_ids in _by_message(keys):
+        removed += [message_id] * db.session.execute(
+            delete(Like).where(Like.message_id == message_id,
+                               Like.user_id.in_(user_ids))).rowcount
+    return removed
+
+
+##############################################################################
+# Session overlay (read-your-writes across workers)
+
+
+def remember_pending_like(session, message_id, liked):
+    """Note a buffered like state in the viewer's session for a few seconds."""
+
+    now = time.time()
+    pending = {key: value for key, value in session.get(SESSION_KEY, {}).items()
+               if value[1] > now}
+    pending[str(message_id)] = [liked, now + SESSION_OVERLAY_SECONDS]
+
+    if len(pending) > SESSION_OVERLAY_MAX:
+        newest = sorted(pending.items(), key=lambda item: item[1][1])
+        pending = dict(newest[-SESSION_OVERLAY_MAX:])
+
+    session[SESSION_KEY] = pending
+
+
+def session_overlay(session, message_ids, liked_ids):
+    """`liked_ids` with the session's unexpired pending states applied."""
+
+    pending = session.get(SESSION_KEY)
+    if not pending:
+        return liked_ids
+
+    now = time.time()
+    liked_ids = set(liked_ids)
+
+    for message_id in message_ids:
+        state = pending.get(str(message_id))
+        if state and state[1] > now:
+            if state[0]:
+                liked_ids.add(message_id)
+            else:
+                liked_ids.discard(message_id)
+
+    return liked_ids
+
+
+like_buffer = LikeBuffer()
@@ -0,0 +1,88 @@
+"""Add the denormalized counter columns to an existing database.
+
+`db.create_all()` never alters tables that already exist, so databases
+created before the counters were introduced need them added. For each
+missing column this runs
+
+    ALTER TABLE <table> ADD COLUMN <column> INTEGER NOT NULL DEFAULT 0
+
+creates the indexes added to existing tables since (the ones the counters
+are maintained through, the profile timeline's and the following list's),
+e.g.
+
+    CREATE INDEX ix_likes_message ON likes (message_id)
+
+and then fills the new counters from the source tables (the same repairs
+as `flask recount-users` and `flask recount-likes`):
+
+    python migrate_counters.py
+
+It runs in a single transaction and is a no-op on a migrated database.
+"""
+
+import sys
+
+from sqlalchemy import inspect, text
+
+from app import db
+from models import Follows, Like, Message, User
+
+# Columns added to tables that predate them, by table.
+COUNTER_COLUMNS = {
+    'users': ['message_count', 'following_count', 'follower_count',
+              'likes_count', 'profile_version', 'state_version'],
+    'messages': ['like_count'],
+}
+
+# Tables whose indexes may postdate them.
+INDEXED_TABLES = [Like.__table__, Message.__table__, Follows.__table__]
+
+
+def missing_columns(table, columns):
+    existing = {column['name']
+                for column in inspect(db.engine).get_columns(table)}
+    return [column for column in columns if column not in existing]
+
+
+def missing_indexes(table):
+    existing = {index['name']
+                for index in inspect(db.engine).get_indexes(table.name)}
+    return [index for index in table.indexes if index.name not in existing]
+
+
+def migrate():
+    added = {table: missing_columns(table, columns)
+             for table, columns in COUNTER_COLUMNS.items()}
+    indexes = [index for table in INDEXED_TABLES
+               for index in missing_indexes(table)]
+
+    if not any(added.values()) and not indexes:
+        print("Counter columns are already migrated.", file=sys.stderr)
+        return
+
+    for table, columns in added.items():
+        for column in columns:
+            db.session.execute(text(
+                f"ALTER TABLE {table} ADD COLUMN {column} "
+                "INTEGER NOT NULL DEFAULT 0"))
+
+    bind = db.session.connection()
+    for index in indexes:
+        index.create(bind)
+
+    if added['users']:
+        User.recount()
+    if added['messages']:
+        Message.recount_likes()
+
+    db.session.commit()
+
+    print("Added " + ", ".join(
+        [f"{table}.{column}" for table, columns in added.items()
+         for column in columns]
+        + [f"index {index.name}" for index in indexes]) + ".",
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    migrate()
@@ -0,0 +1,76 @@
+"""Migrate direct messages to the conversation model.
+
+Older databases store `direct_messages.recipient_id` as the recipient's
+username (text) and have no conversations. This script, run once against
+Postgres:
+
+1. creates the conversations / conversation_participants tables
+2. converts recipient_id to an integer foreign key to users, deleting
+   messages whose recipient username no longer exists
+3. adds direct_messages.conversation_id and builds every conversation
+   from the existing messages (existing history counts as read)
+
+    python migrate_direct_messages.py
+
+It runs in a single transaction and is a no-op on a migrated database.
+"""
+
+import sys
+
+from sqlalchemy import inspect, text
+
+from app import db
+from models import Conversation, ConversationParticipant, DirectMessage
+
+
+def recipient_is_username():
+    columns = {column['name']: column
+               for column in inspect(db.engine).get_columns('direct_messages')}
+    return not str(columns['recipient_id']['type']).startswith('INTEGER')
+
+
+def migrate():
+    if db.engine.dialect.name != 'postgresql':
+        sys.exit("migrate_direct_messages.py only supports Postgres; "
+                 "other databases can be recreated with seed.py.")
+
+    if not recipient_is_username():
+        print("direct_messages is already migrated.", file=sys.stderr)
+        return
+
+    bind = db.session.connection()
+    Conversation.__table__.create(bind, checkfirst=True)
+    ConversationParticipant.__table__.create(bind, checkfirst=True)
+
+    statements = [
+        # recipient username -> user id
+        "ALTER TABLE direct_messages ADD COLUMN recipient_user_id INTEGER",
+        "UPDATE direct_messages SET recipient_user_id = users.id "
+        "FROM users WHERE users.username = direct_messages.recipient_id",
+        "DELETE FROM direct_messages WHERE recipient_user_id IS NULL",
+        "ALTER TABLE direct_messages DROP COLUMN recipient_id",
+        "ALTER TABLE direct_messages "
+        "RENAME COLUMN recipient_user_id TO recipient_id",
+        "ALTER TABLE direct_messages ALTER COLUMN recipient_id SET NOT NULL",
+        "ALTER TABLE direct_messages ADD FOREIGN KEY (recipient_id) "
+        "REFERENCES users (id) ON DELETE CASCADE",
+
+        "ALTER TABLE direct_messages ADD COLUMN conversation_id INTEGER "
+        "REFERENCES conversations (id) ON DELETE CASCADE",
+    ]
+
+    for statement in statements:
+        db.session.execute(text(statement))
+
+    for index in DirectMessage.__table__.indexes:
+        index.create(bind, checkfirst=True)
+
+    Conversation.rebuild()
+    db.session.commit()
+
+    print(f"Migrated {DirectMessage.query.count():,} direct messages into "
+          f"{Conversation.query.count():,} conversations.", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    migrate()
@@ -1,13 +1,57 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import case, delete, func, insert, literal, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+
+from hashing import hasher
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# How many of a newly-followed user's messages get copied into the
+# follower's timeline (older messages are not backfilled).
+TIMELINE_BACKFILL_LIMIT = 800
+
+# Leaderboard windows (name -> length) and how many messages each keeps.
+LEADERBOARD_WINDOWS = {'24h': timedelta(hours=24), '7d': timedelta(days=7)}
+LEADERBOARD_SIZE = 50
+
+
+def upsert(model):
+    """An INSERT for `model` that supports ON CONFLICT clauses."""
+
+    dialect = db.engine.dialect.name
+    dialect_insert = {'postgresql': postgresql.insert,
+                      'sqlite': sqlite.insert}.get(dialect)
+
+    if dialect_insert is None:
+        raise NotImplementedError(f"ON CONFLICT is not supported on {dialect}")
+
+    return dialect_insert(model)
+
+
+def insert_ignoring_conflicts(model, rows):
+    """INSERT `rows` (a dict, or a list of dicts) except any that exist.
+
+    One statement (ON CONFLICT DO NOTHING) instead of read-then-write, so
+    repeated or concurrent requests can't double-insert or fail. Returns
+    the number of rows added.
+    """
+
+    statement = upsert(model).values(rows).on_conflict_do_nothing()
+    return db.session.execute(statement).rowcount
+
+
+def delete_by_key(model, **key):
+    """DELETE the row with primary key `key`; True if a row was removed."""
+
+    statement = delete(model).filter_by(**key)
+    return db.session.execute(statement).rowcount == 1
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -26,6 +70,50 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key leads with the followed user; this covers lookups by
+    # follower (following lists, following counts). Without it User.recount
+    # scans all of follows once per user, which loading the generator's
+    # datasets (generator/synthetic.py) made unworkable.
+    __table_args__ = (
+        db.Index('ix_follows_following',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def add(cls, follower_id, followed_id):
+        """Follow; True if this created the follow."""
+
+        return insert_ignoring_conflicts(
+            cls, dict(user_following_id=follower_id,
+                      user_being_followed_id=followed_id)) == 1
+
+    @classmethod
+    def remove(cls, follower_id, followed_id):
+        """Unfollow; True if there was a follow to remove."""
+
+        return delete_by_key(cls,
+                             user_following_id=follower_id,
+                             user_being_followed_id=followed_id)
+
+    @classmethod
+    def followed_ids_among(cls, follower_id, user_ids):
+        """Which of `user_ids` does user `follower_id` follow?
+
+        One indexed query for a whole page of users, returned as a set so
+        templates can test membership per card.
+        """
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+
+        rows = (db.session.query(cls.user_being_followed_id)
+                .filter(cls.user_following_id == follower_id,
+                        cls.user_being_followed_id.in_(user_ids)))
+
+        return {user_id for (user_id,) in rows}
+
+
 class DirectMessage(db.Model):
     """An individual direct message ("warble")."""
 
@@ -52,12 +140,291 @@ class DirectMessage(db.Model):
         db.ForeignKey('users.id', ondelete='CASCADE'),
         nullable=False,
     )
+
     recipient_id = db.Column(
-        db.Text,
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
         nullable=False,
     )
-    
-    
+
+    # Set by `send`; bulk loads fill it in with Conversation.rebuild().
+    conversation_id = db.Column(
+        db.Integer,
+        db.ForeignKey('conversations.id', ondelete='CASCADE'),
+    )
+
+    recipient = db.relationship('User', foreign_keys=[recipient_id])
+
+    __table_args__ = (
+        db.Index('ix_direct_messages_conversation_timestamp',
+                 'conversation_id', 'timestamp', 'id'),
+    )
+
+    @classmethod
+    def with_author(cls):
+        """Query direct messages with their sender's card eager-loaded."""
+
+        return cls.query.options(author_card(cls.user))
+
+    @classmethod
+    def send(cls, sender_id, recipient_id, text):
+        """Send a message, updating the conversation and unread counts.
+
+        The caller commits.
+        """
+
+        conversation = Conversation.between(sender_id, recipient_id)
+        message = cls(text=text,
+                      user_id=sender_id,
+                      recipient_id=recipient_id,
+                      conversation_id=conversation.id,
+                      timestamp=datetime.utcnow())
+        db.session.add(message)
+
+        conversation.last_message_at = message.timestamp
+        conversation.last_message_preview = text
+
+        # Both participants in one statement: the sender has read up to
+        # their own message, the recipient has one more unread.
+        ConversationParticipant.query.filter_by(
+            conversation_id=conversation.id,
+        ).update({
+            ConversationParticipant.last_message_at: message.timestamp,
+            ConversationParticipant.unread_count: (
+                ConversationParticipant.unread_count
+                + case((ConversationParticipant.user_id == recipient_id, 1),
+                       else_=0)),
+            ConversationParticipant.last_read_at: case(
+                (ConversationParticipant.user_id == sender_id,
+                 message.timestamp),
+                else_=ConversationParticipant.last_read_at),
+        }, synchronize_session=False)
+
+        return message
+
+
+class Conversation(db.Model):
+    """A one-to-one direct message thread between two users."""
+
+    __tablename__ = 'conversations'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # The two users, lower id first, so each pair has exactly one row.
+    user_low_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    user_high_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    last_message_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    last_message_preview = db.Column(
+        db.String(140),
+        nullable=False,
+        default='',
+    )
+
+    __table_args__ = (
+        db.UniqueConstraint('user_low_id', 'user_high_id'),
+    )
+
+    @classmethod
+    def find(cls, user_id, other_id):
+        """The conversation between two users, or None."""
+
+        low, high = sorted((user_id, other_id))
+        return cls.query.filter_by(user_low_id=low,
+                                   user_high_id=high).one_or_none()
+
+    @classmethod
+    def between(cls, user_id, other_id):
+        """Get or create the conversation between two users."""
+
+        conversation = cls.find(user_id, other_id)
+        if conversation is not None:
+            return conversation
+
+        low, high = sorted((user_id, other_id))
+        conversation = cls(user_low_id=low, user_high_id=high)
+
+        try:
+            with db.session.begin_nested():
+                db.session.add(conversation)
+                db.session.flush()
+                db.session.add_all([
+                    ConversationParticipant(conversation_id=conversation.id,
+                                            user_id=user_id,
+                                            other_user_id=other_id),
+                    ConversationParticipant(conversation_id=conversation.id,
+                                            user_id=other_id,
+                                            other_user_id=user_id),
+                ])
+        except IntegrityError:
+            # created concurrently by the other participant
+            return cls.find(user_id, other_id)
+
+        return conversation
+
+    @classmethod
+    def rebuild(cls):
+        """Re-derive every conversation from the direct_messages table.
+
+        Used after bulk loads and by the direct message migration; history
+        loaded this way counts as read.
+        """
+
+        low = case((DirectMessage.user_id < DirectMessage.recipient_id,
+                    DirectMessage.user_id),
+                   else_=DirectMessage.recipient_id)
+        high = case((DirectMessage.user_id < DirectMessage.recipient_id,
+                     DirectMessage.recipient_id),
+                    else_=DirectMessage.user_id)
+
+        DirectMessage.query.update({DirectMessage.conversation_id: None},
+                                   synchronize_session=False)
+        ConversationParticipant.query.delete(synchronize_session=False)
+        cls.query.delete(synchronize_session=False)
+
+        pairs = (select(low, high,
+                        func.min(DirectMessage.timestamp),
+                        func.max(DirectMessage.timestamp),
+                        literal(''))
+                 .group_by(low, high))
+        db.session.execute(insert(cls).from_select(
+            ['user_low_id', 'user_high_id', 'created_at', 'last_message_at',
+             'last_message_preview'],
+            pairs))
+
+        DirectMessage.query.update({
+            DirectMessage.conversation_id: (
+                select(cls.id)
+                .where(cls.user_low_id == low, cls.user_high_id == high)
+                .scalar_subquery()),
+        }, synchronize_session=False)
+
+        cls.query.update({
+            cls.last_message_preview: (
+                select(DirectMessage.text)
+                .where(DirectMessage.conversation_id == cls.id)
+                .order_by(DirectMessage.timestamp.desc(),
+                          DirectMessage.id.desc())
+                .limit(1)
+                .scalar_subquery()),
+        }, synchronize_session=False)
+
+        participant_cols = ['conversation_id', 'user_id', 'other_user_id',
+                            'last_message_at', 'last_read_at', 'unread_count']
+        for user_col, other_col in [(cls.user_low_id, cls.user_high_id),
+                                    (cls.user_high_id, cls.user_low_id)]:
+            participants = select(cls.id, user_col, other_col,
+                                  cls.last_message_at, cls.last_message_at,
+                                  literal(0))
+            if user_col is cls.user_high_id:
+                # one row for a user's notes-to-self conversation
+                participants = participants.where(
+                    cls.user_low_id != cls.user_high_id)
+
+            db.session.execute(insert(ConversationParticipant).from_select(
+                participant_cols, participants))
+
+
+class ConversationParticipant(db.Model):
+    """One user's side of a Conversation: their inbox entry.
+
+    Indexed by (user_id, last_message_at) so the inbox is a keyset range
+    scan, and carries the user's unread count for the thread.
+    """
+
+    __tablename__ = 'conversation_participants'
+
+    conversation_id = db.Column(
+        db.Integer,
+        db.ForeignKey('conversations.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    other_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    last_message_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    last_read_at = db.Column(
+        db.DateTime,
+    )
+
+    unread_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    conversation = db.relationship('Conversation')
+    other_user = db.relationship('User', foreign_keys=[other_user_id])
+
+    __table_args__ = (
+        db.Index('ix_conversation_participants_inbox',
+                 'user_id', 'last_message_at', 'conversation_id'),
+    )
+
+    @classmethod
+    def inbox(cls, user_id):
+        """Query `user_id`'s conversations, with the other user's card."""
+
+        return (cls.query
+                .filter(cls.user_id == user_id)
+                .options(author_card(cls.other_user),
+                         joinedload(cls.conversation)))
+
+    @classmethod
+    def total_unread(cls, user_id):
+        return (db.session.query(func.coalesce(func.sum(cls.unread_count), 0))
+                .filter(cls.user_id == user_id)
+                .scalar())
+
+    @classmethod
+    def mark_read(cls, conversation_id, user_id):
+        """Clear `user_id`'s unread count for a conversation."""
+
+        (cls.query
+         .filter_by(conversation_id=conversation_id, user_id=user_id)
+         .update({cls.unread_count: 0,
+                  cls.last_read_at: datetime.utcnow()},
+                 synchronize_session=False))
+
 
 class User(db.Model):
     """User in the system."""
@@ -104,6 +471,55 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counters, maintained by the write paths in app.py via
+    # `adjust_counts` (and repairable with `recount`).
+
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever the username/avatar shown on message cards changes;
+    # part of the rendered-card cache key.
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped on any change to this user's profile or counters; part of
+    # the ETags of pages that show them (see http_caching.py).
+    state_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message', order_by='Message.timestamp.desc()')
     likes = db.relationship('Message', secondary='likes')   
     
@@ -121,7 +537,9 @@ class User(db.Model):
         secondaryjoin=(Follows.user_being_followed_id == id)
     )
     
-    direct_messages = db.relationship('DirectMessage', backref='user')
+    direct_messages = db.relationship('DirectMessage',
+                                      backref='user',
+                                      foreign_keys='DirectMessage.user_id')
     
     # direct_messages_sent = db.relationship(
     #     "User",
@@ -146,14 +564,92 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return bool(self.following_ids_among([other_user.id]))
+
+    def following_ids_among(self, user_ids):
+        """Which of `user_ids` does this user follow?"""
+
+        return Follows.followed_ids_among(self.id, user_ids)
+
+    def liked_ids_among(self, message_ids):
+        """Which of `message_ids` has this user liked?"""
+
+        return Like.liked_ids_among(self.id, message_ids)
+
+    def counter_dependent_ids(self):
+        """Ids of other users whose counters include this user's rows.
+
+        (Followers, followed users and likers of this user's messages.)
+        """
+
+        followers = select(Follows.user_following_id).where(
+            Follows.user_being_followed_id == self.id)
+        following = select(Follows.user_being_followed_id).where(
+            Follows.user_following_id == self.id)
+        likers = (select(Like.user_id)
+                  .join(Message, Message.id == Like.message_id)
+                  .where(Message.user_id == self.id))
+
+        rows = db.session.execute(followers.union(following, likers))
+        return {user_id for (user_id,) in rows} - {self.id}
+
+    @classmethod
+    def adjust_counts(cls, user_id, **deltas):
+        """Atomically add `deltas` to a user's counters.
+
+        e.g. User.adjust_counts(5, message_count=1). The UPDATE runs in the
+        caller's transaction, so it commits along with the write it counts.
+        Also bumps the user's state_version.
+        """
+
+        values = {getattr(cls, name): getattr(cls, name) + delta
+                  for name, delta in deltas.items()}
+        values[cls.state_version] = cls.state_version + 1
+
+        (cls.query
+         .filter(cls.id == user_id)
+         .update(values, synchronize_session=False))
+
+    @classmethod
+    def recount(cls, user_ids=None, counters=None):
+        """Recompute counters from the source tables.
+
+        Recounts every user, or only those in `user_ids`; every counter, or
+        only those named in `counters`.
+        """
+
+        counts = {
+            cls.message_count: (select(func.count(Message.id))
+                                .where(Message.user_id == cls.id)
+                                .scalar_subquery()),
+            cls.following_count: (select(func.count())
+                                  .select_from(Follows)
+                                  .where(Follows.user_following_id == cls.id)
+                                  .scalar_subquery()),
+            cls.follower_count: (select(func.count())
+                                 .select_from(Follows)
+                                 .where(Follows.user_being_followed_id == cls.id)
+                                 .scalar_subquery()),
+            cls.likes_count: (select(func.count())
+                              .select_from(Like)
+                              .where(Like.user_id == cls.id)
+                              .scalar_subquery()),
+        }
+        if counters is not None:
+            counts = {column: value for column, value in counts.items()
+                      if column.key in counters}
+        counts[cls.state_version] = cls.state_version + 1
+
+        query = cls.query
+        if user_ids is not None:
+            query = query.filter(cls.id.in_(list(user_ids)))
+
+        query.update(counts, synchronize_session=False)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -162,7 +658,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -187,13 +683,27 @@ class User(db.Model):
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
+    def check_password(self, password):
+        """Does `password` match this user's password?
+
+        If it does and the stored hash was made at a different bcrypt cost
+        than the configured one, the password is rehashed (the caller
+        commits the session).
+        """
+
+        if not hasher.check(self.password, password):
+            return False
+
+        if hasher.needs_rehash(self.password):
+            self.password = hasher.hash(password)
+
+        return True
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -222,9 +732,65 @@ class Message(db.Model):
         nullable=False,
     )
 
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
-    
 
+    __table_args__ = (
+        db.Index('ix_messages_user_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
+    @classmethod
+    def with_author(cls):
+        """Query messages with their author's card eager-loaded.
+
+        Timeline-style pages touch msg.user on every row; this loads the
+        authors in the same SELECT instead of one lazy load per message.
+        """
+
+        return cls.query.options(author_card(cls.user))
+
+    @classmethod
+    def adjust_like_counts(cls, deltas):
+        """Apply {message_id: change in likes} to counters and buckets.
+
+        Runs in the caller's transaction, alongside the likes it counts.
+        """
+
+        deltas = {message_id: delta for message_id, delta in deltas.items()
+                  if delta}
+        if not deltas:
+            return
+
+        (cls.query
+         .filter(cls.id.in_(list(deltas)))
+         .update({cls.like_count: cls.like_count + case(deltas, value=cls.id)},
+                 synchronize_session=False))
+
+        LikeBucket.add(deltas)
+
+    @classmethod
+    def recount_likes(cls, message_ids=None):
+        """Recompute like_count from the likes table.
+
+        Recounts every message, or only those in `message_ids`.
+        """
+
+        count = (select(func.count())
+                 .select_from(Like)
+                 .where(Like.message_id == cls.id)
+                 .scalar_subquery())
+
+        query = cls.query
+        if message_ids is not None:
+            query = query.filter(cls.id.in_(list(message_ids)))
+
+        query.update({cls.like_count: count}, synchronize_session=False)
 
 
 class Like(db.Model):
@@ -244,6 +810,369 @@ class Like(db.Model):
         primary_key=True,
     )
 
+    # The primary key leads with the user; this covers lookups by message
+    # (like counts, recounts, the message-delete cascade).
+    __table_args__ = (
+        db.Index('ix_likes_message', 'message_id'),
+    )
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Like a message; True if this created the like."""
+
+        return insert_ignoring_conflicts(
+            cls, dict(user_id=user_id, message_id=message_id)) == 1
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Unlike a message; True if there was a like to remove."""
+
+        return delete_by_key(cls, user_id=user_id, message_id=message_id)
+
+    @classmethod
+    def liked_ids_among(cls, user_id, message_ids):
+        """Which of `message_ids` has user `user_id` liked?
+
+        One query restricted to the messages being rendered, instead of
+        loading the user's whole `likes` relationship.
+        """
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set()
+
+        rows = (db.session.query(cls.message_id)
+                .filter(cls.user_id == user_id,
+                        cls.message_id.in_(message_ids)))
+
+        return {message_id for (message_id,) in rows}
+
+
+class LikeBucket(db.Model):
+    """Net likes a message gained during one hour.
+
+    Maintained with every like/unlike, so a leaderboard window is a sum over
+    a few hours of buckets rather than a scan of the likes table.
+    """
+
+    __tablename__ = 'like_buckets'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    hour = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    likes = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_like_buckets_hour', 'hour', 'message_id'),
+    )
+
+    @staticmethod
+    def hour_of(when):
+        return when.replace(minute=0, second=0, microsecond=0)
+
+    @classmethod
+    def add(cls, deltas, when=None):
+        """Add {message_id: change in likes} to the current hour's buckets."""
+
+        if not deltas:
+            return
+
+        hour = cls.hour_of(when or datetime.utcnow())
+        rows = [dict(message_id=message_id, hour=hour, likes=delta)
+                for message_id, delta in deltas.items()]
+
+        statement = upsert(cls).values(rows)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[cls.message_id, cls.hour],
+            set_={'likes': cls.likes + statement.excluded.likes}))
+
+    @classmethod
+    def prune(cls, before):
+        """Drop buckets older than every leaderboard window."""
+
+        (cls.query
+         .filter(cls.hour < cls.hour_of(before))
+         .delete(synchronize_session=False))
+
+
+class TopMessage(db.Model):
+    """A precomputed leaderboard row: the most liked messages per window.
+
+    Rebuilt by TopMessage.refresh() (`flask refresh-leaderboard`, run on a
+    schedule), so the /top page is a primary key range read.
+    """
+
+    __tablename__ = 'top_messages'
+
+    window = db.Column(
+        db.String(8),
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    likes = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    refreshed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    message = db.relationship('Message')
+
+    @classmethod
+    def refresh(cls, now=None, size=LEADERBOARD_SIZE):
+        """Recompute every window from the like buckets."""
+
+        now = now or datetime.utcnow()
+
+        for window, length in LEADERBOARD_WINDOWS.items():
+            # The current hour's bucket is partial, so a window covers it
+            # plus the previous `length` worth of whole hours.
+            since = LikeBucket.hour_of(now - length)
+            likes = func.sum(LikeBucket.likes)
+            top = (db.session.query(LikeBucket.message_id, likes)
+                   .filter(LikeBucket.hour >= since)
+                   .group_by(LikeBucket.message_id)
+                   .having(likes > 0)
+                   .order_by(likes.desc(), LikeBucket.message_id.desc())
+                   .limit(size)
+                   .all())
+
+            cls.query.filter_by(window=window).delete()
+            db.session.bulk_insert_mappings(cls, [
+                dict(window=window, rank=rank, message_id=message_id,
+                     likes=count, refreshed_at=now)
+                for rank, (message_id, count) in enumerate(top, 1)])
+
+        LikeBucket.prune(now - max(LEADERBOARD_WINDOWS.values()))
+
+    @classmethod
+    def leaderboard(cls, window):
+        """The `window` leaderboard, with messages and authors loaded."""
+
+        return (cls.query
+                .options(joinedload(cls.message).options(
+                    author_card(Message.user)))
+                .filter_by(window=window)
+                .order_by(cls.rank))
+
+
+class Recommendation(db.Model):
+    """A precomputed who-to-follow suggestion.
+
+    Written in bulk by the offline job in recommendations.py: for each user,
+    the top accounts followed by the accounts they follow, scored by how
+    many of those follow them.
+    """
+
+    __tablename__ = 'recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    candidate_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # The user's state_version when computed; the job's --stale mode
+    # recomputes users whose version has moved on since.
+    source_version = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    candidate = db.relationship('User', foreign_keys=[candidate_id])
+
+    @classmethod
+    def for_user(cls, user_id, limit):
+        """`user_id`'s suggestions, best first, minus anyone now followed."""
+
+        followed = (select(Follows.user_being_followed_id)
+                    .where(Follows.user_following_id == user_id,
+                           Follows.user_being_followed_id == cls.candidate_id))
+
+        return (cls.query
+                .options(author_card(cls.candidate))
+                .filter(cls.user_id == user_id, ~followed.exists())
+                .order_by(cls.rank)
+                .limit(limit))
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline.
+
+    Rows are written when a message is posted (fan-out to the author and
+    their followers) and when a user follows/unfollows someone, so the
+    homepage is a single range read on (user_id, timestamp).
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        db.Index('ix_timeline_entries_user_author', 'user_id', 'author_id'),
+    )
+
+    @classmethod
+    def fan_out(cls, message):
+        """Add a (flushed) message to its author's and followers' timelines."""
+
+        followers = (select(Follows.user_following_id,
+                            literal(message.id),
+                            literal(message.user_id),
+                            literal(message.timestamp))
+                     .where(Follows.user_being_followed_id == message.user_id))
+
+        db.session.add(cls(user_id=message.user_id,
+                           message_id=message.id,
+                           author_id=message.user_id,
+                           timestamp=message.timestamp))
+        db.session.execute(
+            insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                followers))
+
+    @classmethod
+    def backfill(cls, user_id, followed_id, limit=TIMELINE_BACKFILL_LIMIT):
+        """Copy `followed_id`'s most recent messages into `user_id`'s timeline."""
+
+        recent = (select(literal(user_id),
+                         Message.id,
+                         Message.user_id,
+                         Message.timestamp)
+                  .where(Message.user_id == followed_id)
+                  .order_by(Message.timestamp.desc())
+                  .limit(limit))
+
+        db.session.execute(
+            insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                recent))
+
+    @classmethod
+    def purge(cls, user_id, followed_id):
+        """Remove `followed_id`'s messages from `user_id`'s timeline."""
+
+        (cls.query
+         .filter(cls.user_id == user_id, cls.author_id == followed_id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls, limit=TIMELINE_BACKFILL_LIMIT):
+        """Re-materialize every timeline from the messages/follows tables.
+
+        Each timeline gets each author's `limit` most recent messages, as
+        `backfill` gives a new follow. Used after bulk loads (see seed.py)
+        that bypass the write paths, and by `flask rebuild-timelines`.
+        """
+
+        cls.query.delete(synchronize_session=False)
+
+        ranked = (select(Message.id,
+                         Message.user_id,
+                         Message.timestamp,
+                         func.row_number().over(
+                             partition_by=Message.user_id,
+                             order_by=(Message.timestamp.desc(),
+                                       Message.id.desc()),
+                         ).label('position'))
+                  .subquery())
+        recent = (select(ranked.c.id, ranked.c.user_id, ranked.c.timestamp)
+                  .where(ranked.c.position <= limit)
+                  .subquery())
+
+        own = select(recent.c.user_id,
+                     recent.c.id,
+                     recent.c.user_id,
+                     recent.c.timestamp)
+        followed = (select(Follows.user_following_id,
+                           recent.c.id,
+                           recent.c.user_id,
+                           recent.c.timestamp)
+                    .join(recent,
+                          recent.c.user_id == Follows.user_being_followed_id))
+
+        cols = ['user_id', 'message_id', 'author_id', 'timestamp']
+        db.session.execute(insert(cls).from_select(cols, own))
+        db.session.execute(insert(cls).from_select(cols, followed))
+
+
+def author_card(relationship):
+    """Loader option: JOIN-load the user behind `relationship`.
+
+    Only the columns a message card renders (id, username, avatar, and
+    the profile version used to cache the card) are fetched.
+    """
+
+    return (joinedload(relationship)
+            .load_only(User.id,
+                       User.username,
+                       User.image_url,
+                       User.profile_version))
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -253,3 +1182,4 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    hasher.init_app(app)
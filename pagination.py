@@ -0,0 +1,88 @@
+"""Keyset (cursor) pagination helpers.
+
+Pages are ordered newest-first on a (position, id) pair -- usually
+(timestamp, id) -- and the "next" cursor encodes the last row shown, so
+fetching an older page is an index range read rather than an OFFSET scan.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+PAGE_SIZE = 100
+
+
+def encode_cursor(position, row_id):
+    """Encode a (position, id) sort key as an opaque string for URLs."""
+
+    if isinstance(position, datetime):
+        position = position.isoformat()
+
+    return f"{position}_{row_id}"
+
+
+def decode_cursor(cursor, kind=datetime):
+    """Decode a cursor made by `encode_cursor`.
+
+    `kind` is the type of the position (datetime, float, ...). Returns
+    None if the cursor is missing or malformed.
+    """
+
+    try:
+        position, row_id = cursor.rsplit('_', 1)
+        if kind is datetime:
+            position = datetime.fromisoformat(position)
+        else:
+            position = kind(position)
+        return position, int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _timestamp_key(row):
+    return row.timestamp, row.id
+
+
+def paginate(query, position_col, id_col, cursor=None, limit=PAGE_SIZE,
+             key=_timestamp_key, kind=datetime):
+    """Return (rows, next_cursor) for one newest-first page of `query`.
+
+    `position_col`/`id_col` are the columns the query is ordered by;
+    `key(row)` must return the same pair for a fetched row. `next_cursor`
+    is None on the last page.
+    """
+
+    after = decode_cursor(cursor, kind) if cursor else None
+    if after:
+        query = query.filter(tuple_(position_col, id_col) < tuple_(*after))
+
+    rows = (query
+            .order_by(position_col.desc(), id_col.desc())
+            .limit(limit + 1)
+            .all())
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(*key(rows[-1]))
+
+    return rows, None
+
+
+
+def paginate_ids(fetch, cursor=None, limit=PAGE_SIZE):
+    """Return (ids, next_cursor) for one highest-first page of ids.
+
+    For ids held in memory (e.g. the follow graph) rather than queried:
+    `fetch(before, count)` returns up to `count` ids below `before` (None
+    for the first page), highest first. Cursors match `paginate` ordered
+    by (id, id).
+    """
+
+    after = decode_cursor(cursor, int) if cursor else None
+    ids = fetch(after[1] if after else None, limit + 1)
+
+    if len(ids) > limit:
+        ids = ids[:limit]
+        return ids, encode_cursor(ids[-1], ids[-1])
+
+    return ids, None
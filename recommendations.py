@@ -0,0 +1,229 @@
+"""Compute who-to-follow recommendations from the follow graph.
+
+Friends-of-friends scoring: with A the follow matrix (A[u, v] = 1 when u
+follows v), (A @ A)[u, w] is how many of the accounts u follows follow w.
+For each user, the job keeps the TOP_K highest-scoring accounts they don't
+already follow (ties go to the lower user id) in the recommendations
+table, which the profile sidebar and /api/v1/recommendations read.
+
+The follows table is loaded once into a scipy CSR matrix. Users are then
+split into blocks of rows, and each block's sparse product, filtering and
+top-k selection (all vectorized) runs in a pool of worker processes. The
+results of each block are written and committed as they arrive, so
+readers only ever see a user's old or new suggestions, never none.
+
+    python recommendations.py                 # every user
+    python recommendations.py --stale         # only users whose follows
+                                              # changed since their last run
+    python recommendations.py --workers 8 --top-k 20
+
+--stale only looks at each user's own follows (via User.state_version), so
+also run a full pass now and then to pick up new follows further out.
+
+Requires numpy and scipy (the web app doesn't).
+"""
+
+import argparse
+import os
+import sys
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import delete, func, insert, select
+
+from app import db
+from models import Follows, Recommendation, User
+
+TOP_K = 20
+BLOCK_SIZE = 10_000
+LOAD_BATCH_SIZE = 100_000
+DELETE_BATCH_SIZE = 1_000
+
+
+##############################################################################
+# Loading
+
+
+def load_graph():
+    """The follows table as a CSR matrix indexed by user id."""
+
+    size = (db.session.query(func.max(User.id)).scalar() or 0) + 1
+    followers, followed = array('i'), array('i')
+
+    rows = db.session.execute(
+        select(Follows.user_following_id, Follows.user_being_followed_id)
+        .execution_options(stream_results=True))
+
+    for batch in rows.partitions(LOAD_BATCH_SIZE):
+        for follower_id, followed_id in batch:
+            followers.append(follower_id)
+            followed.append(followed_id)
+
+    followers = np.frombuffer(followers, dtype=np.int32)
+    followed = np.frombuffer(followed, dtype=np.int32)
+
+    return sparse.csr_matrix(
+        (np.ones(len(followers), dtype=np.int32), (followers, followed)),
+        shape=(size, size))
+
+
+def users_to_score(graph, stale):
+    """Ids of users who follow someone, and their state versions.
+
+    With `stale`, only users whose state_version differs from the one their
+    current suggestions were computed at (or who have none).
+    """
+
+    versions = dict(db.session.execute(
+        select(User.id, User.state_version)
+        .where(User.following_count > 0)).all())
+
+    if stale:
+        computed = dict(db.session.execute(
+            select(Recommendation.user_id, Recommendation.source_version)
+            .where(Recommendation.rank == 1)).all())
+        versions = {user_id: version for user_id, version in versions.items()
+                    if computed.get(user_id) != version}
+
+    # following_count is denormalized; trust the matrix for who follows.
+    degrees = np.diff(graph.indptr)
+    user_ids = np.array(sorted(user_id for user_id in versions
+                               if user_id < len(degrees) and degrees[user_id]),
+                        dtype=np.int32)
+
+    return user_ids, versions
+
+
+##############################################################################
+# Scoring (runs in the worker processes)
+
+
+_graph = None
+
+
+def _set_graph(indptr, indices, shape):
+    global _graph
+    _graph = sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.int32), indices, indptr), shape=shape)
+
+
+def _init_worker(indptr, indices, shape):
+    # Forked workers must not reuse the parent's pooled connections.
+    db.engine.dispose(close=False)
+    _set_graph(indptr, indices, shape)
+
+
+def score_block(user_ids, top_k):
+    """Top `top_k` friends-of-friends for each of `user_ids` (sorted).
+
+    Returns parallel arrays (user id, rank, candidate id, score).
+    """
+
+    follows = _graph[user_ids]
+    scores = follows @ _graph
+
+    # Drop accounts the user already follows, then the user themselves.
+    scores = scores - scores.multiply(follows)
+    scores.eliminate_zeros()
+    scores = scores.tocoo()
+
+    users = user_ids[scores.row]
+    keep = scores.col != users
+    users, candidates, score = users[keep], scores.col[keep], scores.data[keep]
+
+    # Each user's candidates by score, best first; rank = position in run.
+    order = np.lexsort((candidates, -score, users))
+    users, candidates, score = users[order], candidates[order], score[order]
+    rank = np.arange(len(users)) - np.searchsorted(users, users) + 1
+
+    keep = rank <= top_k
+    return users[keep], rank[keep], candidates[keep], score[keep]
+
+
+def score_blocks(graph, blocks, workers, top_k):
+    """Yield each block's results, in order."""
+
+    initargs = (graph.indptr, graph.indices, graph.shape)
+
+    if workers == 1:
+        _set_graph(*initargs)
+        yield from map(score_block, blocks, repeat(top_k))
+        return
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=initargs) as pool:
+        yield from pool.map(score_block, blocks, repeat(top_k))
+
+
+##############################################################################
+# Writing
+
+
+def save_block(user_ids, results, versions):
+    """Replace the suggestions of `user_ids` with `results`."""
+
+    users, ranks, candidates, scores = results
+
+    for start in range(0, len(user_ids), DELETE_BATCH_SIZE):
+        batch = user_ids[start:start + DELETE_BATCH_SIZE].tolist()
+        db.session.execute(
+            delete(Recommendation)
+            .where(Recommendation.user_id.in_(batch))
+            .execution_options(synchronize_session=False))
+
+    rows = [dict(user_id=user_id, rank=rank, candidate_id=candidate_id,
+                 score=score, source_version=versions[user_id])
+            for user_id, rank, candidate_id, score
+            in zip(users.tolist(), ranks.tolist(), candidates.tolist(),
+                   scores.tolist())]
+    if rows:
+        db.session.execute(insert(Recommendation.__table__), rows)
+
+    db.session.commit()
+    return len(rows)
+
+
+def recommend(stale=False, workers=None, top_k=TOP_K, block_size=BLOCK_SIZE):
+    started = time.monotonic()
+
+    graph = load_graph()
+    user_ids, versions = users_to_score(graph, stale)
+    print(f"Loaded {graph.nnz:,} follows; scoring {len(user_ids):,} users",
+          file=sys.stderr)
+
+    if not stale:
+        # Users who no longer follow anyone have nothing to suggest.
+        db.session.execute(
+            delete(Recommendation)
+            .where(Recommendation.user_id.not_in(
+                select(Follows.user_following_id)))
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+
+    blocks = [user_ids[start:start + block_size]
+              for start in range(0, len(user_ids), block_size)]
+    written = 0
+
+    for block, results in zip(blocks, score_blocks(graph, blocks,
+                                                   workers or os.cpu_count(),
+                                                   top_k)):
+        written += save_block(block, results, versions)
+        print(f"  {block[-1]:,}: {written:,} suggestions "
+              f"({time.monotonic() - started:,.1f}s)", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stale', action='store_true',
+                        help='only users whose follows changed')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes (default: one per CPU)')
+    parser.add_argument('--top-k', type=int, default=TOP_K)
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+    args = parser.parse_args()
+
+    recommend(args.stale, args.workers, args.top_k, args.block_size)
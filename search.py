@@ -0,0 +1,144 @@
+"""User search.
+
+Matches the query against usernames and bios, ranks the results and pages
+through them with a (rank, id) cursor.
+
+On Postgres the matching is backed by a trigram index on username and a
+full-text index on bio, and ranking uses pg_trgm's similarity(); run
+`flask create-search-indexes` once to install the extension and indexes.
+SQLite test databases fall back to LIKE with an equivalent ranking.
+"""
+
+from sqlalchemy import (DDL, Float, case, cast, event, func, or_, text,
+                        tuple_)
+from sqlalchemy.exc import DBAPIError
+
+from models import db, User
+from pagination import decode_cursor, encode_cursor
+
+SEARCH_PAGE_SIZE = 48
+
+USERNAME_INDEX_DDL = (
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+    "ON users USING gin (username gin_trgm_ops)")
+BIO_INDEX_DDL = (
+    "CREATE INDEX IF NOT EXISTS ix_users_bio_tsv "
+    "ON users USING gin (to_tsvector('simple', coalesce(bio, '')))")
+
+POSTGRES_SEARCH_DDL = [USERNAME_INDEX_DDL, BIO_INDEX_DDL]
+
+
+class SearchSetupError(Exception):
+    """The pg_trgm extension is missing and can't be created."""
+
+
+def _has_pg_trgm(ddl, target, bind, **kw):
+    return bind.execute(text(
+        "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+    )).first() is not None
+
+
+# New tables get the indexes as they are created. The trigram index needs
+# pg_trgm, which `create_search_indexes` installs; without it create_all
+# leaves that index out rather than failing.
+event.listen(User.__table__,
+             'after_create',
+             DDL(USERNAME_INDEX_DDL).execute_if(dialect='postgresql',
+                                                callable_=_has_pg_trgm))
+event.listen(User.__table__,
+             'after_create',
+             DDL(BIO_INDEX_DDL).execute_if(dialect='postgresql'))
+
+
+def create_search_indexes():
+    """Add pg_trgm and the Postgres search indexes to an existing database."""
+
+    if db.engine.dialect.name != 'postgresql':
+        return
+
+    try:
+        db.session.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except DBAPIError as error:
+        db.session.rollback()
+        raise SearchSetupError(
+            "Could not create the pg_trgm extension that username search "
+            "needs. Have a superuser (or the database owner) run "
+            "CREATE EXTENSION pg_trgm in this database, then run "
+            "`flask create-search-indexes` again.") from error
+
+    for statement in POSTGRES_SEARCH_DDL:
+        db.session.execute(text(statement))
+
+
+def _escape_like(text):
+    return (text.replace('\\', '\\\\')
+                .replace('%', '\\%')
+                .replace('_', '\\_'))
+
+
+def _match_and_rank(q):
+    """Return (filter clause, rank expression) for search term `q`."""
+
+    contains = f"%{_escape_like(q)}%"
+
+    if db.engine.dialect.name == 'postgresql':
+        bio_tsv = func.to_tsvector('simple', func.coalesce(User.bio, ''))
+        query_tsv = func.plainto_tsquery('simple', q)
+
+        match = or_(User.username.ilike(contains, escape='\\'),
+                    bio_tsv.op('@@')(query_tsv))
+        rank = func.greatest(func.similarity(User.username, q),
+                             func.ts_rank(bio_tsv, query_tsv) * 0.5)
+
+    else:
+        prefix = f"{_escape_like(q)}%"
+
+        match = or_(User.username.like(contains, escape='\\'),
+                    User.bio.like(contains, escape='\\'))
+        rank = case(
+            (func.lower(User.username) == q.lower(), 1.0),
+            (User.username.like(prefix, escape='\\'), 0.75),
+            (User.username.like(contains, escape='\\'), 0.5),
+            else_=0.25,
+        )
+
+    return match, cast(rank, Float)
+
+
+def search_users(q=None, cursor=None, limit=SEARCH_PAGE_SIZE):
+    """Return (users, next_cursor) for one page of user search results.
+
+    With no `q`, pages through all users newest-first. Otherwise returns
+    users whose username or bio matches, best matches first.
+    """
+
+    if not q:
+        query = User.query
+        after = decode_cursor(cursor, int) if cursor else None
+        if after:
+            query = query.filter(User.id < after[1])
+
+        users = query.order_by(User.id.desc()).limit(limit + 1).all()
+        if len(users) > limit:
+            users = users[:limit]
+            return users, encode_cursor(users[-1].id, users[-1].id)
+        return users, None
+
+    match, rank = _match_and_rank(q)
+    query = db.session.query(User, rank.label('rank')).filter(match)
+
+    after = decode_cursor(cursor, float) if cursor else None
+    if after:
+        query = query.filter(tuple_(rank, User.id) < tuple_(*after))
+
+    rows = (query
+            .order_by(rank.desc(), User.id.desc())
+            .limit(limit + 1)
+            .all())
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].rank, rows[-1].User.id)
+
+    return [row.User for row in rows], next_cursor
@@ -1,19 +1,293 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+Streams each CSV into its table in fixed-size chunks, committing after
+every chunk:
+
+- on Postgres each chunk goes in with COPY FROM STDIN
+- elsewhere each chunk is one batched (executemany) INSERT
+
+Secondary indexes and foreign keys are dropped before loading and
+rebuilt once the data is in, then timelines, conversations and user and
+like counters are materialized.
+
+Progress is recorded in the seed_progress table in the same transaction
+as each chunk, so an interrupted load can pick up where it stopped:
+
+    python seed.py                  # fresh load (drops all tables)
+    python seed.py --resume         # continue an interrupted load
+
+likes.csv and direct_messages.csv are loaded too when present.
+"""
+
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+from datetime import datetime
+
+from sqlalchemy import (Boolean, Column, DateTime, Integer, MetaData, String,
+                        Table, inspect, insert, select, text)
+from sqlalchemy.schema import AddConstraint
 
-from csv import DictReader
 from app import db
-from models import User, Message, Follows
+from models import User, Message, Conversation, TimelineEntry
+from search import create_search_indexes
+
+CHUNK_SIZE = 50_000
+
+# (table name, CSV file, required), in foreign-key order
+SOURCES = [
+    ('users', 'users.csv', True),
+    ('messages', 'messages.csv', True),
+    ('follows', 'follows.csv', True),
+    ('likes', 'likes.csv', False),
+    ('direct_messages', 'direct_messages.csv', False),
+]
+
+# Built after the load by search.create_search_indexes().
+SEARCH_INDEXES = ['ix_users_username_trgm', 'ix_users_bio_tsv']
+
+progress = Table(
+    'seed_progress', MetaData(),
+    Column('name', String, primary_key=True),
+    Column('rows_loaded', Integer, nullable=False, default=0),
+)
+
+
+def is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+##############################################################################
+# Progress
+
+
+def get_progress(name):
+    return db.session.execute(
+        select(progress.c.rows_loaded).where(progress.c.name == name)
+    ).scalar() or 0
+
+
+def set_progress(name, rows_loaded):
+    """Record progress (commits with the current transaction)."""
+
+    updated = db.session.execute(
+        progress.update()
+        .where(progress.c.name == name)
+        .values(rows_loaded=rows_loaded))
+
+    if not updated.rowcount:
+        db.session.execute(
+            progress.insert().values(name=name, rows_loaded=rows_loaded))
+
+
+def report(name, rows_loaded, started, skipped):
+    elapsed = time.monotonic() - started
+    rate = (rows_loaded - skipped) / elapsed if elapsed else 0
+    print(f"  {name}: {rows_loaded:,} rows ({rate:,.0f} rows/s)",
+          file=sys.stderr)
+
+
+##############################################################################
+# Schema
+
+
+def defer_schema():
+    """Drop secondary indexes and foreign keys ahead of the bulk load."""
+
+    if get_progress('schema_deferred'):
+        return
+
+    bind = db.session.connection()
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(bind, checkfirst=True)
+
+    if is_postgres():
+        for name in SEARCH_INDEXES:
+            db.session.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+        inspector = inspect(bind)
+        for table in db.metadata.sorted_tables:
+            for fk in inspector.get_foreign_keys(table.name):
+                db.session.execute(text(
+                    f'ALTER TABLE {table.name} '
+                    f'DROP CONSTRAINT IF EXISTS "{fk["name"]}"'))
+
+    set_progress('schema_deferred', 1)
+    db.session.commit()
+
+
+def restore_schema(tables):
+    """Rebuild the foreign keys and indexes dropped by defer_schema."""
+
+    bind = db.session.connection()
+
+    if is_postgres():
+        inspector = inspect(bind)
+        for table in tables:
+            existing = {tuple(fk['constrained_columns'])
+                        for fk in inspector.get_foreign_keys(table.name)}
+
+            for fk in table.foreign_key_constraints:
+                if tuple(fk.column_keys) not in existing:
+                    db.session.execute(AddConstraint(fk))
+
+    for table in tables:
+        for index in table.indexes:
+            index.create(bind, checkfirst=True)
+
+    db.session.commit()
+
+
+def sync_sequences():
+    """Move id sequences past ids that were loaded explicitly."""
+
+    if not is_postgres():
+        return
+
+    for table in db.metadata.sorted_tables:
+        if 'id' in table.c and table.c.id.autoincrement is not False:
+            db.session.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"coalesce(max(id), 0) + 1, false) FROM {table.name}"))
+
+    db.session.commit()
+
+
+##############################################################################
+# Loading
+
+
+def chunks(reader, size):
+    chunk = []
+    for row in reader:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def copy_chunk(table, header, rows):
+    """COPY `rows` into `table` (Postgres)."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    columns = ', '.join(header)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def _converter(column):
+    if isinstance(column.type, DateTime):
+        return datetime.fromisoformat
+    if isinstance(column.type, Boolean):
+        return lambda value: value.lower() in ('t', 'true', '1')
+    if isinstance(column.type, Integer):
+        return int
+    return str
+
+
+def insert_chunk(table, header, rows):
+    """Insert `rows` into `table` as one batched INSERT."""
+
+    converters = [_converter(table.c[name]) for name in header]
+
+    db.session.execute(insert(table), [
+        {name: (convert(value) if value != '' else None)
+         for name, convert, value in zip(header, converters, row)}
+        for row in rows
+    ])
+
+
+def load_table(table, path, chunk_size):
+    """Stream the CSV at `path` into `table`, resuming after loaded rows."""
+
+    load_chunk = copy_chunk if is_postgres() else insert_chunk
+    rows_loaded = skipped = get_progress(table.name)
+    started = time.monotonic()
+
+    with open(path, newline='') as source:
+        reader = csv.reader(source)
+        header = next(reader)
+
+        for _ in range(skipped):
+            next(reader)
+
+        for rows in chunks(reader, chunk_size):
+            load_chunk(table, header, rows)
+            rows_loaded += len(rows)
+
+            set_progress(table.name, rows_loaded)
+            db.session.commit()
+            report(table.name, rows_loaded, started, skipped)
+
+    return rows_loaded
+
+
+def seed(data_dir='generator', resume=False, chunk_size=CHUNK_SIZE):
+    bind = db.engine
+
+    if resume:
+        if not inspect(bind).has_table(progress.name):
+            sys.exit("Nothing to resume: run without --resume first.")
+    else:
+        progress.drop(bind, checkfirst=True)
+        db.drop_all()
+        db.create_all()
+        progress.create(bind)
+
+    if is_postgres():
+        db.session.execute(text("SET synchronous_commit TO off"))
+
+    defer_schema()
+
+    for name, filename, required in SOURCES:
+        path = os.path.join(data_dir, filename)
+        if not required and not os.path.exists(path):
+            continue
+
+        print(f"Loading {path}", file=sys.stderr)
+        load_table(db.metadata.tables[name], path, chunk_size)
+
+    sync_sequences()
+
+    print("Rebuilding indexes and foreign keys", file=sys.stderr)
+    timelines = TimelineEntry.__table__
+    restore_schema([table for table in db.metadata.sorted_tables
+                    if table is not timelines])
+
+    print("Materializing timelines and counters", file=sys.stderr)
+    TimelineEntry.rebuild()
+    Conversation.rebuild()
+    User.recount()
+    Message.recount_likes()
+    db.session.commit()
+
+    restore_schema([timelines])
+    create_search_indexes()
 
-db.drop_all()
-db.create_all()
+    if is_postgres():
+        db.session.execute(text("ANALYZE"))
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+    progress.drop(db.session.connection())
+    db.session.commit()
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', default='generator')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an interrupted load')
+    args = parser.parse_args()
 
-db.session.commit()
+    seed(args.data_dir, args.resume, args.chunk_size)
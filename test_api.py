@@ -0,0 +1,162 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_api.py
+
+
+import json
+import os
+from unittest import TestCase
+
+from models import (db, Message, User, Follows, Like, TimelineEntry,
+                    DirectMessage)
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ApiTestCase(TestCase):
+    """Test the v1 JSON API."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        self.testuser2 = User.signup(username="testuser2",
+                                     email="test2@test2.com",
+                                     password="testuser2",
+                                     image_url=None)
+        self.testuser.id = 100
+        self.testuser_id = self.testuser.id
+        self.testuser2.id = 200
+        self.testuser2_id = self.testuser2.id
+        db.session.commit()
+
+        for i in range(3):
+            db.session.add(Message(id=300 + i,
+                                   text=f"Warble {i}",
+                                   user_id=self.testuser2_id))
+        db.session.add(Follows(user_being_followed_id=self.testuser2_id,
+                               user_following_id=self.testuser_id))
+        db.session.commit()
+
+        db.session.add(Like(user_id=self.testuser_id, message_id=301))
+        db.session.commit()
+
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser_id
+
+    def test_requires_login(self):
+        """Is the API closed to anonymous clients?"""
+
+        resp = self.client.get("/api/v1/timeline")
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.json, {"error": "unauthorized"})
+
+    def test_timeline_pagination(self):
+        """Does the timeline page with the 'next' cursor?"""
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get("/api/v1/timeline?limit=2")
+            self.assertEqual(resp.status_code, 200)
+            page = resp.json
+            self.assertEqual(len(page["items"]), 2)
+            self.assertEqual(page["items"][0]["user"]["username"], "testuser2")
+
+            resp = c.get(f"/api/v1/timeline?limit=2&before={page['next']}")
+            self.assertEqual(len(resp.json["items"]), 1)
+            self.assertIsNone(resp.json["next"])
+
+    def test_followers_and_likes(self):
+        """Do the followers and likes lists return the right rows?"""
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get(f"/api/v1/users/{self.testuser2_id}/followers")
+            self.assertEqual([u["id"] for u in resp.json["items"]],
+                             [self.testuser_id])
+
+            resp = c.get(f"/api/v1/users/{self.testuser_id}/likes")
+            self.assertEqual([m["id"] for m in resp.json["items"]], [301])
+
+    def test_messages_export(self):
+        """Does the NDJSON export stream every message?"""
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get(f"/api/v1/users/{self.testuser2_id}/messages.ndjson")
+            self.assertEqual(resp.mimetype, "application/x-ndjson")
+
+            lines = resp.get_data(as_text=True).splitlines()
+            self.assertEqual(sorted(json.loads(line)["id"] for line in lines),
+                             [300, 301, 302])
+
+    def test_unknown_user(self):
+        """Do missing users get a JSON 404?"""
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get("/api/v1/users/9999/messages")
+            self.assertEqual(resp.status_code, 404)
+            self.assertEqual(resp.json, {"error": "not found"})
+
+    def test_conversations(self):
+        """Do conversations and their messages come back for a participant?"""
+
+        DirectMessage.send(self.testuser2_id, self.testuser_id, "Hi there")
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get("/api/v1/conversations")
+            [conversation] = resp.json["items"]
+            self.assertEqual(conversation["user"]["username"], "testuser2")
+            self.assertEqual(conversation["unread_count"], 1)
+            self.assertEqual(conversation["last_message"], "Hi there")
+
+            resp = c.get(
+                f"/api/v1/conversations/{conversation['id']}/messages")
+            [message] = resp.json["items"]
+            self.assertEqual(message["recipient"], "testuser")
+            self.assertEqual(message["recipient_id"], self.testuser_id)
+
+            resp = c.get("/api/v1/direct_messages")
+            self.assertEqual(len(resp.json["items"]), 1)
@@ -0,0 +1,116 @@
+"""Fingerprinted static asset tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from flask import Flask, render_template_string
+
+import assets
+
+STYLESHEET = "body { background: url('/static/images/hero.svg'); }\n" * 20
+IMAGE = "<svg xmlns='http://www.w3.org/2000/svg'></svg>\n"
+
+
+class AssetsTestCase(TestCase):
+    """Test build_assets, asset_url and the /assets/ route."""
+
+    def setUp(self):
+        """Build a throwaway static folder into an app of its own."""
+
+        self.saved_manifest = dict(assets._manifest)
+
+        self.static_folder = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.static_folder, 'stylesheets'))
+        os.makedirs(os.path.join(self.static_folder, 'images'))
+        with open(os.path.join(self.static_folder,
+                               'stylesheets', 'style.css'), 'w') as f:
+            f.write(STYLESHEET)
+        with open(os.path.join(self.static_folder,
+                               'images', 'hero.svg'), 'w') as f:
+            f.write(IMAGE)
+
+        self.manifest = assets.build_assets(self.static_folder)
+
+        self.app = Flask(__name__, static_folder=self.static_folder,
+                         static_url_path='/static')
+        assets.init_app(self.app)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.static_folder)
+        assets._manifest.clear()
+        assets._manifest.update(self.saved_manifest)
+
+    def test_build(self):
+        hashed = self.manifest['stylesheets/style.css']
+        dist = os.path.join(self.static_folder, assets.DIST_DIRNAME)
+
+        self.assertRegex(hashed, r"^stylesheets/style\.[0-9a-f]{12}\.css$")
+        self.assertTrue(os.path.exists(os.path.join(dist, hashed)))
+        self.assertTrue(os.path.exists(os.path.join(dist, hashed + '.gz')))
+
+        with open(os.path.join(dist, hashed)) as f:
+            css = f.read()
+        self.assertIn(f"/assets/{self.manifest['images/hero.svg']}", css)
+        self.assertNotIn("/static/", css)
+
+    def test_static_url(self):
+        with self.app.test_request_context():
+            self.assertEqual(
+                assets.asset_url('stylesheets/style.css'),
+                f"/assets/{self.manifest['stylesheets/style.css']}")
+            self.assertEqual(
+                render_template_string(
+                    "{{ '/static/images/hero.svg' | static_asset }}"),
+                f"/assets/{self.manifest['images/hero.svg']}")
+            self.assertEqual(assets.static_asset('https://example.com/a.png'),
+                             'https://example.com/a.png')
+
+            # Not in the manifest: plain /static/ URL
+            self.assertEqual(assets.asset_url('missing.css'),
+                             '/static/missing.css')
+
+    def test_serve_gzip(self):
+        url = f"/assets/{self.manifest['stylesheets/style.css']}"
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertEqual(gzip.decompress(resp.data).decode(),
+                         STYLESHEET.replace(
+                             '/static/images/hero.svg',
+                             f"/assets/{self.manifest['images/hero.svg']}"))
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertTrue(resp.cache_control.immutable)
+        self.assertEqual(resp.cache_control.max_age, assets.ASSET_MAX_AGE)
+        resp.close()
+
+    def test_serve_uncompressed(self):
+        url = f"/assets/{self.manifest['stylesheets/style.css']}"
+
+        for accept in (None, 'identity', 'gzip;q=0'):
+            with self.subTest(accept=accept):
+                headers = {'Accept-Encoding': accept} if accept else {}
+                resp = self.client.get(url, headers=headers)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertNotIn('Content-Encoding', resp.headers)
+                self.assertIn("/assets/images/hero.",
+                              resp.get_data(as_text=True))
+                self.assertIn('Accept-Encoding', resp.headers['Vary'])
+                self.assertTrue(resp.cache_control.immutable)
+                resp.close()
+
+    def test_serve_missing(self):
+        resp = self.client.get("/assets/stylesheets/style.000000000000.css")
+
+        self.assertEqual(resp.status_code, 404)
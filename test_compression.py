@@ -0,0 +1,142 @@
+"""Response compression tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+
+
+import gzip
+from unittest import TestCase
+
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from compression import CompressionMiddleware
+
+BODY = "<p>Hello, warbler!</p>" * 50
+
+
+def make_client(body=BODY, mimetype='text/html', status=200, headers=None,
+                **options):
+    """Client for a one-response app wrapped in CompressionMiddleware."""
+
+    def app(environ, start_response):
+        response = Response(body, status=status, mimetype=mimetype,
+                            headers=headers)
+        return response(environ, start_response)
+
+    return Client(CompressionMiddleware(app, **options))
+
+
+class CompressionTestCase(TestCase):
+    """Test which responses are gzipped, and their headers."""
+
+    def test_compresses(self):
+        resp = make_client().get('/', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', resp.headers)
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(resp.data).decode(), BODY)
+
+    def test_not_accepted(self):
+        """No gzip, or gzip refused with q=0: sent as is."""
+
+        for accept in (None, 'identity', 'gzip;q=0', 'br, gzip;q=0'):
+            with self.subTest(accept=accept):
+                headers = {'Accept-Encoding': accept} if accept else {}
+                resp = make_client().get('/', headers=headers)
+
+                self.assertNotIn('Content-Encoding', resp.headers)
+                self.assertEqual(resp.get_data(as_text=True), BODY)
+                self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+
+    def test_wildcard_accepted(self):
+        resp = make_client().get('/', headers={'Accept-Encoding': '*'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+    def test_min_size(self):
+        client = make_client(body="short", min_size=500)
+        resp = client.get('/', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.get_data(as_text=True), "short")
+
+    def test_mimetypes(self):
+        """Only listed content types are compressed, or vary."""
+
+        for mimetype in ('image/png', 'application/octet-stream'):
+            with self.subTest(mimetype=mimetype):
+                resp = make_client(mimetype=mimetype).get(
+                    '/', headers={'Accept-Encoding': 'gzip'})
+
+                self.assertNotIn('Content-Encoding', resp.headers)
+                self.assertNotIn('Vary', resp.headers)
+
+        resp = make_client(mimetype='application/json').get(
+            '/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+    def test_already_encoded(self):
+        client = make_client(headers={'Content-Encoding': 'br'})
+        resp = client.get('/', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(resp.get_data(as_text=True), BODY)
+
+    def test_vary_merged(self):
+        """An existing Vary is extended, not duplicated."""
+
+        client = make_client(headers={'Vary': 'Cookie'})
+        for accept in ('gzip', 'identity'):
+            with self.subTest(accept=accept):
+                resp = client.get('/', headers={'Accept-Encoding': accept})
+
+                self.assertEqual(resp.headers.getlist('Vary'),
+                                 ['Cookie, Accept-Encoding'])
+
+        client = make_client(headers={'Vary': 'accept-encoding'})
+        resp = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers.getlist('Vary'), ['accept-encoding'])
+
+    def test_etag_weakened(self):
+        client = make_client(headers={'ETag': '"abc"'})
+
+        resp = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['ETag'], 'W/"abc"')
+
+        resp = client.get('/', headers={'Accept-Encoding': 'identity'})
+        self.assertEqual(resp.headers['ETag'], '"abc"')
+
+    def test_no_body(self):
+        """HEAD, 204 and 304 responses get no gzip stream."""
+
+        resp = make_client().head('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.data, b"")
+
+        for status in (204, 304):
+            with self.subTest(status=status):
+                resp = make_client(body="", status=status).get(
+                    '/', headers={'Accept-Encoding': 'gzip'})
+
+                self.assertNotIn('Content-Encoding', resp.headers)
+                self.assertEqual(resp.data, b"")
+
+    def test_streamed(self):
+        """Streamed bodies are flushed as they go and decompress whole."""
+
+        chunks = [f"<li>{i}</li>".encode() * 100 for i in range(10)]
+
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/html')])
+            return iter(chunks)
+
+        client = Client(CompressionMiddleware(app, flush_size=1024))
+        resp = client.get('/', headers={'Accept-Encoding': 'gzip'},
+                          buffered=False)
+        parts = list(resp.response)
+
+        self.assertGreater(len(parts), 2)
+        self.assertEqual(gzip.decompress(b"".join(parts)), b"".join(chunks))
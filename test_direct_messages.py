@@ -0,0 +1,186 @@
+"""Direct message / conversation tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_direct_messages.py
+
+
+import os
+from unittest import TestCase
+
+from models import (db, User, Follows, DirectMessage, Conversation,
+                    ConversationParticipant)
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class DirectMessagesTestCase(TestCase):
+    """Test conversations, unread counts and the DM views."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        DirectMessage.query.delete()
+        Conversation.query.delete()
+        User.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        self.friend = User.signup(username="friend",
+                                  email="friend@test.com",
+                                  password="friend",
+                                  image_url=None)
+        self.stranger = User.signup(username="stranger",
+                                    email="stranger@test.com",
+                                    password="stranger",
+                                    image_url=None)
+        self.testuser.id = 100
+        self.friend.id = 200
+        self.stranger.id = 300
+        db.session.commit()
+
+        db.session.add(Follows(user_following_id=100,
+                               user_being_followed_id=200))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, client, user_id=100):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def participant(self, user_id):
+        conversation = Conversation.find(100, 200)
+        return ConversationParticipant.query.get((conversation.id, user_id))
+
+    def test_send_tracks_unread_counts(self):
+        DirectMessage.send(100, 200, "Hi")
+        DirectMessage.send(100, 200, "Are you there?")
+        db.session.commit()
+
+        self.assertEqual(Conversation.query.count(), 1)
+        self.assertEqual(self.participant(200).unread_count, 2)
+        self.assertEqual(self.participant(100).unread_count, 0)
+        self.assertEqual(Conversation.find(200, 100).last_message_preview,
+                         "Are you there?")
+
+        DirectMessage.send(200, 100, "Yes")
+        db.session.commit()
+
+        self.assertEqual(Conversation.query.count(), 1)
+        self.assertEqual(self.participant(100).unread_count, 1)
+        self.assertEqual(ConversationParticipant.total_unread(200), 2)
+
+    def test_thread_marks_read(self):
+        DirectMessage.send(200, 100, "Hello testuser")
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+            resp = c.get("/direct_messages")
+            self.assertIn("@friend", str(resp.data))
+            self.assertIn("Hello testuser", str(resp.data))
+
+            resp = c.get("/direct_messages/200")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Hello testuser", str(resp.data))
+
+        self.assertEqual(self.participant(100).unread_count, 0)
+        self.assertIsNotNone(self.participant(100).last_read_at)
+
+    def test_reply_in_thread(self):
+        with self.client as c:
+            self.login(c)
+            resp = c.post("/direct_messages/200", data={"text": "Reply"})
+            self.assertEqual(resp.status_code, 302)
+
+        message = DirectMessage.query.one()
+        self.assertEqual(message.recipient_id, 200)
+        self.assertEqual(message.conversation_id, Conversation.find(100, 200).id)
+
+    def test_new_message_lists_followed_users(self):
+        with self.client as c:
+            self.login(c)
+            resp = c.get("/direct_message/new")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<option value="200">friend</option>', html)
+            self.assertNotIn("stranger", html)
+
+            resp = c.post("/direct_message/new",
+                          data={"select_user": 200, "text": "Hi"})
+            self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(DirectMessage.query.one().recipient_id, 200)
+
+    def test_cannot_message_stranger(self):
+        with self.client as c:
+            self.login(c)
+            resp = c.post("/direct_messages/300", data={"text": "Spam"},
+                          follow_redirects=True)
+            self.assertIn("You can only message users you follow", str(resp.data))
+
+        self.assertEqual(DirectMessage.query.count(), 0)
+
+    def test_thread_pagination(self):
+        conversation = Conversation.between(100, 200)
+        db.session.commit()
+        db.session.add_all([DirectMessage(text=f"dm {i}",
+                                          user_id=100,
+                                          recipient_id=200,
+                                          conversation_id=conversation.id)
+                            for i in range(105)])
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+            resp = c.get("/direct_messages/200")
+            html = resp.get_data(as_text=True)
+            self.assertIn("Older messages", html)
+            self.assertEqual(html.count('class="single-message"'), 100)
+
+    def test_rebuild(self):
+        db.session.add_all([
+            DirectMessage(text="one", user_id=100, recipient_id=200),
+            DirectMessage(text="two", user_id=200, recipient_id=100),
+            DirectMessage(text="three", user_id=300, recipient_id=100),
+        ])
+        db.session.commit()
+
+        Conversation.rebuild()
+        db.session.commit()
+
+        self.assertEqual(Conversation.query.count(), 2)
+        self.assertEqual(ConversationParticipant.query.count(), 4)
+        self.assertEqual(
+            DirectMessage.query.filter_by(conversation_id=None).count(), 0)
+        self.assertEqual(
+            [p.other_user_id for p in ConversationParticipant.inbox(100)
+             .order_by(ConversationParticipant.other_user_id)],
+            [200, 300])
@@ -0,0 +1,244 @@
+"""Timeline event stream tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_events.py
+
+
+import atexit
+import os
+import queue
+import socket
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import psycopg2
+
+from models import db, Message, User, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import threading
+
+from events import (hub, publish_follow, PostgresNotifyBackend,
+                    UnixSocketBackend)
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TimelineEventsTestCase(TestCase):
+    """Test the server-sent events timeline stream."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        self.followed = User.signup(username="followed",
+                                    email="followed@test.com",
+                                    password="followed",
+                                    image_url=None)
+        self.stranger = User.signup(username="stranger",
+                                    email="stranger@test.com",
+                                    password="stranger",
+                                    image_url=None)
+        self.testuser.id = 100
+        self.followed.id = 200
+        self.stranger.id = 300
+        db.session.commit()
+
+        db.session.add(Follows(user_following_id=100,
+                               user_being_followed_id=200))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_stream_requires_login(self):
+        resp = self.client.get("/timeline/events")
+        self.assertEqual(resp.status_code, 401)
+
+    def test_stream_forwards_followed_messages(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 100
+
+            resp = c.get("/timeline/events", buffered=False)
+            self.assertEqual(resp.mimetype, "text/event-stream")
+
+            chunks = iter(resp.response)
+            self.assertIn("retry:", next(chunks).decode())
+
+            hub.publish({'type': 'message', 'id': 1, 'user_id': 300})
+            hub.publish({'type': 'message', 'id': 2, 'user_id': 200})
+            db.session.commit()
+
+            chunk = next(chunks).decode()
+            self.assertIn("event: message", chunk)
+            self.assertIn('"id": 2', chunk)
+            self.assertNotIn('"id": 1', chunk)
+
+            resp.close()
+            self.assertEqual(hub.broker.subscriber_count, 0)
+
+    def test_publish_waits_for_commit(self):
+        subscription = hub.subscribe()
+        try:
+            hub.publish({'type': 'message', 'id': 1, 'user_id': 200})
+            db.session.rollback()
+            hub.publish({'type': 'message', 'id': 2, 'user_id': 200})
+            self.assertTrue(subscription.empty())
+
+            db.session.commit()
+            self.assertEqual(subscription.get_nowait()['id'], 2)
+            self.assertTrue(subscription.empty())
+        finally:
+            hub.unsubscribe(subscription)
+
+    def test_stream_follows_follow_events(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 100
+
+            resp = c.get("/timeline/events", buffered=False)
+            chunks = iter(resp.response)
+            next(chunks)
+
+            publish_follow(100, 300, True)
+            publish_follow(100, 200, False)
+            hub.publish({'type': 'message', 'id': 1, 'user_id': 200})
+            hub.publish({'type': 'message', 'id': 2, 'user_id': 300})
+            db.session.commit()
+
+            chunk = next(chunks).decode()
+            self.assertIn('"id": 2', chunk)
+            self.assertNotIn('"id": 1', chunk)
+
+            resp.close()
+
+    def test_new_message_pushes_card(self):
+        subscription = hub.subscribe()
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 200
+
+                c.post("/messages/new", data={"text": "Pushed warble"})
+
+            event = subscription.get_nowait()
+            self.assertEqual(event['user_id'], 200)
+            self.assertIn("Pushed warble", event['html'])
+            self.assertIn("@followed", event['html'])
+        finally:
+            hub.unsubscribe(subscription)
+
+    def test_stream_cap(self):
+        streams = hub.streams
+        hub.streams = threading.BoundedSemaphore(1)
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 100
+
+                first = c.get("/timeline/events", buffered=False)
+                self.assertEqual(first.status_code, 200)
+
+                refused = c.get("/timeline/events", buffered=False)
+                self.assertEqual(refused.status_code, 503)
+                self.assertIn("Retry-After", refused.headers)
+
+                first.close()
+                again = c.get("/timeline/events", buffered=False)
+                self.assertEqual(again.status_code, 200)
+                again.close()
+        finally:
+            hub.streams = streams
+
+
+class StopListening(BaseException):
+    """Ends a listener loop from inside a test (past its except clauses)."""
+
+
+class EventBackendsTestCase(TestCase):
+    """Test the cross-worker backends' listener threads."""
+
+    def test_postgres_listener_reconnects(self):
+        backend = PostgresNotifyBackend("postgresql:///unused")
+        conn = MagicMock()
+        cursor = conn.cursor.return_value.__enter__.return_value
+
+        with patch('psycopg2.connect',
+                   side_effect=[psycopg2.OperationalError("refused"),
+                                psycopg2.OperationalError("refused"),
+                                conn, conn]) as connect, \
+                patch.object(backend, '_receive',
+                             side_effect=[psycopg2.OperationalError("lost"),
+                                          StopListening()]), \
+                patch('events.time.sleep') as sleep, \
+                self.assertLogs('warbler.events', 'ERROR') as logs:
+            with self.assertRaises(StopListening):
+                backend.listen(lambda event: None)
+
+        self.assertEqual(connect.call_count, 4)
+        self.assertEqual(len(logs.records), 3)
+
+        # Backs off while the database is down, and starts over once a
+        # connection has been made.
+        self.assertEqual([call.args[0] for call in sleep.call_args_list],
+                         [1, 2, 1])
+
+        # LISTEN again on every new connection, and close the old ones.
+        self.assertEqual(
+            [call.args[0] for call in cursor.execute.call_args_list],
+            ["LISTEN warbler_messages"] * 2)
+        self.assertEqual(conn.close.call_count, 2)
+
+    def test_unix_socket_backend(self):
+        directory = tempfile.mkdtemp()
+        backend = UnixSocketBackend(directory)
+        atexit.unregister(backend.close)
+
+        received = queue.Queue()
+        threading.Thread(target=backend.listen,
+                         args=(received.put,),
+                         daemon=True).start()
+
+        with self.assertLogs('warbler.events', 'WARNING'):
+            sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sender.sendto(b"not json", backend._path)
+            sender.close()
+
+            backend.publish({'type': 'message', 'id': 1})
+            self.assertEqual(received.get(timeout=5),
+                             {'type': 'message', 'id': 1})
+
+        # What atexit runs: the worker's socket goes away with it.
+        backend.close()
+        self.assertEqual(os.listdir(directory), [])
+        os.rmdir(directory)
@@ -0,0 +1,199 @@
+"""Follow graph index tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_followgraph.py
+
+
+import os
+from array import array
+from functools import partial
+from unittest import TestCase
+
+from models import db, User, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY, followed_users, follower_users
+from followgraph import Adjacency, FollowGraph, follow_graph
+from pagination import paginate_ids
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Built once at startup, no periodic rebuilds: the tests rebuild
+# explicitly.
+app.config['FOLLOW_GRAPH_ENABLED'] = True
+app.config['FOLLOW_GRAPH_REBUILD_SECONDS'] = 0
+follow_graph.init_app(app)
+
+
+class AdjacencyTestCase(TestCase):
+    """CSR arrays with an overlay of edits."""
+
+    def setUp(self):
+        self.adjacency = Adjacency.build(
+            [(1, 2), (1, 3), (1, 7), (3, 1)], size=8)
+
+    def test_build(self):
+        self.assertEqual(self.adjacency.offsets,
+                         array('q', [0, 0, 3, 3, 4, 4, 4, 4, 4]))
+        self.assertEqual(self.adjacency.targets, array('i', [2, 3, 7, 1]))
+
+    def test_queries(self):
+        self.assertTrue(self.adjacency.contains(1, 7))
+        self.assertFalse(self.adjacency.contains(1, 4))
+        self.assertFalse(self.adjacency.contains(2, 1))
+        self.assertFalse(self.adjacency.contains(50, 1))
+        self.assertEqual(self.adjacency.degree(1), 3)
+        self.assertEqual(self.adjacency.degree(50), 0)
+        self.assertEqual(self.adjacency.neighbours(1), [2, 3, 7])
+
+    def test_overlay(self):
+        self.adjacency.set_edge(1, 5, True)
+        self.adjacency.set_edge(1, 2, False)
+        self.adjacency.set_edge(1, 3, True)  # already there
+        self.adjacency.set_edge(50, 1, True)  # user newer than the arrays
+
+        self.assertEqual(self.adjacency.neighbours(1), [3, 5, 7])
+        self.assertEqual(self.adjacency.degree(1), 3)
+        self.assertTrue(self.adjacency.contains(50, 1))
+        self.assertEqual(self.adjacency.overlay_size, 3)
+
+        # Undoing an edit empties the overlay again.
+        self.adjacency.set_edge(1, 5, False)
+        self.adjacency.set_edge(1, 2, True)
+        self.assertEqual(self.adjacency.neighbours(1), [2, 3, 7])
+        self.assertEqual(self.adjacency.overlay_size, 1)
+
+
+class PaginateIdsTestCase(TestCase):
+    """Keyset pages of a CSR adjacency."""
+
+    def setUp(self):
+        self.adjacency = Adjacency.build([(1, target) for target in
+                                          [1, 2, 3, 4, 5, 6, 7]], size=8)
+        self.fetch = partial(self.adjacency.page, 1)
+
+    def test_pages(self):
+        page, cursor = paginate_ids(self.fetch, limit=3)
+        self.assertEqual(page, [7, 6, 5])
+
+        page, cursor = paginate_ids(self.fetch, cursor, limit=3)
+        self.assertEqual(page, [4, 3, 2])
+
+        page, cursor = paginate_ids(self.fetch, cursor, limit=3)
+        self.assertEqual(page, [1])
+        self.assertIsNone(cursor)
+
+    def test_overlay_and_cursor_between_ids(self):
+        """Edits since the build are merged in; stale cursors still page."""
+
+        self.adjacency.set_edge(1, 4, False)
+        self.adjacency.set_edge(1, 6, False)
+        self.adjacency.set_edge(1, 9, True)
+
+        self.assertEqual(paginate_ids(self.fetch, limit=3),
+                         ([9, 7, 5], '5_5'))
+        self.assertEqual(paginate_ids(self.fetch, '4_4', limit=5),
+                         ([3, 2, 1], None))
+        self.assertEqual(self.adjacency.page(1, before=9, limit=100),
+                         self.adjacency.neighbours(1)[::-1][1:])
+
+
+class FollowGraphTestCase(TestCase):
+    """The graph mirrors the follows table and the follow routes."""
+
+    def setUp(self):
+        Follows.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        users = [User.signup(f"user{i}", f"user{i}@test.com", "password",
+                             None)
+                 for i in range(4)]
+        db.session.commit()
+        self.ids = [user.id for user in users]
+
+        a, b, c, _ = self.ids
+        for follower_id, followed_id in [(a, b), (a, c), (b, a)]:
+            Follows.add(follower_id, followed_id)
+        db.session.commit()
+
+        follow_graph.build()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_build(self):
+        a, b, c, d = self.ids
+
+        self.assertTrue(follow_graph.is_following(a, b))
+        self.assertFalse(follow_graph.is_following(b, c))
+        self.assertEqual(follow_graph.following_ids(a), [b, c])
+        self.assertEqual(follow_graph.follower_ids(a), [b])
+        self.assertEqual(follow_graph.following_count(a), 2)
+        self.assertEqual(follow_graph.follower_count(d), 0)
+        self.assertEqual(follow_graph.followed_ids_among(a, [b, c, d]),
+                         {b, c})
+
+    def test_routes_update_graph(self):
+        a, b, _, d = self.ids
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = a
+
+            c.post(f'/users/follow/{d}')
+            c.post(f'/users/stop-following/{b}')
+
+            self.assertTrue(follow_graph.is_following(a, d))
+            self.assertFalse(follow_graph.is_following(a, b))
+            self.assertEqual(follow_graph.follower_ids(d), [a])
+
+            html = c.get(f'/users/{a}/following').get_data(as_text=True)
+            self.assertIn('@user3', html)
+            self.assertNotIn('@user1', html)
+
+            html = c.get(f'/users/{a}/followers').get_data(as_text=True)
+            self.assertIn('@user1', html)
+
+    def test_rebuild_matches_overlay(self):
+        a, _, _, d = self.ids
+
+        Follows.add(d, a)
+        follow_graph.record(d, a, True)
+        db.session.commit()
+
+        graph = FollowGraph()
+        graph.build()
+
+        for user_id in self.ids:
+            self.assertEqual(graph.following_ids(user_id),
+                             follow_graph.following_ids(user_id))
+            self.assertEqual(graph.follower_count(user_id),
+                             follow_graph.follower_count(user_id))
+
+    def test_pages_match_follows_table(self):
+        a = self.ids[0]
+
+        with app.test_request_context():
+            user = User.query.get(a)
+            from_graph = [followed_users(user), follower_users(user)]
+
+            follow_graph.enabled = False
+            try:
+                from_table = [followed_users(user), follower_users(user)]
+            finally:
+                follow_graph.enabled = True
+
+        for (graph_users, graph_cursor), (table_users, table_cursor) in zip(
+                from_graph, from_table):
+            self.assertEqual([other.id for other in graph_users],
+                             [other.id for other in table_users])
+            self.assertEqual(graph_cursor, table_cursor)
+
+        self.assertEqual([other.id for other in from_graph[0][0]],
+                         sorted(self.ids[1:3], reverse=True))
@@ -0,0 +1,240 @@
+"""SQL instrumentation tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_instrumentation.py
+
+
+import os
+from unittest import TestCase
+
+from flask import g, session
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from models import db, Message, User, Follows, Like, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, identity_cache, CURR_USER_KEY
+from instrumentation import QueryBudgetExceeded, RequestStats
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class InstrumentationTestCase(TestCase):
+    """Test query counting, Server-Timing and query budgets."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        self.other = User.signup(username="other",
+                                 email="other@test.com",
+                                 password="other",
+                                 image_url=None)
+        self.testuser.id = 100
+        self.other.id = 200
+        db.session.commit()
+
+        db.session.add(Follows(user_following_id=100,
+                               user_being_followed_id=200))
+        db.session.add_all([Message(id=1000 + i, text=f"warble {i}",
+                                    user_id=200)
+                            for i in range(20)])
+        db.session.commit()
+
+        db.session.add_all([Like(user_id=100, message_id=1000 + i)
+                            for i in range(10)])
+        db.session.commit()
+
+        app.config['SQL_STRICT'] = True
+        app.config['PROPAGATE_EXCEPTIONS'] = True
+
+    def tearDown(self):
+        app.config['SQL_STRICT'] = False
+        app.config['PROPAGATE_EXCEPTIONS'] = None
+        db.session.rollback()
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 100
+
+    def test_server_timing_header(self):
+        with self.client as c:
+            self.login(c)
+            resp = c.get("/users")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertRegex(resp.headers["Server-Timing"],
+                             r'^db;dur=[\d.]+;desc="\d+ queries", '
+                             r'app;dur=[\d.]+$')
+
+    def test_pages_within_budget(self):
+        with self.client as c:
+            self.login(c)
+
+            for url in ["/", "/users", "/users/200", "/users/100/following",
+                        "/users/200/followers", "/users/100/likes",
+                        "/messages/1000"]:
+                resp = c.get(url)
+                resp.get_data()
+                resp.close()
+                self.assertEqual(resp.status_code, 200, url)
+
+            resp = c.post("/messages/1015/like")
+            self.assertEqual(resp.status_code, 302)
+
+            resp = c.post("/messages/new", data={"text": "Hello"})
+            self.assertEqual(resp.status_code, 302)
+
+    def test_eager_loaded_pages_within_budget(self):
+        """Timeline-style pages don't query per message author."""
+
+        for i in range(10):
+            author = User.signup(username=f"author{i}",
+                                 email=f"author{i}@test.com",
+                                 password="author",
+                                 image_url=None)
+            author.id = 300 + i
+            db.session.commit()
+
+            db.session.add(Follows(user_following_id=100,
+                                   user_being_followed_id=300 + i))
+            db.session.add(Message(id=2000 + i, text=f"author {i}",
+                                   user_id=300 + i))
+            db.session.commit()
+            db.session.add(Like(user_id=100, message_id=2000 + i))
+            db.session.commit()
+
+        TimelineEntry.rebuild()
+        User.recount()
+        Message.recount_likes()
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+
+            for url in ["/", "/users/100/likes", "/messages/2000",
+                        "/direct_message/new"]:
+                # cold identity cache: the worst case for the budget
+                identity_cache.clear()
+                resp = c.get(url)
+                html = resp.get_data(as_text=True)
+                resp.close()
+
+                self.assertEqual(resp.status_code, 200, url)
+                self.assertIn("author0", html, url)
+
+            identity_cache.clear()
+            resp = c.post("/direct_message/new",
+                          data={"select_user": 300, "text": "Hello"})
+            self.assertEqual(resp.status_code, 302)
+
+    def test_budget_exceeded(self):
+        for endpoint, url in [("list_users", "/users"),
+                              ("display_homepage", "/")]:
+            view = app.view_functions[endpoint]
+            budget = view.query_budget
+            view.query_budget = 0
+
+            try:
+                with self.client as c:
+                    self.login(c)
+                    with self.assertRaises(QueryBudgetExceeded, msg=url):
+                        resp = c.get(url)
+                        resp.get_data()
+                        resp.close()
+            finally:
+                view.query_budget = budget
+
+    def test_lazy_globals(self):
+        """Requests that never use g.user/g.identity/g.csrf don't query."""
+
+        app.config['SQL_QUERY_BUDGET'] = 0
+
+        try:
+            with self.client as c:
+                self.login(c)
+                resp = c.get("/static/stylesheets/style.css")
+                resp.close()
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('desc="0 queries"',
+                              resp.headers["Server-Timing"])
+        finally:
+            app.config['SQL_QUERY_BUDGET'] = None
+
+        identity_cache.clear()
+
+        with app.test_request_context():
+            session[CURR_USER_KEY] = 100
+            g.sql_stats = RequestStats()
+
+            g.csrf
+            self.assertEqual(g.sql_stats.count, 0)
+
+            self.assertEqual(g.identity.username, "testuser")
+            g.identity
+            self.assertEqual(g.sql_stats.count, 1)
+
+            self.assertEqual(g.user.email, "test@test.com")
+            g.user
+            self.assertEqual(g.sql_stats.count, 2)
+
+        with app.test_request_context():
+            session[CURR_USER_KEY] = 100
+            g.sql_stats = RequestStats()
+
+            # served from the identity cache
+            self.assertEqual(g.identity.id, 100)
+            self.assertEqual(g.sql_stats.count, 0)
+
+    def test_repeated_statements(self):
+        stats = RequestStats()
+        for ids in ["?", "?, ?", "?, ?, ?"]:
+            stats.record(f"SELECT * FROM users WHERE id IN ({ids})", 0.001)
+        stats.record("SELECT * FROM messages", 0.001)
+
+        self.assertEqual(stats.count, 4)
+        self.assertEqual(stats.repeated(3), [{
+            'statement': "SELECT * FROM users WHERE id IN (...)",
+            'count': 3,
+        }])
+
+    def test_failed_statement_not_timed(self):
+        with app.test_request_context():
+            g.sql_stats = RequestStats()
+
+            with self.assertRaises(DBAPIError):
+                db.session.execute(text("SELECT * FROM no_such_table"))
+            db.session.rollback()
+
+            db.session.execute(text("SELECT 1"))
+
+            self.assertEqual(g.sql_stats.count, 1)
+            self.assertEqual(g.sql_stats.statements[0][0], "SELECT 1")
@@ -0,0 +1,143 @@
+"""Like count and leaderboard tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_leaderboard.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import (db, Message, User, Like, LikeBucket, TopMessage)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LeaderboardTestCase(TestCase):
+    """Likes keep per-message counts and hourly buckets for the leaderboard."""
+
+    def setUp(self):
+        TopMessage.query.delete()
+        LikeBucket.query.delete()
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        self.author = User.signup("author", "author@test.com", "password",
+                                  None)
+        self.likers = [User.signup(f"liker{i}", f"liker{i}@test.com",
+                                   "password", None)
+                       for i in range(3)]
+        db.session.commit()
+
+        self.author_id = self.author.id
+        self.liker_ids = [liker.id for liker in self.likers]
+
+        self.message_ids = []
+        for i in range(3):
+            msg = Message(text=f"warble {i}", user_id=self.author_id)
+            db.session.add(msg)
+            db.session.commit()
+            self.message_ids.append(msg.id)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def like(self, user_id, message_id):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            return c.post(f'/messages/{message_id}/like',
+                          headers={'Accept': 'application/json'})
+
+    def test_like_count(self):
+        """Liking and unliking keeps Message.like_count and buckets."""
+
+        message_id = self.message_ids[0]
+
+        for liker_id in self.liker_ids:
+            self.like(liker_id, message_id)
+        self.like(self.liker_ids[0], message_id)  # unlike
+
+        self.assertEqual(Message.query.get(message_id).like_count, 2)
+        self.assertEqual(
+            [bucket.likes for bucket in LikeBucket.query.all()], [2])
+
+        Message.query.filter_by(id=message_id).update({'like_count': 0})
+        Message.recount_likes([message_id])
+        self.assertEqual(Message.query.get(message_id).like_count, 2)
+
+    def test_deleted_liker(self):
+        """Deleting a user takes their likes out of counts and buckets."""
+
+        first, second, _ = self.message_ids
+        for user_id in self.liker_ids[:2]:
+            self.like(user_id, first)
+        self.like(self.liker_ids[0], second)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.liker_ids[0]
+            c.post('/users/delete')
+
+        self.assertEqual(Message.query.get(first).like_count, 1)
+        self.assertEqual(Message.query.get(second).like_count, 0)
+        self.assertEqual({bucket.message_id: bucket.likes
+                          for bucket in LikeBucket.query.all()},
+                         {first: 1, second: 0})
+
+        TopMessage.refresh()
+        self.assertEqual([top.message_id for top in
+                          TopMessage.leaderboard('24h')], [first])
+
+    def test_refresh_windows(self):
+        """Each window ranks by likes gained within it."""
+
+        first, second, third = self.message_ids
+        now = datetime.utcnow()
+
+        LikeBucket.add({first: 1, second: 3}, when=now)
+        LikeBucket.add({first: 5}, when=now - timedelta(days=2))
+        LikeBucket.add({third: 9}, when=now - timedelta(days=8))
+        TopMessage.refresh(now=now)
+        db.session.commit()
+
+        day = [(row.message_id, row.likes)
+               for row in TopMessage.leaderboard('24h')]
+        week = [(row.message_id, row.likes)
+                for row in TopMessage.leaderboard('7d')]
+
+        self.assertEqual(day, [(second, 3), (first, 1)])
+        self.assertEqual(week, [(first, 6), (second, 3)])
+
+        # Buckets older than the longest window are pruned.
+        self.assertFalse(LikeBucket.query.filter_by(message_id=third).all())
+
+    def test_top_page(self):
+        """The /top page shows the precomputed leaderboard."""
+
+        first, second, _ = self.message_ids
+        self.like(self.liker_ids[0], second)
+        self.like(self.liker_ids[1], second)
+        self.like(self.liker_ids[0], first)
+        TopMessage.refresh()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.liker_ids[2]
+
+            html = c.get('/top').get_data(as_text=True)
+            self.assertLess(html.index('warble 1'), html.index('warble 0'))
+            self.assertIn('2 likes', html)
+
+            self.assertEqual(c.get('/top?window=1y').status_code, 404)
@@ -0,0 +1,228 @@
+"""Like write-behind buffer tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_like_buffer.py
+
+
+import glob
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, Message, User, Like, LikeBucket
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from like_buffer import LikeBuffer, like_buffer, _delete_likes, _insert_likes
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# No background thread: the tests flush explicitly.
+app.config['LIKE_BUFFER_ENABLED'] = True
+app.config['LIKE_BUFFER_INTERVAL_MS'] = 0
+app.config['LIKE_BUFFER_JOURNAL_DIR'] = tempfile.mkdtemp()
+like_buffer.init_app(app)
+
+
+class LikeBufferTestCase(TestCase):
+    """Buffered likes are coalesced, journaled and flushed in batches."""
+
+    def setUp(self):
+        like_buffer.flush()
+
+        LikeBucket.query.delete()
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        self.liker = User.signup("liker", "liker@test.com", "password", None)
+        self.author = User.signup("author", "author@test.com", "password",
+                                  None)
+        db.session.commit()
+        self.liker_id = self.liker.id
+
+        self.message_ids = []
+        for i in range(3):
+            msg = Message(text=f"warble {i}", user_id=self.author.id)
+            db.session.add(msg)
+            db.session.commit()
+            self.message_ids.append(msg.id)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.liker_id
+
+    def test_toggle_is_buffered_and_read_your_writes(self):
+        """A like shows as liked before it is written."""
+
+        message_id = self.message_ids[0]
+
+        with self.client as c:
+            self.login(c)
+            resp = c.post(f'/messages/{message_id}/like',
+                          headers={'Accept': 'application/json'})
+
+            self.assertEqual(resp.json, {'message_id': message_id,
+                                         'liked': True})
+            self.assertEqual(Like.query.count(), 0)
+
+            html = c.get(f'/messages/{message_id}').get_data(as_text=True)
+            self.assertIn('btn btn-warning">liked', html)
+
+            # Toggling again reads the pending state, not the table.
+            resp = c.post(f'/messages/{message_id}/like',
+                          headers={'Accept': 'application/json'})
+            self.assertFalse(resp.json['liked'])
+
+    def test_flush_coalesces_and_counts(self):
+        """Repeated toggles collapse to one row change per message."""
+
+        first, second, third = self.message_ids
+        metrics = like_buffer.metrics()
+
+        like_buffer.record(self.liker_id, first, True)
+        like_buffer.record(self.liker_id, first, False)
+        like_buffer.record(self.liker_id, first, True)
+        like_buffer.record(self.liker_id, second, True)
+        like_buffer.record(self.liker_id, third, False)
+        like_buffer.flush()
+
+        self.assertEqual(
+            {like.message_id for like in Like.query.all()}, {first, second})
+        self.assertEqual(User.query.get(self.liker_id).likes_count, 2)
+        self.assertEqual(Message.query.get(first).like_count, 1)
+        self.assertEqual(
+            {bucket.message_id: bucket.likes
+             for bucket in LikeBucket.query.all()}, {first: 1, second: 1})
+
+        after = like_buffer.metrics()
+        self.assertEqual(after['events'] - metrics['events'], 5)
+        self.assertEqual(after['coalesced'] - metrics['coalesced'], 2)
+        self.assertEqual(after['rows_written'] - metrics['rows_written'], 2)
+        self.assertEqual(after['pending'], 0)
+
+        # Flushing the same states again changes nothing.
+        like_buffer.record(self.liker_id, first, True)
+        like_buffer.record(self.liker_id, third, False)
+        like_buffer.flush()
+
+        self.assertEqual(Like.query.count(), 2)
+        self.assertEqual(Message.query.get(first).like_count, 1)
+        self.assertEqual(User.query.get(self.liker_id).likes_count, 2)
+        self.assertEqual(
+            sum(bucket.likes for bucket in LikeBucket.query.all()), 2)
+
+    def test_flush_adjusts_like_counts(self):
+        """A flush adds its changes to like_count instead of recounting."""
+
+        first = self.message_ids[0]
+        Message.query.filter_by(id=first).update({'like_count': 10})
+        db.session.commit()
+
+        like_buffer.record(self.liker_id, first, True)
+        like_buffer.flush()
+
+        self.assertEqual(Message.query.get(first).like_count, 11)
+
+    def test_counts_come_from_rows_written(self):
+        """Likes another worker wrote first are not counted again."""
+
+        first, second, _ = self.message_ids
+        Like.add(self.liker_id, first)
+        db.session.commit()
+
+        # As if the other worker's like landed after the flush's SELECT.
+        self.assertEqual(_insert_likes([(self.liker_id, first),
+                                        (self.liker_id, second)]), [second])
+        self.assertEqual(_delete_likes([(self.liker_id, first),
+                                        (self.author.id, first)]), [first])
+        db.session.rollback()
+
+    def test_flush_removes_journal(self):
+        """Committed events are dropped from the journal."""
+
+        like_buffer.record(self.liker_id, self.message_ids[0], True)
+
+        journals = glob.glob(os.path.join(like_buffer.journal_dir,
+                                          '*.journal'))
+        self.assertTrue(any(os.path.getsize(path) for path in journals))
+
+        like_buffer.flush()
+
+        journals = glob.glob(os.path.join(like_buffer.journal_dir,
+                                          '*.journal'))
+        self.assertEqual([os.path.getsize(path) for path in journals], [0])
+
+    def test_orphaned_journal_is_replayed(self):
+        """A dead worker's journal is written by the next worker."""
+
+        first, second, _ = self.message_ids
+        journal_dir = tempfile.mkdtemp()
+
+        # Replay also repairs the counts of the messages it touches.
+        Message.query.filter_by(id=first).update({'like_count': 10})
+        db.session.commit()
+
+        with open(os.path.join(journal_dir, 'likes-1-1.journal'), 'w') as f:
+            f.write(f"{self.liker_id} {first} 1\n")
+            f.write(f"{self.liker_id} {second} 1\n")
+            f.write(f"{self.liker_id} {second} 0\n")
+            f.write(f"{self.liker_id} 99")  # torn by the crash
+
+        buffer = LikeBuffer()
+        app.config['LIKE_BUFFER_JOURNAL_DIR'] = journal_dir
+        try:
+            buffer.init_app(app)
+        finally:
+            app.config['LIKE_BUFFER_JOURNAL_DIR'] = like_buffer.journal_dir
+
+        self.assertEqual([like.message_id for like in Like.query.all()],
+                         [first])
+        self.assertEqual(Message.query.get(first).like_count, 1)
+        self.assertEqual(buffer.metrics()['replayed'], 3)
+        self.assertFalse(os.path.exists(
+            os.path.join(journal_dir, 'likes-1-1.journal')))
+
+    def test_drained_orphans_are_removed(self):
+        """Orphans with no complete events are deleted, not kept."""
+
+        journal_dir = tempfile.mkdtemp()
+        torn = os.path.join(journal_dir, 'likes-1-1.journal')
+        stale = os.path.join(journal_dir, 'likes-1-2.journal.tmp')
+
+        with open(torn, 'w') as f:
+            f.write(f"{self.liker_id} 99")  # torn by the crash
+        open(stale, 'w').close()
+        os.utime(stale, (0, 0))
+
+        buffer = LikeBuffer()
+        app.config['LIKE_BUFFER_JOURNAL_DIR'] = journal_dir
+        try:
+            buffer.init_app(app)
+        finally:
+            app.config['LIKE_BUFFER_JOURNAL_DIR'] = like_buffer.journal_dir
+
+        self.assertEqual(os.listdir(journal_dir),
+                         [os.path.basename(buffer._journal[0])])
+
+    def test_deleted_message_is_skipped(self):
+        """A like on a message deleted before the flush is dropped."""
+
+        msg = Message.query.get(self.message_ids[0])
+        like_buffer.record(self.liker_id, msg.id, True)
+        db.session.delete(msg)
+        db.session.commit()
+
+        like_buffer.flush()
+
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(like_buffer.metrics()['pending'], 0)
@@ -80,6 +80,7 @@ class MessageViewTestCase(TestCase):
 
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
+            self.assertEqual(User.query.get(self.testuser.id).message_count, 1)
     
     def test_delete_message(self):
         """Test if messags deletes"""
@@ -0,0 +1,113 @@
+"""Who-to-follow recommendation tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_recommendations.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Follows, Recommendation
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from recommendations import recommend
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class RecommendationTestCase(TestCase):
+    """Friends-of-friends suggestions, stored and served."""
+
+    def setUp(self):
+        Recommendation.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        users = [User.signup(f"user{i}", f"user{i}@test.com", "password",
+                             None)
+                 for i in range(6)]
+        db.session.commit()
+        self.ids = [user.id for user in users]
+
+        # u0 follows u1 and u2; both follow u3, only u1 follows u4, and
+        # u2 follows u0 back (u0 must not be suggested to themselves).
+        u0, u1, u2, u3, u4, _ = self.ids
+        self.follow([(u0, u1), (u0, u2), (u1, u3), (u2, u3), (u1, u4),
+                     (u2, u0)])
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def follow(self, pairs):
+        for follower_id, followed_id in pairs:
+            Follows.add(follower_id, followed_id)
+            User.adjust_counts(follower_id, following_count=1)
+        db.session.commit()
+
+    def suggestions(self, user_id):
+        return [(row.candidate_id, row.score) for row
+                in Recommendation.query.filter_by(user_id=user_id)
+                .order_by(Recommendation.rank)]
+
+    def test_friends_of_friends(self):
+        """Candidates are ranked by how many followed accounts follow them."""
+
+        u0, u1, u2, u3, u4, u5 = self.ids
+        recommend(workers=1)
+
+        self.assertEqual(self.suggestions(u0), [(u3, 2), (u4, 1)])
+        self.assertEqual(self.suggestions(u2), [(u1, 1)])
+        self.assertEqual(self.suggestions(u5), [])
+
+    def test_top_k_and_stale(self):
+        """Only the top k are kept; --stale redoes only changed users."""
+
+        u0, u1, u2, u3, u4, u5 = self.ids
+        recommend(workers=1, top_k=1)
+        self.assertEqual(self.suggestions(u0), [(u3, 2)])
+
+        # u0 follows u3 (their version moves on); u2's suggestions go stale
+        # too, but --stale only redoes u0.
+        self.follow([(u0, u3), (u3, u5)])
+        recommend(stale=True, workers=1)
+
+        self.assertEqual(self.suggestions(u0), [(u4, 1), (u5, 1)])
+        self.assertEqual(self.suggestions(u2), [(u1, 1)])
+
+    def test_parallel_matches_serial(self):
+        """Blocks scored in worker processes give the same result."""
+
+        recommend(workers=1, block_size=2)
+        serial = [self.suggestions(user_id) for user_id in self.ids]
+
+        recommend(workers=2, block_size=2)
+        self.assertEqual([self.suggestions(user_id) for user_id in self.ids],
+                         serial)
+
+    def test_sidebar_and_api(self):
+        """The profile sidebar and API show suggestions not yet followed."""
+
+        u0, u1, _, u3, u4, _ = self.ids
+        recommend(workers=1)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u0
+
+            html = c.get(f'/users/{u1}').get_data(as_text=True)
+            self.assertIn('Who to follow', html)
+            self.assertIn('@user3', html)
+            self.assertIn('Followed by 2 people you follow', html)
+
+            c.post(f'/users/follow/{u3}')
+
+            resp = c.get('/api/v1/recommendations')
+            self.assertEqual([(item['id'], item['score'])
+                              for item in resp.json['items']], [(u4, 1)])
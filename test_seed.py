@@ -0,0 +1,166 @@
+"""Seed loader tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_seed.py
+
+
+import csv
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import inspect
+
+from models import (db, DirectMessage, Follows, Like, Message, TimelineEntry,
+                    User)
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+import seed
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+CSVS = {
+    'users.csv': [
+        ['id', 'email', 'username', 'image_url', 'password', 'bio',
+         'location'],
+        *[[i, f"user{i}@test.com", f"user{i}", "", "HASHED_PASSWORD",
+           f"bio {i}", ""] for i in range(1, 7)],
+    ],
+    'messages.csv': [
+        ['id', 'text', 'timestamp', 'user_id'],
+        *[[i, f"warble {i}", f"2022-01-01 00:00:{i:02d}", i % 6 + 1]
+          for i in range(1, 10)],
+    ],
+    'follows.csv': [
+        ['user_being_followed_id', 'user_following_id'],
+        [1, 2], [1, 3], [2, 1], [3, 1], [4, 5],
+    ],
+    'likes.csv': [
+        ['user_id', 'message_id'],
+        [1, 2], [1, 3], [2, 3], [4, 3],
+    ],
+    'direct_messages.csv': [
+        ['text', 'timestamp', 'user_id', 'recipient_id'],
+        ["hello", "2022-01-02 00:00:00", 1, 2],
+        ["hi back", "2022-01-02 00:01:00", 2, 1],
+    ],
+}
+
+
+class Interrupted(Exception):
+    """Stands in for the load being killed part way through."""
+
+
+def interrupt_after(calls, load_chunk):
+    """Wrap `load_chunk` to fail on every call after the first `calls`."""
+
+    made = 0
+
+    def wrapped(*args):
+        nonlocal made
+        made += 1
+        if made > calls:
+            raise Interrupted()
+        return load_chunk(*args)
+
+    return wrapped
+
+
+class SeedTestCase(TestCase):
+    """Test seed.py's chunked, resumable load."""
+
+    def setUp(self):
+        """Write a small data set in the generator's CSV format."""
+
+        self.data_dir = tempfile.mkdtemp()
+
+        for filename, rows in CSVS.items():
+            with open(os.path.join(self.data_dir, filename), 'w',
+                      newline='') as f:
+                csv.writer(f).writerows(rows)
+
+    def tearDown(self):
+        db.session.rollback()
+        shutil.rmtree(self.data_dir)
+
+        # Leave the usual empty schema for the other test modules.
+        db.drop_all()
+        db.create_all()
+
+    def test_interrupt_and_resume(self):
+        # Chunks of 2 rows: users take 3, then the second chunk of
+        # messages fails.
+        with patch.object(seed, 'insert_chunk',
+                          interrupt_after(4, seed.insert_chunk)), \
+                patch.object(seed, 'copy_chunk',
+                             interrupt_after(4, seed.copy_chunk)):
+            with self.assertRaises(Interrupted):
+                seed.seed(self.data_dir, chunk_size=2)
+
+        db.session.rollback()
+
+        # Every committed chunk stays, with its progress.
+        self.assertEqual(User.query.count(), 6)
+        self.assertEqual(Message.query.count(), 2)
+        self.assertEqual(seed.get_progress('messages'), 2)
+
+        seed.seed(self.data_dir, resume=True, chunk_size=2)
+
+        self.assertEqual(User.query.count(), 6)
+        self.assertEqual(Message.query.count(), 9)
+        self.assertEqual(Follows.query.count(), 5)
+        self.assertEqual(Like.query.count(), 4)
+        self.assertEqual(DirectMessage.query.count(), 2)
+        self.assertFalse(inspect(db.engine).has_table(seed.progress.name))
+
+        # Timelines, counters and indexes are rebuilt.
+        user1 = User.query.get(1)
+        self.assertEqual(user1.message_count, 1)
+        self.assertEqual(user1.follower_count, 2)
+        self.assertEqual(user1.following_count, 2)
+        self.assertEqual(Message.query.get(3).like_count, 3)
+        # user1's own warble and the two each of user2 and user3
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=1).count(),
+                         5)
+        self.assertIn('ix_messages_user_timestamp',
+                      {index['name'] for index in
+                       inspect(db.engine).get_indexes('messages')})
+
+        # Sequences continue after the loaded ids.
+        user = User.signup(username="newuser",
+                           email="new@test.com",
+                           password="password",
+                           image_url=None)
+        db.session.commit()
+        self.assertEqual(user.id, 7)
+
+        message = Message(text="new warble", user_id=user.id)
+        db.session.add(message)
+        db.session.commit()
+        self.assertEqual(message.id, 10)
+
+    def test_resume_without_load(self):
+        seed.progress.drop(db.engine, checkfirst=True)
+
+        with self.assertRaises(SystemExit):
+            seed.seed(self.data_dir, resume=True)
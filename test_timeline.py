@@ -0,0 +1,186 @@
+"""Home timeline tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_timeline.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, Message, User, Follows, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from pagination import paginate
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TimelineTestCase(TestCase):
+    """Test materialized home timelines."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        TimelineEntry.query.delete()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+
+        self.testuser2 = User.signup(username="testuser2",
+                                     email="test2@test2.com",
+                                     password="testuser2",
+                                     image_url=None)
+        self.testuser.id = 100
+        self.testuser_id = self.testuser.id
+        self.testuser2.id = 200
+        self.testuser2_id = self.testuser2.id
+        db.session.commit()
+
+        msg = Message(id=300,
+                      text="Old warble",
+                      user_id=self.testuser2_id)
+        db.session.add(msg)
+        db.session.commit()
+
+    def test_follow_backfills_timeline(self):
+        """Does following a user copy their messages into my timeline?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/users/follow/{self.testuser2_id}")
+
+            entries = TimelineEntry.query.filter_by(
+                user_id=self.testuser_id).all()
+            self.assertEqual([e.message_id for e in entries], [300])
+
+            resp = c.get("/")
+            self.assertIn("Old warble", resp.get_data(as_text=True))
+
+    def test_new_message_fans_out(self):
+        """Does posting a message add it to followers' timelines?"""
+
+        db.session.add(Follows(user_being_followed_id=self.testuser_id,
+                               user_following_id=self.testuser2_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/messages/new", data={"text": "Fresh warble"})
+
+        msg = Message.query.filter_by(text="Fresh warble").one()
+        owners = {e.user_id for e in
+                  TimelineEntry.query.filter_by(message_id=msg.id)}
+        self.assertEqual(owners, {self.testuser_id, self.testuser2_id})
+
+    def test_unfollow_purges_timeline(self):
+        """Does unfollowing remove that user's messages from my timeline?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/users/follow/{self.testuser2_id}")
+            c.post(f"/users/stop-following/{self.testuser2_id}")
+
+            resp = c.get("/")
+            self.assertNotIn("Old warble", resp.get_data(as_text=True))
+            self.assertEqual(
+                TimelineEntry.query.filter_by(user_id=self.testuser_id).count(),
+                0)
+
+    def test_repeated_follow_counts_once(self):
+        """Do repeated follow/unfollow requests only count real changes?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/users/follow/{self.testuser2_id}")
+            resp = c.post(f"/users/follow/{self.testuser2_id}",
+                          headers={"Accept": "application/json"})
+            self.assertEqual(resp.json, {"user_id": self.testuser2_id,
+                                         "following": True})
+
+            self.assertEqual(Follows.query.count(), 1)
+            self.assertEqual(User.query.get(self.testuser_id).following_count,
+                             1)
+            self.assertEqual(User.query.get(self.testuser2_id).follower_count,
+                             1)
+
+            c.post(f"/users/stop-following/{self.testuser2_id}")
+            c.post(f"/users/stop-following/{self.testuser2_id}")
+
+            self.assertEqual(Follows.query.count(), 0)
+            self.assertEqual(User.query.get(self.testuser_id).following_count,
+                             0)
+
+    def test_rebuild_caps_each_author(self):
+        """Does rebuild copy only each author's most recent messages?"""
+
+        for i in range(4):
+            db.session.add(Message(id=400 + i, text=f"warble {i}",
+                                   user_id=self.testuser2_id,
+                                   timestamp=datetime(2020, 1, 1 + i)))
+        db.session.add(Follows(user_following_id=self.testuser_id,
+                               user_being_followed_id=self.testuser2_id))
+        db.session.commit()
+
+        TimelineEntry.rebuild(limit=2)
+        db.session.commit()
+
+        entries = (TimelineEntry.query
+                   .filter_by(user_id=self.testuser_id)
+                   .order_by(TimelineEntry.timestamp.desc())
+                   .all())
+        # "Old warble" (300) was posted now, after the 2020 messages.
+        self.assertEqual([entry.message_id for entry in entries], [300, 403])
+        self.assertEqual(TimelineEntry.query.filter_by(
+            user_id=self.testuser2_id).count(), 2)
+
+    def test_paginate_with_cursor(self):
+        """Does the 'before' cursor fetch the next older page?"""
+
+        db.session.add(Message(id=301,
+                               text="New warble",
+                               user_id=self.testuser2_id))
+        db.session.commit()
+
+        query = Message.query.filter(Message.user_id == self.testuser2_id)
+        page, cursor = paginate(query, Message.timestamp, Message.id, limit=1)
+        self.assertEqual([m.id for m in page], [301])
+        self.assertIsNotNone(cursor)
+
+        page, cursor = paginate(query, Message.timestamp, Message.id,
+                                cursor=cursor, limit=1)
+        self.assertEqual([m.id for m in page], [300])
+        self.assertIsNone(cursor)
@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Follows, Like, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -82,3 +82,66 @@ class MessageViewTestCase(TestCase):
             user = User.query.get(self.testuser_id)
             like = user.likes[0]
             self.assertEqual(like.id, self.msg_id)
+
+    def test_liked_button_state(self):
+        """Test that a liked message renders as liked on the profile page"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post('/messages/300/like')
+            resp = c.get(f'/users/{self.testuser2_id}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('>liked</button>', html)
+
+    def test_liked_button_state_on_home(self):
+        """Test that a liked message renders as liked on the home timeline"""
+
+        db.session.add(Follows(user_being_followed_id=self.testuser2_id,
+                               user_following_id=self.testuser_id))
+        db.session.commit()
+        TimelineEntry.backfill(self.testuser_id, self.testuser2_id)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post('/messages/300/like', follow_redirects=True)
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('>liked</button>', html)
+
+    def test_like_toggle_json(self):
+        """Test that a fetch() like toggles and returns the new state"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            headers = {'Accept': 'application/json'}
+
+            resp = c.post('/messages/300/like', headers=headers)
+            self.assertEqual(resp.json, {'message_id': 300, 'liked': True})
+            self.assertEqual(User.query.get(self.testuser_id).likes_count, 1)
+
+            resp = c.post('/messages/300/like', headers=headers)
+            self.assertEqual(resp.json, {'message_id': 300, 'liked': False})
+            self.assertEqual(User.query.get(self.testuser_id).likes_count, 0)
+
+    def test_cannot_like_own_message(self):
+        """Test that authors can't like their own messages"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser2_id
+
+            resp = c.post('/messages/300/like',
+                          headers={'Accept': 'application/json'})
+
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(Like.query.count(), 0)
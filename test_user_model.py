@@ -6,11 +6,15 @@
 
 
 import os
+import time
+from threading import Event, Thread
 from unittest import TestCase
 
+from flask import Flask
 from psycopg2 import IntegrityError
 
 from models import db, User, Message, Follows
+from hashing import hasher, HashingOverloaded, PasswordHasher
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -96,6 +100,18 @@ class UserModelTestCase(TestCase):
         self.assertTrue(self.user.is_following(self.user2))
 
     
+    def test_following_ids_among(self):
+        """Does the batched follow check return only followed ids"""
+
+        self.user.following.append(self.user2)
+        db.session.commit()
+
+        self.assertEqual(
+            self.user.following_ids_among([self.user2.id, self.user.id, 9999]),
+            {self.user2.id})
+        self.assertEqual(self.user.following_ids_among([]), set())
+
+
     def test_is_not_followed_by(self):
         """Does is followed by method work when not followed"""
 
@@ -111,6 +127,22 @@ class UserModelTestCase(TestCase):
         self.assertTrue(self.user.is_followed_by(self.user2))
 
     
+    def test_user_recount(self):
+        """Does recount repair the denormalized counters"""
+
+        self.user.following.append(self.user2)
+        db.session.add(Message(text="Counted", user_id=self.user.id))
+        db.session.commit()
+
+        User.recount()
+        db.session.commit()
+
+        self.assertEqual(self.user.message_count, 1)
+        self.assertEqual(self.user.following_count, 1)
+        self.assertEqual(self.user2.follower_count, 1)
+        self.assertEqual(self.user2.following_count, 0)
+
+
     def test_user_signup(self):
         """Does User signup successfully create a new user"""
 
@@ -166,3 +198,61 @@ class UserModelTestCase(TestCase):
 
         self.assertFalse(user, test_user)
 
+
+    def test_user_authenticate_rehash(self):
+        """Does authenticate rehash a password made at a different cost"""
+
+        rounds = hasher.rounds
+        hasher.rounds = 4
+        try:
+            User.signup('new_user', 'new_email', '123456', 'http://google.com')
+            db.session.commit()
+
+            hasher.rounds = 5
+            user = User.authenticate("new_user", "123456")
+            db.session.commit()
+        finally:
+            hasher.rounds = rounds
+
+        self.assertTrue(user.password.startswith("$2b$05$"))
+        self.assertTrue(hasher.check(user.password, "123456"))
+
+    def test_hashing_overloaded(self):
+        """Does a full hashing queue reject quickly and log its metrics"""
+
+        pool = PasswordHasher(rounds=4, workers=1, max_queue=0,
+                              queue_timeout=0.01)
+        release = Event()
+        busy = Thread(target=pool._run, args=(release.wait,))
+        busy.start()
+
+        try:
+            while not pool.metrics()['in_flight']:
+                time.sleep(0.001)
+
+            with self.assertLogs('warbler.hashing', 'WARNING') as logs:
+                with self.assertRaises(HashingOverloaded):
+                    pool.hash("123456")
+        finally:
+            release.set()
+            busy.join()
+
+        self.assertIn('"rejected": 1', logs.output[0])
+        self.assertEqual(pool.metrics()['rejected'], 1)
+
+    def test_hashing_init_app_replaces_pool(self):
+        """Does init_app shut down the pool it replaces"""
+
+        pool = PasswordHasher(rounds=4, workers=1)
+        old_pool = pool._pool
+
+        configured = Flask(__name__)
+        configured.config['BCRYPT_LOG_ROUNDS'] = 4
+        configured.config['HASHING_WORKERS'] = 2
+        pool.init_app(configured)
+
+        with self.assertRaises(RuntimeError):
+            old_pool.submit(time.sleep, 0)
+
+        self.assertEqual(pool.workers, 2)
+        self.assertTrue(pool.check(pool.hash("123456"), "123456"))
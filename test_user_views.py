@@ -19,7 +19,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, identity_cache, CURR_USER_KEY
+from search import search_users
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -78,6 +79,28 @@ class MessageViewTestCase(TestCase):
         db.session.commit()
 
 
+    def test_user_search(self):
+        """Testing: does search rank the exact username match first?"""
+
+        with self.client as c:
+            resp = c.get("/users?q=testuser2")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@testuser2", html)
+            self.assertNotIn("@testuser3", html)
+
+    def test_user_search_pagination(self):
+        """Testing: does the search cursor page through results?"""
+
+        users, cursor = search_users("testuser", limit=2)
+        self.assertEqual(users[0].id, self.testuser_id)
+        self.assertIsNotNone(cursor)
+
+        more, cursor = search_users("testuser", cursor, limit=2)
+        self.assertEqual(len(more), 1)
+        self.assertIsNone(cursor)
+        self.assertNotIn(more[0], users)
+
     def test_following_page(self):
         """Testing: can you see the following pages for any user?"""
 
@@ -123,3 +146,101 @@ class MessageViewTestCase(TestCase):
             html = resp.get_data(as_text=True)
             self.assertEqual(resp.status_code, 200)
             self.assertIn("You can not follow yourself!!!", html)
+
+    def test_edit_profile_refreshes_message_cards(self):
+        """Test cached message cards show the new username after an edit"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/messages/new", data={"text": "Cached warble"})
+            c.get(f"/users/{self.testuser_id}")
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "test@test.com",
+                                           "image_url": "",
+                                           "header_image_url": "",
+                                           "bio": "",
+                                           "password": "testuser"})
+
+            resp = c.get(f"/users/{self.testuser_id}")
+            html = resp.get_data(as_text=True)
+            self.assertIn("@renamed", html)
+            self.assertNotIn("@testuser<", html)
+
+    def test_edit_profile_refreshes_identity(self):
+        """Test the cached identity is dropped when the profile changes"""
+
+        # Not `with self.client`: that keeps the streamed page's context
+        # (and its g.identity) alive into the next request.
+        c = self.client
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser_id
+
+        resp = c.get("/")
+        resp.get_data()
+        resp.close()
+        self.assertEqual(identity_cache.get(self.testuser_id).username,
+                         "testuser")
+
+        c.post("/users/profile", data={"username": "renamed",
+                                       "email": "test@test.com",
+                                       "image_url": "",
+                                       "header_image_url": "",
+                                       "bio": "",
+                                       "password": "testuser"})
+        self.assertIsNone(identity_cache.get(self.testuser_id))
+
+        resp = c.get("/")
+        html = resp.get_data(as_text=True)
+        resp.close()
+        self.assertIn('alt="renamed"', html)
+        self.assertEqual(identity_cache.get(self.testuser_id).username,
+                         "renamed")
+
+    def test_delete_user_drops_identity(self):
+        """Test a deleted user's cached identity is dropped"""
+
+        # Not `with self.client`; see test_edit_profile_refreshes_identity.
+        c = self.client
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser_id
+
+        resp = c.get("/")
+        resp.get_data()
+        resp.close()
+        self.assertIsNotNone(identity_cache.get(self.testuser_id))
+
+        resp = c.post("/users/delete")
+        self.assertEqual(resp.status_code, 302)
+        self.assertIsNone(identity_cache.get(self.testuser_id))
+
+        # a stale session for the deleted id is anonymous
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser_id
+
+        resp = c.get(f"/users/{self.testuser2_id}/following")
+        self.assertEqual(resp.status_code, 302)
+
+    def test_profile_conditional_get(self):
+        """Test profile pages answer 304 until the profile changes"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get(f"/users/{self.testuser_id}")
+            etag = resp.headers["ETag"]
+            self.assertEqual(resp.status_code, 200)
+
+            resp = c.get(f"/users/{self.testuser_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            c.post("/messages/new", data={"text": "Changes the page"})
+
+            resp = c.get(f"/users/{self.testuser_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Changes the page", resp.get_data(as_text=True))